@@ -0,0 +1,491 @@
+""" Benchmarks on vicroads declared roads data
+
+eg. python3 bench.py index VicRoads_Declared_Roads.kml --sizes 10000 100000
+"""
+
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+import unittest.mock
+from array import array
+
+import contraction_hierarchy
+import distance_matrix
+import graph_search
+import graph_update
+import kd_tree
+import kml_convert
+import landmarks
+import placemark_graph
+import placemark_store
+import snapping
+import spatial_hash
+
+
+def main():
+    args = parse_args()
+    args.func(args)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks on vicroads kml data')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    index_parser = subparsers.add_parser(
+        'index', help='compare spatial indexes for the close node join')
+    add_kml_args(index_parser)
+    index_parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                              help='number of road points to index. Default: all')
+    index_parser.add_argument('-q', '--queries', type=int, default=100,
+                              help='number of queries to time for kd_tree.create + search_knn')
+    index_parser.add_argument('-c', '--cell-size', type=float,
+                              help='spatial hash cell size. Default: about one point per cell')
+    index_parser.set_defaults(func=bench_index)
+
+    coords_parser = subparsers.add_parser(
+        'coords', help='time decoding of kml <coordinates> blocks')
+    coords_parser.add_argument('kml', help='vicroads kml data file')
+    coords_parser.add_argument('-l', '--limit', type=int, help='limit the numer of placemarks read')
+    coords_parser.add_argument('-r', '--repeat', type=int, default=3,
+                               help='number of timing runs, the best is reported')
+    coords_parser.set_defaults(func=bench_coords)
+
+    bbox_parser = subparsers.add_parser(
+        'bbox', help='time extracting regions with the bbox filter')
+    bbox_parser.add_argument('kml', help='vicroads kml data file')
+    bbox_parser.add_argument('-l', '--limit', type=int, help='limit the numer of placemarks read')
+    bbox_parser.add_argument('-n', '--num-boxes', type=int, default=10,
+                             help='number of regions to extract. Default: %(default)s')
+    bbox_parser.set_defaults(func=bench_bbox)
+
+    alt_parser = subparsers.add_parser(
+        'alt', help='compare A* with and without ALT landmarks')
+    add_kml_args(alt_parser)
+    alt_parser.add_argument('-n', '--num-landmarks', type=int,
+                            default=landmarks.DEFAULT_NUM_LANDMARKS,
+                            help='number of landmarks. Default: %(default)s')
+    alt_parser.add_argument('-q', '--queries', type=int, default=20,
+                            help='number of random queries. Default: %(default)s')
+    alt_parser.add_argument('-s', '--simplify', action='store_true',
+                            help='merge chains of degree 2 nodes first')
+    alt_parser.add_argument('--seed', type=int, default=0, help='random seed for the queries')
+    alt_parser.set_defaults(func=bench_alt)
+
+    ch_parser = subparsers.add_parser(
+        'ch', help='compare contraction hierarchy queries with bidirectional dijkstra')
+    add_kml_args(ch_parser)
+    ch_parser.add_argument('-q', '--queries', type=int, default=20,
+                           help='number of random queries. Default: %(default)s')
+    ch_parser.add_argument('-s', '--simplify', action='store_true',
+                           help='merge chains of degree 2 nodes first')
+    ch_parser.add_argument('--seed', type=int, default=0, help='random seed for the queries')
+    ch_parser.set_defaults(func=bench_ch)
+
+    matrix_parser = subparsers.add_parser(
+        'matrix', help='time many-to-many distance matrices')
+    add_kml_args(matrix_parser)
+    matrix_parser.add_argument('-n', '--size', type=int, default=20,
+                               help='number of sources, and of targets. Default: %(default)s')
+    matrix_parser.add_argument('-j', '--jobs', type=int, nargs='+', default=[1],
+                               help='process pool sizes to time. Default: 1')
+    matrix_parser.add_argument('--seed', type=int, default=0, help='random seed for the nodes')
+    matrix_parser.set_defaults(func=bench_matrix)
+
+    snap_parser = subparsers.add_parser(
+        'snap', help='time snapping random points to the road graph')
+    add_kml_args(snap_parser)
+    snap_parser.add_argument('-q', '--queries', type=int, default=10000,
+                             help='number of points to snap. Default: %(default)s')
+    snap_parser.add_argument('--seed', type=int, default=0, help='random seed for the points')
+    snap_parser.set_defaults(func=bench_snap)
+
+    knn_parser = subparsers.add_parser(
+        'knn', help='compare recursive and iterative k nearest neighbour searches')
+    add_kml_args(knn_parser)
+    knn_parser.add_argument('-k', type=int, nargs='+', default=[1, 2, 10],
+                            help='numbers of neighbours to find. Default: %(default)s')
+    knn_parser.add_argument('-q', '--queries', type=int, default=1000,
+                            help='number of random road points to search around. Default: %(default)s')
+    knn_parser.add_argument('--seed', type=int, default=0, help='random seed for the queries')
+    knn_parser.set_defaults(func=bench_knn)
+
+    range_parser = subparsers.add_parser(
+        'range', help='compare kd_tree range searches with brute force')
+    add_kml_args(range_parser)
+    range_parser.add_argument('-q', '--queries', type=int, default=100,
+                              help='number of random road points to search around. Default: %(default)s')
+    range_parser.add_argument('-d', '--distances', type=float, nargs='+',
+                              default=[0.0001, 0.001, 0.01],
+                              help='search radii, in degrees. Default: %(default)s')
+    range_parser.add_argument('--seed', type=int, default=0, help='random seed for the queries')
+    range_parser.set_defaults(func=bench_range)
+
+    memory_parser = subparsers.add_parser(
+        'memory', help='measure the memory used per node by graph nodes and spatial indexes')
+    add_kml_args(memory_parser)
+    memory_parser.set_defaults(func=bench_memory)
+
+    update_parser = subparsers.add_parser(
+        'update', help='compare updating the graph for edited roads with a full rebuild')
+    add_kml_args(update_parser)
+    update_parser.add_argument('-n', '--changes', type=int, nargs='+', default=[1, 10, 100],
+                               help='numbers of placemarks to edit. Default: %(default)s')
+    update_parser.add_argument('--seed', type=int, default=0, help='random seed for the edits')
+    update_parser.set_defaults(func=bench_update)
+
+    if args is None:
+        return parser.parse_args()
+    else:
+        return parser.parse_args(args)
+
+
+def add_kml_args(parser):
+    parser.add_argument('kml', help='vicroads kml data file')
+    parser.add_argument('-l', '--limit', type=int, help='limit the numer of placemarks read')
+    parser.add_argument('-b', '--bbox', type=float, nargs=4,
+                        help='bounding box: [lat lon lat lon]. Points outside this box are removed')
+
+
+def load_store(args):
+    store = kml_convert.kml_2_placemark_store(args.kml, args.limit)
+    if args.bbox:
+        store = kml_convert.filter_placemarks_bbox(store, args.bbox)
+    return store
+
+
+def timed(f, *args, **kwargs):
+    """ Returns (result, seconds taken) """
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_index(args):
+    store = load_store(args)
+    sizes = args.sizes or [store.num_points]
+    print('{:>10} {:<24} {:>10} {:>14}'.format('points', 'index', 'build s', 'us/query'))
+    for size in sizes:
+        xs = store.lons[:size]
+        ys = store.lats[:size]
+        n = len(xs)
+        nq = min(args.queries, n)
+        points = list(zip(xs, ys))
+
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * n))
+        tree, build = timed(kd_tree.create, points)
+        _, query = timed(lambda: [tree.search_knn(p, 2) for p in points[:nq]])
+        print_row(n, 'kd_tree.create', build, query, nq)
+
+        tree, build = timed(kd_tree.create_bulk, xs=xs, ys=ys)
+        _, query = timed(tree.search_knn_batch, xs, ys, 2)
+        print_row(n, 'kd_tree.create_bulk', build, query, n)
+
+        index, build = timed(spatial_hash.create, xs=xs, ys=ys, cell_size=args.cell_size)
+        _, query = timed(index.search_knn_batch, xs, ys, 2)
+        print_row(n, 'spatial_hash.create', build, query, n)
+
+        _, join = timed(tree.query_pairs, .0000000000001)
+        print_row(n, 'kd_tree query_pairs', 0, join, n)
+        _, join = timed(index.query_pairs, .0000000000001)
+        print_row(n, 'spatial_hash query_pairs', 0, join, n)
+
+
+def bench_coords(args):
+    texts = []
+    for i, p in enumerate(kml_convert.iter_placemark_elements(args.kml)):
+        if args.limit and i >= args.limit:
+            break
+        texts.extend(c.text for c in p.iter('coordinates'))
+    num_vertices = sum(len(t.split()) for t in texts)
+
+    def per_tuple():
+        for t in texts:
+            list(kml_convert.coords_text_to_points(t))
+
+    def bulk_points():
+        for t in texts:
+            kml_convert.points_from_arrays(*kml_convert.coords_text_to_arrays(t))
+
+    def bulk():
+        for t in texts:
+            kml_convert.coords_text_to_arrays(t)
+
+    print('{} coordinate blocks, {} vertices'.format(len(texts), num_vertices))
+    # placemark_e2obj makes Points, placemark_e2store keeps the arrays
+    for name, f in [('coords_text_to_points', per_tuple),
+                    ('arrays + points_from_arrays', bulk_points),
+                    ('coords_text_to_arrays', bulk)]:
+        best = min(timed(f)[1] for _ in range(args.repeat))
+        print('{:<28} {:>8.1f} ns/vertex'.format(name, 1e9 * best / num_vertices))
+
+
+def bench_bbox(args):
+    store = kml_convert.kml_2_placemark_store(args.kml, args.limit)
+    minlat, maxlat = min(store.lats), max(store.lats)
+    minlon, maxlon = min(store.lons), max(store.lons)
+    # a grid of regions, each a quarter of the data's extent in each direction
+    height, width = (maxlat - minlat) / 4, (maxlon - minlon) / 4
+    bboxes = []
+    for i in range(args.num_boxes):
+        lat = minlat + (i % 4) * (maxlat - minlat - height) / 3
+        lon = minlon + (i // 4 % 4) * (maxlon - minlon - width) / 3
+        bboxes.append((lat, lat + height, lon, lon + width))
+
+    def point_check(bbox):
+        lo_lat, hi_lat, lo_lon, hi_lon = bbox
+        return [[(lat, lon) for lat, lon in p.latlons()
+                 if lat >= lo_lat and lat < hi_lat and lon >= lo_lon and lon < hi_lon]
+                for p in store]
+
+    print('{} placemarks, {} points, {} regions'.format(len(store), store.num_points, len(bboxes)))
+    _, seconds = timed(lambda: [point_check(b) for b in bboxes])
+    print('{:<28} {:>8.3f} s'.format('per point check', seconds))
+    _, seconds = timed(store.bounds)
+    print('{:<28} {:>8.3f} s'.format('bounding box index', seconds))
+    _, seconds = timed(placemark_store.filter_store_bboxes, store, bboxes)
+    print('{:<28} {:>8.3f} s'.format('filter_store_bboxes', seconds))
+
+
+def bench_alt(args):
+    store = load_store(args)
+    graph = kml_convert.placemarks_to_csr_graph(store, args.simplify)
+    component = landmarks.largest_component(graph)
+    print('{} nodes, largest connected component {} nodes'.format(len(graph), len(component)))
+    alt, build = timed(landmarks.select_farthest, graph, args.num_landmarks, component[0])
+    print('{} landmarks in {:.2f} s'.format(len(alt), build))
+
+    rng = random.Random(args.seed)
+    queries = [(rng.choice(component), rng.choice(component)) for _ in range(args.queries)]
+    print('{:<10} {:>14} {:>12}'.format('search', 'settled/query', 'ms/query'))
+    for name, heuristic in [('A*', lambda target: None),
+                            ('A* + ALT', lambda target: alt.heuristic(target, graph))]:
+        settled = 0
+        start = time.perf_counter()
+        for source, target in queries:
+            settled += graph_search.astar(graph, source, target, heuristic(target)).settled
+        seconds = time.perf_counter() - start
+        print('{:<10} {:>14.0f} {:>12.2f}'.format(
+            name, settled / len(queries), 1e3 * seconds / len(queries)))
+
+
+def bench_ch(args):
+    store = load_store(args)
+    graph = kml_convert.placemarks_to_csr_graph(store, args.simplify)
+    ch, build = timed(contraction_hierarchy.build, graph)
+    print('{} nodes, {} edges. Contracted in {:.1f} s, adding {} shortcuts'.format(
+        len(graph), graph.num_edges, build, ch.num_shortcuts))
+
+    rng = random.Random(args.seed)
+    queries = [(rng.randrange(len(graph)), rng.randrange(len(graph)))
+               for _ in range(args.queries)]
+    print('{:<24} {:>14} {:>12}'.format('search', 'settled/query', 'ms/query'))
+    for name, search in [('bidirectional_dijkstra',
+                          lambda s, t: graph_search.bidirectional_dijkstra(graph, s, t)),
+                         ('contraction hierarchy', ch.query)]:
+        settled = 0
+        start = time.perf_counter()
+        for source, target in queries:
+            settled += search(source, target).settled
+        seconds = time.perf_counter() - start
+        print('{:<24} {:>14.0f} {:>12.2f}'.format(
+            name, settled / len(queries), 1e3 * seconds / len(queries)))
+
+
+def bench_matrix(args):
+    store = load_store(args)
+    graph = kml_convert.placemarks_to_csr_graph(store)
+    rng = random.Random(args.seed)
+    sources = [rng.randrange(len(graph)) for _ in range(args.size)]
+    targets = [rng.randrange(len(graph)) for _ in range(args.size)]
+    print('{} nodes, {} x {} matrix'.format(len(graph), len(sources), len(targets)))
+
+    _, seconds = timed(lambda: [graph_search.bidirectional_dijkstra(graph, s, t)
+                                for s in sources for t in targets])
+    print('{:<28} {:>8.2f} s'.format('pairwise searches', seconds))
+    for jobs in args.jobs:
+        _, seconds = timed(distance_matrix.distance_matrix, graph, sources, targets, jobs)
+        print('{:<28} {:>8.2f} s'.format('distance_matrix, {} jobs'.format(jobs), seconds))
+
+
+def bench_snap(args):
+    store = load_store(args)
+    graph = kml_convert.placemarks_to_csr_graph(store)
+    rng = random.Random(args.seed)
+    # points scattered around random road nodes, like noisy gps fixes
+    nodes = [rng.randrange(len(graph)) for _ in range(args.queries)]
+    lats = array('d', (graph.lats[i] + rng.gauss(0, 0.0002) for i in nodes))
+    lons = array('d', (graph.lons[i] + rng.gauss(0, 0.0002) for i in nodes))
+    snapper = snapping.Snapper(graph)
+    print('{} nodes, {} edges, {} points'.format(len(graph), graph.num_edges, len(lats)))
+    print('{:<16} {:>10} {:>14}'.format('snap to', 'build s', 'us/point'))
+    for name, index, snap in [('nodes', 'node_index', snapper.snap_nodes),
+                              ('segments', 'segment_index', snapper.snap_segments)]:
+        _, build = timed(getattr, snapper, index)
+        _, seconds = timed(snap, lats, lons)
+        print('{:<16} {:>10.2f} {:>14.1f}'.format(name, build, 1e6 * seconds / len(lats)))
+
+
+def bench_knn(args):
+    store = load_store(args)
+    points = list(zip(store.lons, store.lats))
+    rng = random.Random(args.seed)
+    queries = [points[rng.randrange(len(points))] for _ in range(args.queries)]
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * len(points)))
+    tree = kd_tree.create(points)
+    bulk_tree = kd_tree.create_bulk(points)
+    print('{} points, {} queries'.format(len(points), len(queries)))
+    print('{:>4} {:<28} {:>14} {:>10}'.format('k', 'search', 'us/query', 'speedup'))
+    for k in args.k:
+        recursive, base = timed(lambda: [tree.search_knn(p, k) for p in queries])
+        iterative, seconds = timed(lambda: [tree.search_knn_2d(p, k) for p in queries])
+        same = all([id(n) for n, _ in a] == [id(n) for n, _ in b]
+                   for a, b in zip(recursive, iterative))
+        _, bulk = timed(lambda: [bulk_tree.search_knn(p, k) for p in queries])
+        for name, t in [('KDNode.search_knn', base), ('KDNode.search_knn_2d', seconds),
+                        ('ImplicitKDTree.search_knn', bulk)]:
+            print('{:>4} {:<28} {:>14.1f} {:>9.1f}x'.format(
+                k, name, 1e6 * t / len(queries), base / t))
+        if not same:
+            print('search_knn_2d results differ from search_knn')
+
+
+def bench_range(args):
+    store = load_store(args)
+    xs, ys = store.lons, store.lats
+    n = len(xs)
+    points = list(zip(xs, ys))
+    rng = random.Random(args.seed)
+    queries = [points[rng.randrange(n)] for _ in range(args.queries)]
+
+    def brute_force(point, distance):
+        # strictly closer, as search_nn_dist finds
+        px, py = point
+        max_d = distance * distance
+        found = []
+        for i in range(n):
+            dx = xs[i] - px
+            dy = ys[i] - py
+            if dx * dx + dy * dy < max_d:
+                found.append(i)
+        return found
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * n))
+    node_tree, node_build = timed(kd_tree.create, points)
+    tree, build = timed(kd_tree.create_bulk, xs=xs, ys=ys)
+    print('{} points, {} queries'.format(n, len(queries)))
+    print('{:>10} {:<30} {:>10} {:>14} {:>10}'.format(
+        'distance', 'search', 'build s', 'us/query', 'found'))
+    for distance in args.distances:
+        # ImplicitKDTree.search_nn_dist is search_range, which also finds
+        # points at exactly distance, filtered to those strictly closer
+        for name, build_time, search in [
+                ('brute force', 0, brute_force),
+                ('KDNode.search_nn_dist', node_build, node_tree.search_nn_dist),
+                ('ImplicitKDTree.search_nn_dist', build, tree.search_nn_dist)]:
+            found, seconds = timed(lambda: [search(p, distance) for p in queries])
+            print('{:>10} {:<30} {:>10.3f} {:>14.1f} {:>10}'.format(
+                distance, name, build_time, 1e6 * seconds / len(queries),
+                sum(len(f) for f in found)))
+
+
+def bench_memory(args):
+    store = load_store(args)
+    points = list(zip(store.lons, store.lats))
+    n = len(points)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * n))
+
+    # subclasses without __slots__ get a __dict__ again, as the nodes had
+    # before they used slots
+    class DictNode(placemark_graph.Node):
+        pass
+
+    class DictKDNode(kd_tree.KDNode):
+        pass
+
+    print('{} points'.format(n))
+    print('{:<36} {:>14}'.format('structure', 'bytes/node'))
+    tracemalloc.start()
+    try:
+        for label, node_class in [('placemark_graph.Node', placemark_graph.Node),
+                                  ('  with __dict__', DictNode)]:
+            with unittest.mock.patch.object(placemark_graph, 'Node', node_class):
+                nodes, size = traced_size(placemark_graph.placemarks_to_nodes, store)
+            print('{:<36} {:>14.1f}'.format(label, size / n))
+            del nodes
+        nodes = placemark_graph.placemarks_to_nodes(store)
+        adjacent = sum(sys.getsizeof(node.adjacent) for node in nodes)
+        print('{:<36} {:>14.1f}'.format('  of which adjacent sets', adjacent / n))
+        del nodes
+        tree, size = traced_size(kd_tree.create, points)
+        print('{:<36} {:>14.1f}'.format('kd_tree.create (KDNodes)', size / n))
+        # KDNode.__init__ names its class in super(), so it can't be patched
+        # like Node; copy the tree node for node into each class instead
+        for label, node_class in [('  copied as KDNodes', kd_tree.KDNode),
+                                  ('  copied with __dict__', DictKDNode)]:
+            copy, size = traced_size(copy_kd_tree, tree, node_class)
+            print('{:<36} {:>14.1f}'.format(label, size / n))
+            del copy
+        del tree
+        tree, size = traced_size(kd_tree.create_bulk, xs=store.lons, ys=store.lats)
+        print('{:<36} {:>14.1f}'.format('kd_tree.create_bulk (arrays)', size / n))
+    finally:
+        tracemalloc.stop()
+
+
+def copy_kd_tree(node, node_class):
+    """ Copy of a kd-tree built from node_class nodes, sharing the points """
+    if node is None:
+        return None
+    return node_class(node.data, copy_kd_tree(node.left, node_class),
+                      copy_kd_tree(node.right, node_class), axis=node.axis,
+                      sel_axis=node.sel_axis, dimensions=node.dimensions)
+
+
+def traced_size(f, *args, **kwargs):
+    """ Returns (result, bytes allocated by f and still in use).
+        tracemalloc must be tracing.
+    """
+    before = tracemalloc.get_traced_memory()[0]
+    result = f(*args, **kwargs)
+    return result, tracemalloc.get_traced_memory()[0] - before
+
+
+def bench_update(args):
+    store = load_store(args)
+    rng = random.Random(args.seed)
+    graph, build = timed(graph_update.build, store)
+    print('{} placemarks, {} nodes, initial build {:.2f}s'.format(
+        len(store), graph.num_nodes, build))
+    print('{:>8} {:>10} {:>10} {:>10}  {}'.format('edits', 'update s', 'rebuild s', 'speedup', 'changes'))
+    for num_changes in args.changes:
+        # move some placemarks a little, and drop as many others
+        edited = rng.sample(range(len(store)), min(len(store), 2 * num_changes))
+        moved = set(edited[:num_changes])
+        dropped = set(edited[num_changes:])
+        new_store = placemark_store.PlacemarkStore()
+        for i in range(len(store)):
+            pm = placemark_store.StoredPlacemark(store, i)
+            if i in moved:
+                new_store.append([lat + 0.00001 for lat in pm.lats], pm.lons, pm.declared_name,
+                                 pm.road_name, pm.local_name)
+            elif i not in dropped:
+                new_store.append_placemark(pm)
+        report, update = timed(graph.update, new_store)
+        _, rebuild = timed(kml_convert.placemarks_to_csr_graph, new_store)
+        print('{:>8} {:>10.3f} {:>10.2f} {:>9.0f}x  {}'.format(
+            num_changes, update, rebuild, rebuild / update, report))
+        # back to the original roads for the next run
+        graph.update(store)
+
+
+def print_row(n, name, build, query, num_queries):
+    print('{:>10} {:<24} {:>10.3f} {:>14.2f}'.format(
+        n, name, build, 1e6 * query / num_queries))
+
+
+if __name__ == '__main__':
+    main()
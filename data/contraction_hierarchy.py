@@ -0,0 +1,358 @@
+""" Contraction hierarchies (CH) for fast shortest path queries
+
+Nodes are contracted one at a time, least important first. Contracting a
+node removes it, adding a shortcut between each pair of its neighbours
+whose shortest path went through it. Whether a pair needs a shortcut is
+decided by a witness search: a small Dijkstra search for another path
+that's no longer. Nodes are ordered by edge difference (shortcuts added
+minus edges removed), plus the number of neighbours already contracted,
+which spreads contraction evenly over the graph.
+
+A query is a bidirectional Dijkstra search that only follows edges up the
+hierarchy, to more important nodes. Both searches meet at the most
+important node of the shortest path, having settled only a few hundred
+nodes even on a large graph.
+
+The hierarchy is stored as the upward graph: node v's edges to more
+important nodes are targets[offsets[v]:offsets[v + 1]], with weights. A
+shortcut also records the node it skips (its middle), so paths can be
+expanded back to the original graph. File layout, all little-endian, each
+block 8 byte aligned:
+
+    header (32 bytes):
+        magic       8 bytes     b'VRCHIER\\0'
+        version     uint32
+        (zero padding)
+        num_nodes   uint64
+        num_entries uint64
+    ranks       int32[num_nodes]        contraction order of each node
+    offsets     int32[num_nodes + 1]
+    targets     int32[num_entries]
+    weights     float64[num_entries]
+    middles     int32[num_entries]      -1 for an original edge
+"""
+
+
+import heapq
+import os
+import struct
+import tempfile
+import unittest
+from array import array
+
+import csr_graph
+import graph_file
+import graph_search
+
+
+MAGIC = b'VRCHIER\0'
+VERSION = 1
+HEADER = struct.Struct('<8sI4xQQ')
+HEADER_SIZE = 32
+# nodes settled by each witness search before giving up. A lower limit
+# builds faster, but adds shortcuts that aren't needed
+DEFAULT_WITNESS_LIMIT = 60
+EDGE_DIFFERENCE_WEIGHT = 2
+
+
+class ContractionHierarchy(object):
+    """ The upward graph of a contracted road graph, see the module doc """
+    def __init__(self, ranks, offsets, targets, weights, middles):
+        if len(offsets) != len(ranks) + 1:
+            raise ValueError('offsets must have one more entry than there are nodes')
+        self.ranks = ranks
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.middles = middles
+
+    def __len__(self):
+        return len(self.ranks)
+
+    @property
+    def num_shortcuts(self):
+        return sum(1 for m in self.middles if m >= 0)
+
+    def query(self, source, target):
+        """ Shortest path from source to target. Returns a
+            graph_search.SearchResult, with the path in original nodes.
+        """
+        inf = float('inf')
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+        dists = ({source: 0.0}, {target: 0.0})
+        parents = ({source: source}, {target: target})
+        closed = (set(), set())
+        frontiers = ([(0.0, source)], [(0.0, target)])
+        best = inf
+        meeting = -1
+        settled = 0
+        side = 1
+        while frontiers[0] or frontiers[1]:
+            # alternate sides while both can still improve on best
+            if frontiers[1 - side]:
+                side = 1 - side
+            d, node = heapq.heappop(frontiers[side])
+            if d >= best:
+                # nothing left on this side can improve the path
+                del frontiers[side][:]
+                continue
+            if node in closed[side]:
+                continue
+            closed[side].add(node)
+            settled += 1
+            other = dists[1 - side].get(node)
+            if other is not None and d + other < best:
+                best = d + other
+                meeting = node
+            side_dists = dists[side]
+            for e in range(offsets[node], offsets[node + 1]):
+                neighbour = targets[e]
+                nd = d + weights[e]
+                if nd < side_dists.get(neighbour, inf):
+                    side_dists[neighbour] = nd
+                    parents[side][neighbour] = node
+                    heapq.heappush(frontiers[side], (nd, neighbour))
+        if meeting < 0:
+            return graph_search.SearchResult([], inf, settled)
+        up = _parent_path(parents[0], meeting)
+        down = _parent_path(parents[1], meeting)
+        down.reverse()
+        return graph_search.SearchResult(self.unpack(up + down[1:]), best, settled)
+
+    def unpack(self, path):
+        """ Replace the shortcuts in a path with the nodes they skip """
+        if not path:
+            return []
+        full = [path[0]]
+        # edges still to expand, the next one on top
+        stack = list(zip(path[1:], path))[::-1]
+        while stack:
+            b, a = stack.pop()
+            middle = self.middles[self.edge_index(a, b)]
+            if middle < 0:
+                full.append(b)
+            else:
+                stack.append((b, middle))
+                stack.append((middle, a))
+        return full
+
+    def edge_index(self, a, b):
+        """ Index of the upward edge between nodes a and b """
+        if self.ranks[a] > self.ranks[b]:
+            a, b = b, a
+        for e in range(self.offsets[a], self.offsets[a + 1]):
+            if self.targets[e] == b:
+                return e
+        raise ValueError('no edge between {} and {}'.format(a, b))
+
+
+def _parent_path(parents, node):
+    path = [node]
+    while parents[node] != node:
+        node = parents[node]
+        path.append(node)
+    path.reverse()
+    return path
+
+
+def build(graph, witness_limit=DEFAULT_WITNESS_LIMIT):
+    """ Contract a weighted graph (a csr_graph.CSRGraph, or a list of
+        placemark_graph Nodes). Returns a ContractionHierarchy.
+    """
+    graph = graph_search.prepare(graph)
+    n = len(graph)
+    # the remaining graph: node -> {neighbour: weight}
+    adj = [{} for _ in range(n)]
+    for i in range(n):
+        row = adj[i]
+        for j, w in graph.edges(i):
+            if j != i and w < row.get(j, float('inf')):
+                row[j] = w
+    # (a, b) with a < b -> middle node of the shortcut between them
+    middles = {}
+    contracted_neighbours = array('i', [0]) * n
+    # depth of the hierarchy below each node
+    levels = array('i', [0]) * n
+    ranks = array('i', [-1]) * n
+    upward = [None] * n
+
+    def priority(shortcuts, v):
+        edge_difference = len(shortcuts) - len(adj[v])
+        return EDGE_DIFFERENCE_WEIGHT * edge_difference + contracted_neighbours[v] + levels[v]
+
+    queue = [(priority(_shortcuts(adj, v, witness_limit), v), v) for v in range(n)]
+    heapq.heapify(queue)
+    rank = 0
+    while queue:
+        _, v = heapq.heappop(queue)
+        # lazy update: the priority may be out of date
+        shortcuts = _shortcuts(adj, v, witness_limit)
+        p = priority(shortcuts, v)
+        if queue and p > queue[0][0]:
+            heapq.heappush(queue, (p, v))
+            continue
+        neighbours = adj[v]
+        upward[v] = [(u, w, middles.get((min(u, v), max(u, v)), -1))
+                     for u, w in neighbours.items()]
+        for u, x, w in shortcuts:
+            if w < adj[u].get(x, float('inf')):
+                adj[u][x] = w
+                adj[x][u] = w
+                middles[(min(u, x), max(u, x))] = v
+        for u in neighbours:
+            del adj[u][v]
+            contracted_neighbours[u] += 1
+            if levels[u] <= levels[v]:
+                levels[u] = levels[v] + 1
+        adj[v] = {}
+        ranks[v] = rank
+        rank += 1
+
+    offsets = array('i', [0])
+    targets = array('i')
+    weights = array('d')
+    middle_ids = array('i')
+    for v in range(n):
+        for u, w, middle in sorted(upward[v]):
+            targets.append(u)
+            weights.append(w)
+            middle_ids.append(middle)
+        offsets.append(len(targets))
+    return ContractionHierarchy(ranks, offsets, targets, weights, middle_ids)
+
+
+def _shortcuts(adj, v, witness_limit):
+    """ The shortcuts needed if v were contracted now: [(u, x, weight)] """
+    neighbours = list(adj[v].items())
+    shortcuts = []
+    for i, (u, wu) in enumerate(neighbours[:-1]):
+        others = neighbours[i + 1:]
+        max_dist = wu + max(w for _, w in others)
+        dists = _witness_search(adj, u, v, [x for x, _ in others], max_dist, witness_limit)
+        for x, wx in others:
+            if dists.get(x, float('inf')) > wu + wx:
+                shortcuts.append((u, x, wu + wx))
+    return shortcuts
+
+
+def _witness_search(adj, source, avoid, targets, max_dist, limit):
+    """ Distances of paths from source that don't pass through avoid, found
+        by a Dijkstra search stopped once all targets are settled, at
+        max_dist, or after limit nodes.
+        Distances of nodes that weren't settled are upper bounds.
+    """
+    dists = {source: 0.0}
+    frontier = [(0.0, source)]
+    remaining = set(targets)
+    settled = 0
+    while frontier and settled < limit:
+        d, node = heapq.heappop(frontier)
+        if d > dists[node]:
+            continue
+        if d > max_dist:
+            break
+        if node in remaining:
+            remaining.discard(node)
+            if not remaining:
+                break
+        settled += 1
+        for neighbour, w in adj[node].items():
+            if neighbour == avoid:
+                continue
+            nd = d + w
+            if nd < dists.get(neighbour, float('inf')):
+                dists[neighbour] = nd
+                heapq.heappush(frontier, (nd, neighbour))
+    return dists
+
+
+def hierarchy_path(graph_path):
+    """ CH file path for a graph file, eg. roads.graph.bin -> roads.ch.bin """
+    if graph_path.endswith('.graph.bin'):
+        graph_path = graph_path[:-len('.graph.bin')]
+    return graph_path + '.ch.bin'
+
+
+def write_hierarchy(path, ch):
+    """ Write a ContractionHierarchy to a binary file """
+    header = HEADER.pack(MAGIC, VERSION, len(ch), len(ch.targets))
+    blocks = [array('i', ch.ranks), array('i', ch.offsets), array('i', ch.targets),
+              array('d', ch.weights), array('i', ch.middles)]
+    with open(path, 'wb') as ofile:
+        ofile.write(header.ljust(HEADER_SIZE, b'\0'))
+        graph_file.write_blocks(ofile, blocks)
+
+
+def load_hierarchy(path):
+    """ Memory-map a CH file. The arrays are read-only views of the file. """
+    view = graph_file.map_file(path)
+    magic, version, num_nodes, num_entries = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError('{} is not a contraction hierarchy file'.format(path))
+    if version != VERSION:
+        raise ValueError('unsupported contraction hierarchy file version: {}'.format(version))
+    graph_file.check_mappable('contraction hierarchy files')
+
+    block = graph_file.BlockReader(view, HEADER_SIZE).block
+    ranks = block('i', num_nodes)
+    offsets = block('i', num_nodes + 1)
+    targets = block('i', num_entries)
+    weights = block('d', num_entries)
+    middles = block('i', num_entries)
+    return ContractionHierarchy(ranks, offsets, targets, weights, middles)
+
+
+class ContractionHierarchyTests(unittest.TestCase):
+    def setUp(self):
+        # 8 x 8 grid with some edges missing, and an unconnected pair
+        size = 8
+        missing = [(i, i + 1) for i in range(size * size) if (i // size * 7 + i % size) % 5 == 0]
+        missing.extend((i, i + size) for i in range(size * size)
+                       if (i // size + i % size * 3) % 7 == 0)
+        self.graph = csr_graph.make_test_grid(size, missing=missing)
+
+    def check_matches_dijkstra(self, ch, sources):
+        for source in sources:
+            dists, _ = graph_search.dijkstra_all(self.graph, source)
+            for target in range(len(self.graph)):
+                result = ch.query(source, target)
+                self.assertAlmostEqual(result.distance, dists[target], delta=1e-6)
+                if result.path:
+                    self.assertEqual(result.path[0], source)
+                    self.assertEqual(result.path[-1], target)
+                    length = sum(dict(self.graph.edges(a))[b]
+                                 for a, b in zip(result.path, result.path[1:]))
+                    self.assertAlmostEqual(length, dists[target], delta=1e-6)
+
+    def test_queries_match_dijkstra(self):
+        ch = build(self.graph)
+        self.assertEqual(sorted(ch.ranks), list(range(len(self.graph))))
+        self.check_matches_dijkstra(ch, [0, 9, 27, 63, 64])
+
+    def test_small_witness_limit(self):
+        # more shortcuts, same answers
+        ch = build(self.graph, witness_limit=1)
+        self.check_matches_dijkstra(ch, [0, 35])
+
+    def test_upward_edges(self):
+        ch = build(self.graph)
+        for v in range(len(ch)):
+            for e in range(ch.offsets[v], ch.offsets[v + 1]):
+                self.assertGreater(ch.ranks[ch.targets[e]], ch.ranks[v])
+
+    def test_write_load(self):
+        ch = build(self.graph)
+        fd, path = tempfile.mkstemp(suffix='.ch.bin')
+        os.close(fd)
+        try:
+            write_hierarchy(path, ch)
+            loaded = load_hierarchy(path)
+            self.assertEqual(list(loaded.middles), list(ch.middles))
+            self.assertEqual(loaded.query(0, 63), ch.query(0, 63))
+        finally:
+            os.remove(path)
+        self.assertEqual(hierarchy_path('roads.graph.bin'), 'roads.ch.bin')
+
+
+if __name__ == '__main__':
+    unittest.main()
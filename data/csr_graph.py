@@ -0,0 +1,214 @@
+""" Compressed sparse row (CSR) storage for the road graph """
+
+
+import unittest
+from array import array
+
+from geo import haversine
+
+
+class CSRGraph(object):
+    """ An immutable undirected graph in flat arrays. The neighbours of node i
+        are targets[offsets[i]:offsets[i + 1]], sorted, and every edge is
+        stored once in each direction. weights, if present, holds the
+        float32 great-circle length in metres of each entry in targets.
+        Nodes can optionally be named: node i is called names[name_ids[i]].
+        geometry, if present, is an EdgeGeometry holding the road shape
+        points that each edge entry stands for, eg. after
+        graph_simplify.contract_degree_2.
+    """
+    def __init__(self, lats, lons, offsets, targets, weights=None, name_ids=None, names=None,
+                 geometry=None):
+        if len(offsets) != len(lats) + 1:
+            raise ValueError('offsets must have one more entry than there are nodes')
+        self.lats = lats
+        self.lons = lons
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.name_ids = name_ids
+        self.names = names
+        self.geometry = geometry
+
+    def __len__(self):
+        return len(self.lats)
+
+    @property
+    def num_edges(self):
+        """ Number of undirected edges """
+        return len(self.targets) // 2
+
+    def node_name(self, i):
+        if self.name_ids is None:
+            return None
+        return self.names[self.name_ids[i]]
+
+    def degree(self, i):
+        return self.offsets[i + 1] - self.offsets[i]
+
+    def neighbours(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def edges(self, i):
+        """ Iterator of (neighbour index, edge weight) """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if self.weights is not None:
+            return zip(self.targets[start:end], self.weights[start:end])
+        lat, lon, lats, lons = self.lats[i], self.lons[i], self.lats, self.lons
+        return ((j, haversine(lat, lon, lats[j], lons[j]))
+                for j in self.targets[start:end])
+
+    def undirected_edges(self):
+        """ Yield each edge once, as an (i, j) tuple with i < j """
+        offsets, targets = self.offsets, self.targets
+        for i in range(len(self)):
+            for e in range(offsets[i], offsets[i + 1]):
+                if targets[e] > i:
+                    yield i, targets[e]
+
+
+class EdgeGeometry(object):
+    """ Shape points strictly between the ends of each edge entry, in the
+        direction of that entry: the points of entry e are
+        (lats[p], lons[p]) for p in range(offsets[e], offsets[e + 1])
+    """
+    def __init__(self, offsets, lats, lons):
+        if len(lats) != len(lons):
+            raise ValueError('lats and lons must be the same length')
+        self.offsets = offsets
+        self.lats = lats
+        self.lons = lons
+
+    def __len__(self):
+        """ Number of edge entries """
+        return len(self.offsets) - 1
+
+    @property
+    def num_points(self):
+        return len(self.lats)
+
+    def points(self, e):
+        """ List of (lat, lon) shape points of edge entry e """
+        start, end = self.offsets[e], self.offsets[e + 1]
+        return list(zip(self.lats[start:end], self.lons[start:end]))
+
+
+def from_edges(lats, lons, firsts, seconds, weighted=True, name_ids=None, names=None):
+    """ Build a CSRGraph from node coordinates and edges (firsts[e], seconds[e]).
+        Edges may be given in either or both directions. Duplicate edges and
+        self loops are dropped. name_ids and names are passed to the CSRGraph.
+    """
+    n = len(lats)
+    degree = array('i', [0]) * n
+    for a, b in zip(firsts, seconds):
+        if a != b:
+            degree[a] += 1
+            degree[b] += 1
+    cursor = array('i', [0]) * (n + 1)
+    for i in range(n):
+        cursor[i + 1] = cursor[i] + degree[i]
+    targets = array('i', [0]) * cursor[n]
+    for a, b in zip(firsts, seconds):
+        if a != b:
+            targets[cursor[a]] = b
+            cursor[a] += 1
+            targets[cursor[b]] = a
+            cursor[b] += 1
+
+    # cursor[i] is now the end of row i. Sort and dedupe rows in place
+    offsets = array('i', [0]) * (n + 1)
+    out = 0
+    start = 0
+    for i in range(n):
+        end = cursor[i]
+        row = sorted(set(targets[start:end]))
+        targets[out:out + len(row)] = array('i', row)
+        out += len(row)
+        offsets[i + 1] = out
+        start = end
+    del targets[out:]
+
+    lats = array('d', lats)
+    lons = array('d', lons)
+    weights = None
+    if weighted:
+        weights = array('f', [0]) * len(targets)
+        for i in range(n):
+            lat, lon = lats[i], lons[i]
+            for e in range(offsets[i], offsets[i + 1]):
+                j = targets[e]
+                weights[e] = haversine(lat, lon, lats[j], lons[j])
+    return CSRGraph(lats, lons, offsets, targets, weights, name_ids, names)
+
+
+def from_nodes(nodes, weighted=True):
+    """ Build a CSRGraph from placemark_graph Nodes. Node idxs must be the
+        same as their list positions, as made by placemarks_to_graph.
+    """
+    firsts = array('i')
+    seconds = array('i')
+    for i, node in enumerate(nodes):
+        if node.idx != i:
+            raise ValueError('node idx {} is at position {}'.format(node.idx, i))
+        for j in node.adjacent:
+            if j > i:
+                firsts.append(i)
+                seconds.append(j)
+    return from_edges([n.y for n in nodes], [n.x for n in nodes],
+                      firsts, seconds, weighted)
+
+
+def make_test_grid(size, spacing=0.001, missing=(), pair=True, weighted=True):
+    """ A test graph: a size x size grid, with node row * size + col at
+        (row * spacing, col * spacing) joined to its right and upper
+        neighbours, except for the (i, j) node pairs in missing. If pair,
+        two more nodes joined only to each other come after the grid.
+    """
+    missing = set(missing)
+    lats, lons, firsts, seconds = [], [], [], []
+    for row in range(size):
+        for col in range(size):
+            i = row * size + col
+            lats.append(row * spacing)
+            lons.append(col * spacing)
+            for j, exists in [(i + 1, col + 1 < size), (i + size, row + 1 < size)]:
+                if exists and (i, j) not in missing:
+                    firsts.append(i)
+                    seconds.append(j)
+    if pair:
+        n = size * size
+        lats.extend([1, 1])
+        lons.extend([1, 1 + spacing])
+        firsts.append(n)
+        seconds.append(n + 1)
+    return from_edges(lats, lons, firsts, seconds, weighted)
+
+
+class CSRGraphTests(unittest.TestCase):
+    def test_from_edges(self):
+        graph = from_edges([0, 0, 0], [0, 1, 2], [0, 1, 1, 2, 2], [1, 0, 2, 2, 1])
+        self.assertEqual(len(graph), 3)
+        self.assertEqual(graph.num_edges, 2)
+        self.assertEqual(list(graph.offsets), [0, 1, 3, 4])
+        self.assertEqual(list(graph.neighbours(1)), [0, 2])
+        self.assertEqual(list(graph.undirected_edges()), [(0, 1), (1, 2)])
+
+    def test_weights(self):
+        graph = from_edges([0, 0], [0, 1], [0], [1])
+        (j, weight), = graph.edges(0)
+        self.assertEqual(j, 1)
+        self.assertAlmostEqual(weight, haversine(0, 0, 0, 1), delta=0.01)
+        unweighted = from_edges([0, 0], [0, 1], [0], [1], weighted=False)
+        self.assertIsNone(unweighted.weights)
+        self.assertAlmostEqual(list(unweighted.edges(0))[0][1], weight, delta=0.01)
+
+    def test_make_test_grid(self):
+        graph = make_test_grid(3, missing=[(4, 5)])
+        self.assertEqual(len(graph), 11)
+        self.assertEqual(graph.num_edges, 12)
+        self.assertEqual(list(graph.neighbours(4)), [1, 3, 7])
+        self.assertEqual(list(graph.neighbours(9)), [10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+""" Many-to-many road distances
+
+Each row of the matrix is one Dijkstra search from a source, stopped once
+every target is settled. That does the work shared between targets once,
+rather than once per source and target pair. Rows can be computed by a
+pool of processes. The workers share the graph's arrays rather than each
+being sent a copy: either they're inherited from the parent when the pool
+is forked, or each worker memory-maps the same graph file.
+"""
+
+
+import heapq
+import multiprocessing
+import os
+import tempfile
+import unittest
+from array import array
+
+import csr_graph
+import graph_file
+import graph_search
+
+
+class DistanceMatrix(object):
+    """ Dense row-major matrix of distances in metres, in a flat float64
+        array. The distance from sources[i] to targets[j] is
+        data[i * num_targets + j], infinite if unreachable.
+        For numpy: numpy.frombuffer(matrix.data).reshape(matrix.shape)
+    """
+    def __init__(self, data, num_sources, num_targets):
+        if len(data) != num_sources * num_targets:
+            raise ValueError('data must have num_sources * num_targets entries')
+        self.data = data
+        self.shape = (num_sources, num_targets)
+
+    def __getitem__(self, index):
+        i, j = index
+        return self.data[i * self.shape[1] + j]
+
+    def row(self, i):
+        num_targets = self.shape[1]
+        return self.data[i * num_targets:(i + 1) * num_targets]
+
+    def tolist(self):
+        return [list(self.row(i)) for i in range(self.shape[0])]
+
+
+def one_to_many(graph, source, targets):
+    """ Distances from source to each of targets, as an array('d') """
+    graph = graph_search.prepare(graph)
+    inf = float('inf')
+    dists = {source: 0.0}
+    remaining = set(targets)
+    closed = set()
+    frontier = [(0.0, source)]
+    while frontier and remaining:
+        d, node = heapq.heappop(frontier)
+        if node in closed:
+            continue
+        closed.add(node)
+        remaining.discard(node)
+        for neighbour, weight in graph.edges(node):
+            nd = d + weight
+            if nd < dists.get(neighbour, inf):
+                dists[neighbour] = nd
+                heapq.heappush(frontier, (nd, neighbour))
+    return array('d', (dists[t] if t in closed else inf for t in targets))
+
+
+def distance_matrix(graph, sources, targets, jobs=1, graph_path=None):
+    """ Distances from every source to every target, as a DistanceMatrix.
+        With jobs > 1, batches of sources are searched by a process pool.
+        If graph_path is given, workers memory-map that graph file (which
+        must hold the same graph). Otherwise the pool is forked, so workers
+        share the parent's graph arrays.
+    """
+    graph = graph_search.prepare(graph)
+    sources = list(sources)
+    targets = list(targets)
+    data = array('d')
+    if jobs <= 1 or len(sources) <= 1:
+        for source in sources:
+            data.extend(one_to_many(graph, source, targets))
+        return DistanceMatrix(data, len(sources), len(targets))
+
+    global _worker_graph, _worker_targets
+    batch_size = max(1, -(-len(sources) // (jobs * 4)))
+    batches = [sources[i:i + batch_size] for i in range(0, len(sources), batch_size)]
+    if graph_path is not None:
+        pool = multiprocessing.Pool(jobs, _init_mapped_worker, (graph_path, targets))
+    elif 'fork' in multiprocessing.get_all_start_methods():
+        # set before forking, so the workers inherit them
+        _worker_graph, _worker_targets = graph, targets
+        pool = multiprocessing.get_context('fork').Pool(jobs)
+    else:
+        raise ValueError('graph_path is needed where processes can not be forked')
+    try:
+        with pool:
+            for rows in pool.imap(_search_batch, batches):
+                data.frombytes(rows)
+    finally:
+        _worker_graph = _worker_targets = None
+    return DistanceMatrix(data, len(sources), len(targets))
+
+
+# the graph and targets of a pool worker
+_worker_graph = None
+_worker_targets = None
+
+
+def _init_mapped_worker(graph_path, targets):
+    global _worker_graph, _worker_targets
+    _worker_graph = graph_file.load_graph(graph_path)
+    _worker_targets = targets
+
+
+def _search_batch(sources):
+    """ Rows for a batch of sources, as bytes of float64s """
+    rows = array('d')
+    for source in sources:
+        rows.extend(one_to_many(_worker_graph, source, _worker_targets))
+    return rows.tobytes()
+
+
+class DistanceMatrixTests(unittest.TestCase):
+    def setUp(self):
+        # a 5 x 5 grid with one edge missing, plus an unconnected pair
+        self.graph = csr_graph.make_test_grid(5, missing=[(12, 13)])
+        self.sources = [0, 7, 12, 25, 24]
+        self.targets = [3, 24, 25, 0, 12, 12]
+
+    def expected(self):
+        rows = []
+        for source in self.sources:
+            dists, _ = graph_search.dijkstra_all(self.graph, source)
+            rows.append([dists[t] for t in self.targets])
+        return rows
+
+    def test_matches_dijkstra(self):
+        matrix = distance_matrix(self.graph, self.sources, self.targets)
+        self.assertEqual(matrix.shape, (5, 6))
+        self.assertEqual(matrix.tolist(), self.expected())
+        self.assertEqual(matrix[0, 3], 0)
+        self.assertEqual(matrix[3, 0], float('inf'))
+
+    def test_forked_pool(self):
+        matrix = distance_matrix(self.graph, self.sources, self.targets, jobs=2)
+        self.assertEqual(matrix.tolist(), self.expected())
+
+    def test_mapped_pool(self):
+        fd, path = tempfile.mkstemp(suffix='.graph.bin')
+        os.close(fd)
+        try:
+            graph_file.write_graph(path, self.graph)
+            matrix = distance_matrix(self.graph, self.sources, self.targets,
+                                     jobs=2, graph_path=path)
+        finally:
+            os.remove(path)
+        self.assertEqual(matrix.tolist(), self.expected())
+
+    def test_empty(self):
+        self.assertEqual(distance_matrix(self.graph, [], [1, 2]).shape, (0, 2))
+        self.assertEqual(distance_matrix(self.graph, [1, 2], []).tolist(), [[], []])
+
+
+if __name__ == '__main__':
+    unittest.main()
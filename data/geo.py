@@ -0,0 +1,17 @@
+""" Geographic distance helpers """
+
+
+import math
+
+
+EARTH_RADIUS_METRES = 6371008.8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Great-circle distance in metres between two (lat, lon) points """
+    lat1 = math.radians(lat1)
+    lat2 = math.radians(lat2)
+    dlat = lat2 - lat1
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_METRES * math.asin(min(1.0, math.sqrt(a)))
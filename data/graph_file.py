@@ -0,0 +1,238 @@
+""" Versioned binary file format for the road graph
+
+Layout, all little-endian. Every block starts on an 8 byte boundary, so it
+can be viewed in place as a typed array (numpy, memoryview, js TypedArray).
+
+    header (64 bytes):
+        magic       8 bytes     b'VRGRAPH\\0'
+        version     uint32
+        flags       uint32      1: has weights, 2: has names, 4: has geometry
+        num_nodes   uint64
+        num_entries uint64      length of targets (2 * number of edges)
+        names_size  uint64      size in bytes of the names block
+        num_points  uint64      number of edge geometry points
+        (zero padding)
+    lats        float64[num_nodes]
+    lons        float64[num_nodes]
+    offsets     int32[num_nodes + 1]
+    targets     int32[num_entries]
+    weights     float32[num_entries]    if flags & 1
+    name_ids    int32[num_nodes]        if flags & 2
+    names       utf-8 json list         if flags & 2
+    (zero padding to 8 bytes)
+    path_offsets    int32[num_entries + 1]  if flags & 4, see
+    path_lats       float64[num_points]     csr_graph.EdgeGeometry
+    path_lons       float64[num_points]
+
+The geometry blocks come last, so files without them are laid out as
+before.
+"""
+
+
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from array import array
+
+import csr_graph
+
+
+MAGIC = b'VRGRAPH\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQ')
+HEADER_SIZE = 64
+HAS_WEIGHTS = 1
+HAS_NAMES = 2
+HAS_GEOMETRY = 4
+
+
+def write_graph(path, graph):
+    """ Write a csr_graph.CSRGraph to a binary graph file """
+    flags = 0
+    blocks = [_typed(graph.lats, 'd'), _typed(graph.lons, 'd'),
+              _typed(graph.offsets, 'i'), _typed(graph.targets, 'i')]
+    if graph.weights is not None:
+        flags |= HAS_WEIGHTS
+        blocks.append(_typed(graph.weights, 'f'))
+    names = b''
+    if graph.name_ids is not None:
+        flags |= HAS_NAMES
+        blocks.append(_typed(graph.name_ids, 'i'))
+        names = json.dumps(graph.names).encode('utf-8')
+    path_blocks = []
+    num_points = 0
+    if graph.geometry is not None:
+        flags |= HAS_GEOMETRY
+        geometry = graph.geometry
+        num_points = geometry.num_points
+        path_blocks = [_typed(geometry.offsets, 'i'), _typed(geometry.lats, 'd'),
+                       _typed(geometry.lons, 'd')]
+    header = HEADER.pack(MAGIC, VERSION, flags, len(graph), len(graph.targets), len(names),
+                         num_points)
+    if names:
+        blocks.append(names)
+    with open(path, 'wb') as ofile:
+        ofile.write(header.ljust(HEADER_SIZE, b'\0'))
+        write_blocks(ofile, blocks + path_blocks)
+
+
+def write_blocks(ofile, blocks):
+    """ Write arrays little-endian, and bytes as they are, each padded to a
+        multiple of 8 bytes so that BlockReader can view them in place
+    """
+    for block in blocks:
+        if isinstance(block, array):
+            if sys.byteorder == 'big':
+                block = array(block.typecode, block)
+                block.byteswap()
+            block = block.tobytes()
+        ofile.write(block)
+        ofile.write(b'\0' * padding(len(block)))
+
+
+class BlockReader(object):
+    """ Reads the blocks written by write_blocks from a buffer, such as a
+        memory-mapped file, starting at position
+    """
+    def __init__(self, buffer, position=0):
+        self.view = memoryview(buffer)
+        self.position = position
+
+    def _next(self, size):
+        start = self.position
+        if start + size > len(self.view):
+            raise ValueError('truncated file')
+        self.position = start + size + padding(size)
+        return self.view[start:start + size]
+
+    def block(self, typecode, count):
+        """ The next block as a read-only view cast to typecode, nothing is
+            copied. Only right on little-endian machines.
+        """
+        return self._next(count * struct.calcsize(typecode)).cast(typecode)
+
+    def array(self, typecode, count):
+        """ A copy of the next block as an array """
+        values = array(typecode)
+        values.frombytes(self._next(count * values.itemsize))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def bytes(self, size):
+        """ A copy of the next block as bytes """
+        return bytes(self._next(size))
+
+
+def map_file(path):
+    """ Memory-map a file read-only, as a memoryview """
+    with open(path, 'rb') as ifile:
+        return memoryview(mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def check_mappable(description):
+    """ Raise a ValueError on machines where the little-endian blocks of a
+        file can't be viewed in place
+    """
+    if sys.byteorder == 'big':
+        raise ValueError('{} can only be memory-mapped on little-endian machines'.format(
+            description))
+
+
+def load_graph(path):
+    """ Memory-map a binary graph file. Returns a csr_graph.CSRGraph whose
+        arrays are read-only views of the file, nothing is copied.
+    """
+    view = map_file(path)
+    magic, version, flags, num_nodes, num_entries, names_size, num_points = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError('{} is not a graph file'.format(path))
+    if version != VERSION:
+        raise ValueError('unsupported graph file version: {}'.format(version))
+    check_mappable('graph files')
+
+    reader = BlockReader(view, HEADER_SIZE)
+    block = reader.block
+    lats = block('d', num_nodes)
+    lons = block('d', num_nodes)
+    offsets = block('i', num_nodes + 1)
+    targets = block('i', num_entries)
+    weights = block('f', num_entries) if flags & HAS_WEIGHTS else None
+    name_ids = names = None
+    if flags & HAS_NAMES:
+        name_ids = block('i', num_nodes)
+        names = json.loads(reader.bytes(names_size).decode('utf-8'))
+    geometry = None
+    if flags & HAS_GEOMETRY:
+        path_offsets = block('i', num_entries + 1)
+        geometry = csr_graph.EdgeGeometry(path_offsets, block('d', num_points),
+                                          block('d', num_points))
+    return csr_graph.CSRGraph(lats, lons, offsets, targets, weights, name_ids, names, geometry)
+
+
+def _typed(values, typecode):
+    """ Copy values to an array of the given type """
+    return array(typecode, values)
+
+
+def padding(size):
+    """ Number of zero bytes after a block of size bytes """
+    return -size % 8
+
+
+class GraphFileTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.graph.bin')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        graph = csr_graph.from_edges([0, 0, 1], [0, 1, 1], [0, 1], [1, 2],
+                                     name_ids=array('i', [1, 1, 2]),
+                                     names=[None, 'road a', 'road b'])
+        write_graph(self.path, graph)
+        loaded = load_graph(self.path)
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(list(loaded.lons), [0, 1, 1])
+        self.assertEqual(list(loaded.offsets), list(graph.offsets))
+        self.assertEqual(list(loaded.neighbours(1)), [0, 2])
+        self.assertEqual(list(loaded.weights), list(graph.weights))
+        self.assertEqual(loaded.node_name(2), 'road b')
+
+    def test_without_weights_or_names(self):
+        graph = csr_graph.from_edges([0, 0], [0, 1], [0], [1], weighted=False)
+        write_graph(self.path, graph)
+        loaded = load_graph(self.path)
+        self.assertIsNone(loaded.weights)
+        self.assertIsNone(loaded.name_ids)
+        self.assertIsNone(loaded.geometry)
+        self.assertEqual(list(loaded.undirected_edges()), [(0, 1)])
+
+    def test_geometry(self):
+        graph = csr_graph.from_edges([0, 0, 1], [0, 1, 1], [0, 1], [1, 2])
+        graph = csr_graph.CSRGraph(graph.lats, graph.lons, graph.offsets, graph.targets,
+                                   graph.weights, array('i', [0, 0, 0]), ['a road'],
+                                   csr_graph.EdgeGeometry(array('i', [0, 2, 4, 4, 5]),
+                                                          [0, .5, .5, 0, .5], [.2, .4, .4, .2, 1]))
+        write_graph(self.path, graph)
+        loaded = load_graph(self.path)
+        self.assertEqual(loaded.names, ['a road'])
+        self.assertEqual(len(loaded.geometry), 4)
+        self.assertEqual(loaded.geometry.points(1), [(.5, .4), (0, .2)])
+        self.assertEqual(loaded.geometry.points(2), [])
+        self.assertEqual(list(loaded.geometry.lons), [.2, .4, .4, .2, 1])
+
+    def test_not_a_graph_file(self):
+        with open(self.path, 'wb') as ofile:
+            ofile.write(b'\0' * HEADER_SIZE)
+        self.assertRaises(ValueError, load_graph, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+""" Route searches over the road graph made by placemark_graph
+
+All searches take a csr_graph.CSRGraph or a list of placemark_graph Nodes,
+and node indexes. Edge weights are great-circle distances in metres. The
+road graph is undirected: every edge is stored in both directions.
+"""
+
+
+import heapq
+import unittest
+from array import array
+from collections import deque, namedtuple
+
+import csr_graph
+from geo import haversine
+
+# path: list of node indexes from source to target, empty if unreachable
+# distance: path length. Metres, except for bfs where it's the number of edges
+# settled: number of nodes taken off the frontier
+SearchResult = namedtuple('SearchResult', ['path', 'distance', 'settled'])
+
+
+def prepare(graph):
+    """ Convert a list of placemark_graph Nodes to a CSRGraph, so that a batch
+        of searches only converts it once. Anything else is assumed to be a
+        graph already.
+    """
+    if isinstance(graph, list):
+        return csr_graph.from_nodes(graph)
+    return graph
+
+
+def bfs(graph, source, target):
+    """ Breadth first search for the path with the fewest edges """
+    graph = prepare(graph)
+    parents = array('l', [-1]) * len(graph)
+    parents[source] = source
+    frontier = deque([source])
+    settled = 0
+    while frontier:
+        node = frontier.popleft()
+        settled += 1
+        if node == target:
+            path = _path(parents, source, target)
+            return SearchResult(path, len(path) - 1, settled)
+        for neighbour in graph.neighbours(node):
+            if parents[neighbour] < 0:
+                parents[neighbour] = node
+                frontier.append(neighbour)
+    return SearchResult([], float('inf'), settled)
+
+
+def dijkstra(graph, source, target):
+    """ Shortest path from source to target """
+    return astar(graph, source, target, heuristic=lambda node: 0.0)
+
+
+def dijkstra_all(graph, source):
+    """ Shortest path distances from source to every node.
+        Returns (distances, parents) arrays. Unreachable nodes have an
+        infinite distance and a parent of -1.
+    """
+    graph = prepare(graph)
+    dists = array('d', [float('inf')]) * len(graph)
+    parents = array('l', [-1]) * len(graph)
+    settled = bytearray(len(graph))
+    dists[source] = 0.0
+    parents[source] = source
+    frontier = [(0.0, source)]
+    while frontier:
+        d, node = heapq.heappop(frontier)
+        if settled[node]:
+            continue
+        settled[node] = 1
+        for neighbour, weight in graph.edges(node):
+            nd = d + weight
+            if nd < dists[neighbour]:
+                dists[neighbour] = nd
+                parents[neighbour] = node
+                heapq.heappush(frontier, (nd, neighbour))
+    return dists, parents
+
+
+def astar(graph, source, target, heuristic=None):
+    """ A* search. heuristic(node) must not overestimate the distance from
+        node to target. Defaults to the great-circle distance to target.
+    """
+    graph = prepare(graph)
+    lats, lons = graph.lats, graph.lons
+    if heuristic is None:
+        tlat, tlon = lats[target], lons[target]
+        # scaled down slightly, so it stays below float32 rounded edge weights
+        heuristic = lambda node: haversine(lats[node], lons[node], tlat, tlon) * 0.999999
+    dists = array('d', [float('inf')]) * len(graph)
+    parents = array('l', [-1]) * len(graph)
+    closed = bytearray(len(graph))
+    dists[source] = 0.0
+    parents[source] = source
+    frontier = [(heuristic(source), source)]
+    settled = 0
+    while frontier:
+        _, node = heapq.heappop(frontier)
+        if closed[node]:
+            continue
+        closed[node] = 1
+        settled += 1
+        if node == target:
+            return SearchResult(_path(parents, source, target), dists[target], settled)
+        d = dists[node]
+        for neighbour, weight in graph.edges(node):
+            nd = d + weight
+            if nd < dists[neighbour]:
+                dists[neighbour] = nd
+                parents[neighbour] = node
+                heapq.heappush(frontier, (nd + heuristic(neighbour), neighbour))
+    return SearchResult([], float('inf'), settled)
+
+
+def bidirectional_dijkstra(graph, source, target):
+    """ Dijkstra searches from both source and target, stopping once the
+        frontiers can no longer improve on the best path that joins them
+    """
+    graph = prepare(graph)
+    inf = float('inf')
+    n = len(graph)
+    dists = (array('d', [inf]) * n, array('d', [inf]) * n)
+    parents = (array('l', [-1]) * n, array('l', [-1]) * n)
+    closed = (bytearray(n), bytearray(n))
+    frontiers = ([(0.0, source)], [(0.0, target)])
+    for side, start in ((0, source), (1, target)):
+        dists[side][start] = 0.0
+        parents[side][start] = start
+    best = inf
+    meeting = -1
+    settled = 0
+    while frontiers[0] and frontiers[1]:
+        if frontiers[0][0][0] + frontiers[1][0][0] >= best:
+            break
+        # expand the side with the smaller frontier
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        d, node = heapq.heappop(frontiers[side])
+        if closed[side][node]:
+            continue
+        closed[side][node] = 1
+        settled += 1
+        side_dists = dists[side]
+        other_dists = dists[1 - side]
+        for neighbour, weight in graph.edges(node):
+            nd = d + weight
+            if nd < side_dists[neighbour]:
+                side_dists[neighbour] = nd
+                parents[side][neighbour] = node
+                heapq.heappush(frontiers[side], (nd, neighbour))
+            if nd + other_dists[neighbour] < best:
+                best = nd + other_dists[neighbour]
+                meeting = neighbour
+        if d + other_dists[node] < best:
+            best = d + other_dists[node]
+            meeting = node
+    if meeting < 0:
+        return SearchResult([], inf, settled)
+    path = _path(parents[0], source, meeting)
+    path.extend(reversed(_path(parents[1], target, meeting)[:-1]))
+    return SearchResult(path, best, settled)
+
+
+def _path(parents, source, target):
+    """ Follow parents back from target to source """
+    path = [target]
+    node = target
+    while node != source:
+        node = parents[node]
+        path.append(node)
+    path.reverse()
+    return path
+
+
+class GraphSearchTests(unittest.TestCase):
+    def setUp(self):
+        # a square with a long way round: 0-1-2 direct, 0-3-4-2 around
+        self.lats = [0, 0, 0, 1, 1, 5]
+        self.lons = [0, 1, 2, 0, 2, 5]
+        edges = [(0, 1), (1, 2), (0, 3), (3, 4), (4, 2)]
+        self.graph = csr_graph.from_edges(self.lats, self.lons,
+                                          [a for a, b in edges], [b for a, b in edges])
+        self.direct = haversine(0, 0, 0, 1) + haversine(0, 1, 0, 2)
+
+    def test_haversine(self):
+        # one degree of longitude at the equator
+        self.assertAlmostEqual(haversine(0, 0, 0, 1), 111195, delta=1)
+
+    def test_bfs(self):
+        result = bfs(self.graph, 0, 2)
+        self.assertEqual(result.path, [0, 1, 2])
+        self.assertEqual(result.distance, 2)
+
+    def test_weighted_searches(self):
+        for search in [dijkstra, astar, bidirectional_dijkstra]:
+            result = search(self.graph, 0, 2)
+            self.assertEqual(result.path, [0, 1, 2])
+            self.assertAlmostEqual(result.distance, self.direct, delta=0.1)
+            result = search(self.graph, 3, 1)
+            self.assertEqual(result.path, [3, 0, 1])
+
+    def test_unreachable(self):
+        for search in [bfs, dijkstra, astar, bidirectional_dijkstra]:
+            result = search(self.graph, 0, 5)
+            self.assertEqual(result.path, [])
+            self.assertEqual(result.distance, float('inf'))
+
+    def test_dijkstra_all(self):
+        dists, parents = dijkstra_all(self.graph, 0)
+        self.assertAlmostEqual(dists[2], self.direct, delta=0.1)
+        self.assertEqual(parents[2], 1)
+        self.assertEqual(parents[5], -1)
+
+    def test_same_source_and_target(self):
+        for search in [bfs, dijkstra, astar, bidirectional_dijkstra]:
+            result = search(self.graph, 4, 4)
+            self.assertEqual(result.path, [4])
+            self.assertEqual(result.distance, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+""" Shrink the road graph by merging chains of degree 2 nodes
+
+Most road graph nodes are shape points in the middle of a road, with exactly
+two neighbours. They can't be a junction, so each chain of them is replaced
+by a single weighted edge between the nodes at its ends. The original nodes
+of each edge are kept, so paths found on the contracted graph can be
+expanded back to road geometry.
+"""
+
+
+import unittest
+from array import array
+
+import csr_graph
+
+
+class ContractedGraph(object):
+    """ graph: the contracted csr_graph.CSRGraph, with weights, and the
+            coordinates of each edge's merged nodes as its geometry
+        node_ids: original node index of each contracted node
+        path_offsets, path_nodes: the original nodes strictly between the
+            ends of contracted edge entry e (in the direction of that entry)
+            are path_nodes[path_offsets[e]:path_offsets[e + 1]]
+    """
+    def __init__(self, graph, node_ids, path_offsets, path_nodes):
+        self.graph = graph
+        self.node_ids = node_ids
+        self.path_offsets = path_offsets
+        self.path_nodes = path_nodes
+        self._contracted_ids = None
+
+    def contracted_index(self, original_idx):
+        """ Index of an original node in the contracted graph, or -1 if it
+            was merged into an edge
+        """
+        if self._contracted_ids is None:
+            self._contracted_ids = {orig: i for i, orig in enumerate(self.node_ids)}
+        return self._contracted_ids.get(original_idx, -1)
+
+    def expand_path(self, path):
+        """ Convert a path of contracted node indexes to the full path of
+            original node indexes
+        """
+        if not path:
+            return []
+        graph = self.graph
+        full = [self.node_ids[path[0]]]
+        for a, b in zip(path, path[1:]):
+            start, end = graph.offsets[a], graph.offsets[a + 1]
+            for e in range(start, end):
+                if graph.targets[e] == b:
+                    break
+            else:
+                raise ValueError('no edge between {} and {}'.format(a, b))
+            full.extend(self.path_nodes[self.path_offsets[e]:self.path_offsets[e + 1]])
+            full.append(self.node_ids[b])
+        return full
+
+
+def contract_degree_2(graph):
+    """ Contract all chains of degree 2 nodes in a weighted CSRGraph.
+        Every original node is kept as a node or in some edge's path. Where
+        a chain would loop back to its start node, or join the same two
+        nodes as another chain, one of its nodes is kept to split it, so the
+        contracted graph has no self loops or parallel edges.
+        Returns a ContractedGraph.
+    """
+    n = len(graph)
+    offsets, targets = graph.offsets, graph.targets
+    keep = bytearray(n)
+    for i in range(n):
+        if offsets[i + 1] - offsets[i] != 2:
+            keep[i] = 1
+
+    while True:
+        # (a, b) -> (weight, interior nodes from a to b), for a < b
+        chains = {}
+        visited = bytearray(n)
+        split = set()
+
+        def walk_chains(u):
+            for first, weight in graph.edges(u):
+                prev, node = u, first
+                interior = []
+                while not keep[node]:
+                    visited[node] = 1
+                    interior.append(node)
+                    n1, n2 = graph.edges(node)
+                    nxt, w = n1 if n1[0] != prev else n2
+                    weight += w
+                    prev, node = node, nxt
+                if node == u:
+                    # a loop: walked both ways, so pick the same node each time
+                    split.add(min(interior))
+                    continue
+                if u < node:
+                    key, path = (u, node), interior
+                else:
+                    key, path = (node, u), interior[::-1]
+                if key not in chains:
+                    chains[key] = (weight, path)
+                elif chains[key][1] != path:
+                    # parallel chains, at most one of which is a direct edge
+                    split.add(min(path or chains[key][1]))
+
+        for u in range(n):
+            if keep[u]:
+                walk_chains(u)
+        # what's left are rings of degree 2 nodes, which then loop back
+        for u in range(n):
+            if not keep[u] and not visited[u]:
+                keep[u] = 1
+                walk_chains(u)
+        if not split:
+            break
+        for u in split:
+            keep[u] = 1
+
+    node_ids = array('i', [i for i in range(n) if keep[i]])
+    contracted_ids = array('i', [-1]) * n
+    for i, orig in enumerate(node_ids):
+        contracted_ids[orig] = i
+
+    # rows of (target, weight, interior nodes)
+    rows = [[] for _ in node_ids]
+    for (a, b), (weight, path) in chains.items():
+        ca, cb = contracted_ids[a], contracted_ids[b]
+        rows[ca].append((cb, weight, path))
+        rows[cb].append((ca, weight, path[::-1]))
+
+    offsets = array('i', [0])
+    targets = array('i')
+    weights = array('f')
+    path_offsets = array('i', [0])
+    path_nodes = array('i')
+    for row in rows:
+        row.sort()
+        for target, weight, path in row:
+            targets.append(target)
+            weights.append(weight)
+            path_nodes.extend(path)
+            path_offsets.append(len(path_nodes))
+        offsets.append(len(targets))
+    lats = array('d', (graph.lats[i] for i in node_ids))
+    lons = array('d', (graph.lons[i] for i in node_ids))
+    name_ids = None
+    if graph.name_ids is not None:
+        name_ids = array('i', (graph.name_ids[i] for i in node_ids))
+    geometry = csr_graph.EdgeGeometry(path_offsets,
+                                      array('d', (graph.lats[i] for i in path_nodes)),
+                                      array('d', (graph.lons[i] for i in path_nodes)))
+    contracted = csr_graph.CSRGraph(lats, lons, offsets, targets, weights,
+                                    name_ids, graph.names, geometry)
+    return ContractedGraph(contracted, node_ids, path_offsets, path_nodes)
+
+
+class ContractDegree2Tests(unittest.TestCase):
+    def build(self, num_nodes, edges):
+        lats = [0.0] * num_nodes
+        lons = [i * 0.001 for i in range(num_nodes)]
+        return csr_graph.from_edges(lats, lons, [a for a, b in edges], [b for a, b in edges])
+
+    def test_chain(self):
+        # 0 - 1 - 2 - 3, with 4 branching off 2
+        graph = self.build(5, [(0, 1), (1, 2), (2, 3), (2, 4)])
+        contracted = contract_degree_2(graph)
+        self.assertEqual(list(contracted.node_ids), [0, 2, 3, 4])
+        self.assertEqual(contracted.graph.num_edges, 3)
+        self.assertEqual(contracted.contracted_index(1), -1)
+        self.assertAlmostEqual(contracted.graph.weights[0],
+                               graph.weights[0] + graph.weights[1], places=2)
+        self.assertEqual(contracted.expand_path([0, 1, 2]), [0, 1, 2, 3])
+        self.assertEqual(contracted.expand_path([2, 1, 0]), [3, 2, 1, 0])
+        geometry = contracted.graph.geometry
+        self.assertEqual(len(geometry), len(contracted.graph.targets))
+        self.assertEqual(geometry.points(0), [(0.0, 0.001)])
+        self.assertEqual(geometry.points(1), [(0.0, 0.001)])
+        self.assertEqual(geometry.points(2), [])
+
+    def assert_all_points_kept(self, graph, contracted):
+        kept = list(contracted.node_ids) + list(contracted.path_nodes)
+        self.assertEqual(set(kept), set(range(len(graph))))
+        geometry = contracted.graph.geometry
+        points = set(zip(contracted.graph.lats, contracted.graph.lons))
+        for e in range(len(geometry)):
+            points.update(geometry.points(e))
+        self.assertEqual(points, set(zip(graph.lats, graph.lons)))
+        for a in range(len(contracted.graph)):
+            neighbours = list(contracted.graph.neighbours(a))
+            self.assertNotIn(a, neighbours)
+            self.assertEqual(len(neighbours), len(set(neighbours)))
+
+    def test_parallel_chains(self):
+        # 0 and 3 joined directly by 0-1-3, and the long way by 0-2-4-3
+        graph = self.build(6, [(0, 1), (1, 3), (0, 2), (2, 4), (4, 3), (0, 5), (3, 5)])
+        contracted = contract_degree_2(graph)
+        self.assert_all_points_kept(graph, contracted)
+        zero, three = contracted.contracted_index(0), contracted.contracted_index(3)
+        two = contracted.contracted_index(2)
+        self.assertEqual(contracted.expand_path([zero, three]), [0, 1, 3])
+        self.assertEqual(contracted.expand_path([zero, two, three]), [0, 2, 4, 3])
+
+    def test_parallel_direct_edge(self):
+        # 0-1 directly and by 0-2-1, with 3 and 4 making 0 and 1 junctions
+        graph = self.build(5, [(0, 1), (0, 2), (2, 1), (0, 3), (1, 4)])
+        contracted = contract_degree_2(graph)
+        self.assert_all_points_kept(graph, contracted)
+        self.assertEqual(list(contracted.node_ids), [0, 1, 2, 3, 4])
+
+    def test_lasso(self):
+        # 0 - 1 - 2, with 2 - 3 - 4 - 5 - 2 looping back
+        graph = self.build(6, [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 2)])
+        contracted = contract_degree_2(graph)
+        self.assert_all_points_kept(graph, contracted)
+        # the loop needs two nodes kept, to avoid parallel edges
+        self.assertEqual(list(contracted.node_ids), [0, 2, 3, 4])
+        two, three, four = (contracted.contracted_index(i) for i in [2, 3, 4])
+        self.assertEqual(contracted.expand_path([two, three, four, two]), [2, 3, 4, 5, 2])
+
+    def test_triangle_loop(self):
+        # 0 - 1, with 1 - 2 - 3 - 1 looping back
+        graph = self.build(4, [(0, 1), (1, 2), (2, 3), (3, 1)])
+        contracted = contract_degree_2(graph)
+        self.assert_all_points_kept(graph, contracted)
+        self.assertEqual(list(contracted.node_ids), [0, 1, 2, 3])
+
+    def test_ring(self):
+        graph = self.build(4, [(0, 1), (1, 2), (2, 3), (3, 0)])
+        contracted = contract_degree_2(graph)
+        self.assert_all_points_kept(graph, contracted)
+        self.assertEqual(list(contracted.node_ids), [0, 1, 2])
+        self.assertEqual(contracted.expand_path([0, 1, 2, 0]), [0, 1, 2, 3, 0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+""" Split the road graph into spatial tiles, for loading in the browser on
+demand (see js/tiled_graph.js)
+
+Nodes are split into quadtree tiles over lon/lat, each holding at most
+max_nodes nodes. Nodes are renumbered so that each tile's nodes have
+consecutive ids, so the tile holding any node can be found from the
+manifest alone. An edge between two tiles refers to the other node by id,
+and is written into both tiles.
+
+    manifest.json:
+        {"version": 1, "num_nodes": n, "num_edges": m,
+         "bbox": [minlon, minlat, maxlon, maxlat],
+         "tiles": [{"key": "03", "file": "t03.json", "bbox": [...],
+                    "first": 0, "count": 812}, ...]}
+    t<key>.json:
+        {"nodes": [[lon, lat], ...], "edges": [[a, b], ...],
+         "paths": [[[lon, lat], ...], ...]}
+        a is a node of the tile. Edges within the tile are written once,
+        with a < b. paths is only there if the graph has edge geometry (see
+        csr_graph.EdgeGeometry): the shape points of each edge, from a to b.
+
+Tile keys are quadtree paths: '' is the whole graph, and each digit picks
+a quarter of its parent (0: south west, 1: south east, 2: north west,
+3: north east).
+"""
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+
+import csr_graph
+import graph_simplify
+
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+DEFAULT_MAX_NODES = 4096
+# stop splitting here, in case more than max_nodes nodes share a location
+MAX_DEPTH = 24
+
+
+class Tile(object):
+    """ A quadtree tile. Its nodes are first:first + count in the tiled
+        node order.
+    """
+    def __init__(self, key, bbox, first, count):
+        self.key = key
+        self.bbox = bbox
+        self.first = first
+        self.count = count
+
+    @property
+    def filename(self):
+        return 't{}.json'.format(self.key)
+
+    def to_jsondict(self):
+        return {'key': self.key, 'file': self.filename, 'bbox': self.bbox,
+                'first': self.first, 'count': self.count}
+
+
+def graph_bbox(graph):
+    """ [minlon, minlat, maxlon, maxlat] of a graph's nodes """
+    if len(graph) == 0:
+        return [0.0, 0.0, 0.0, 0.0]
+    return [min(graph.lons), min(graph.lats), max(graph.lons), max(graph.lats)]
+
+
+def tile_graph(graph, max_nodes=DEFAULT_MAX_NODES):
+    """ Split a graph's nodes into quadtree tiles.
+        Returns (tiles, order): the Tiles in order, and the original index
+        of each node in tiled order.
+    """
+    lons, lats = graph.lons, graph.lats
+    tiles = []
+    order = array('i')
+    # depth first, so each tile's nodes are appended consecutively
+    stack = [('', graph_bbox(graph), list(range(len(graph))))]
+    while stack:
+        key, bbox, nodes = stack.pop()
+        if len(nodes) <= max_nodes or len(key) >= MAX_DEPTH:
+            if nodes:
+                tiles.append(Tile(key, bbox, len(order), len(nodes)))
+                order.extend(nodes)
+            continue
+        minlon, minlat, maxlon, maxlat = bbox
+        midlon = (minlon + maxlon) / 2
+        midlat = (minlat + maxlat) / 2
+        quarters = [[], [], [], []]
+        for i in nodes:
+            quarters[(lons[i] >= midlon) + 2 * (lats[i] >= midlat)].append(i)
+        bboxes = [[minlon, minlat, midlon, midlat], [midlon, minlat, maxlon, midlat],
+                  [minlon, midlat, midlon, maxlat], [midlon, midlat, maxlon, maxlat]]
+        for q in reversed(range(4)):
+            stack.append((key + str(q), bboxes[q], quarters[q]))
+    return tiles, order
+
+
+def write_tiles(out_dir, graph, max_nodes=DEFAULT_MAX_NODES):
+    """ Write a csr_graph.CSRGraph as a manifest and tile files in out_dir.
+        Tile files from a previous export are removed.
+    """
+    tiles, order = tile_graph(graph, max_nodes)
+    new_ids = array('i', [0]) * len(order)
+    for new_id, orig in enumerate(order):
+        new_ids[orig] = new_id
+
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(out_dir):
+        if name.startswith('t') and name.endswith('.json'):
+            os.remove(os.path.join(out_dir, name))
+
+    offsets, targets, geometry = graph.offsets, graph.targets, graph.geometry
+    for tile in tiles:
+        first, end = tile.first, tile.first + tile.count
+        nodes = []
+        edges = []
+        paths = []
+        for a in range(first, end):
+            u = order[a]
+            nodes.append((graph.lons[u], graph.lats[u]))
+            for e in range(offsets[u], offsets[u + 1]):
+                b = new_ids[targets[e]]
+                if a < b or not first <= b < end:
+                    edges.append((a, b))
+                    if geometry is not None:
+                        paths.append([(lon, lat) for lat, lon in geometry.points(e)])
+        data = {'nodes': nodes, 'edges': edges}
+        if geometry is not None:
+            data['paths'] = paths
+        with open(os.path.join(out_dir, tile.filename), 'w') as ofile:
+            json.dump(data, ofile)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'num_nodes': len(graph),
+        'num_edges': graph.num_edges,
+        'bbox': graph_bbox(graph),
+        'tiles': [tile.to_jsondict() for tile in tiles]
+    }
+    with open(os.path.join(out_dir, MANIFEST_NAME), 'w') as ofile:
+        json.dump(manifest, ofile)
+
+
+def read_tiles(out_dir):
+    """ Read a tiled export back into a CSRGraph, in tiled node order """
+    with open(os.path.join(out_dir, MANIFEST_NAME)) as ifile:
+        manifest = json.load(ifile)
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ValueError('unsupported tile manifest version: {}'.format(manifest['version']))
+    lats, lons = array('d'), array('d')
+    firsts, seconds = [], []
+    for tile in manifest['tiles']:
+        with open(os.path.join(out_dir, tile['file'])) as ifile:
+            data = json.load(ifile)
+        lons.extend(lon for lon, lat in data['nodes'])
+        lats.extend(lat for lon, lat in data['nodes'])
+        for a, b in data['edges']:
+            firsts.append(a)
+            seconds.append(b)
+    return csr_graph.from_edges(lats, lons, firsts, seconds, weighted=False)
+
+
+class GraphTilesTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tiles_cover_all_nodes(self):
+        graph = csr_graph.make_test_grid(10, 0.01, pair=False, weighted=False)
+        tiles, order = tile_graph(graph, max_nodes=8)
+        self.assertEqual(sorted(order), list(range(100)))
+        self.assertTrue(all(tile.count <= 8 for tile in tiles))
+        self.assertEqual(sum(tile.count for tile in tiles), 100)
+        for tile in tiles:
+            minlon, minlat, maxlon, maxlat = tile.bbox
+            for i in order[tile.first:tile.first + tile.count]:
+                self.assertTrue(minlon <= graph.lons[i] <= maxlon)
+                self.assertTrue(minlat <= graph.lats[i] <= maxlat)
+
+    def test_round_trip(self):
+        graph = csr_graph.make_test_grid(10, 0.01, pair=False, weighted=False)
+        write_tiles(self.dir, graph, max_nodes=8)
+        tiled = read_tiles(self.dir)
+        _, order = tile_graph(graph, max_nodes=8)
+        self.assertEqual(tiled.num_edges, graph.num_edges)
+        self.assertEqual(list(tiled.lats), [graph.lats[i] for i in order])
+        expected = sorted(tuple(sorted((order[a], order[b]))) for a, b in tiled.undirected_edges())
+        self.assertEqual(expected, list(graph.undirected_edges()))
+
+    def test_single_tile(self):
+        write_tiles(self.dir, csr_graph.make_test_grid(3, 0.01, pair=False, weighted=False))
+        with open(os.path.join(self.dir, MANIFEST_NAME)) as ifile:
+            manifest = json.load(ifile)
+        self.assertEqual([t['file'] for t in manifest['tiles']], ['t.json'])
+        self.assertEqual(manifest['num_edges'], 12)
+
+    def test_edge_geometry(self):
+        # 0 - 1 - 2 - 3 chain, contracted to one edge 0 - 3 with two shape points
+        graph = csr_graph.from_edges([0, 0, 0, 0.01], [0, 0.01, 0.02, 0.02],
+                                     [0, 1, 2], [1, 2, 3])
+        contracted = graph_simplify.contract_degree_2(graph).graph
+        write_tiles(self.dir, contracted, max_nodes=1)
+        tiles, order = tile_graph(contracted, max_nodes=1)
+        paths = {}
+        for tile in tiles:
+            with open(os.path.join(self.dir, tile.filename)) as ifile:
+                data = json.load(ifile)
+            for (a, b), path in zip(data['edges'], data['paths']):
+                paths[order[a], order[b]] = path
+        self.assertEqual(paths, {(0, 1): [[0.01, 0], [0.02, 0]],
+                                 (1, 0): [[0.02, 0], [0.01, 0]]})
+
+    def test_duplicate_points_stop_splitting(self):
+        graph = csr_graph.from_edges([1.0] * 10, [2.0] * 10, [], [], weighted=False)
+        tiles, order = tile_graph(graph, max_nodes=2)
+        self.assertEqual(len(tiles), 1)
+        self.assertEqual(len(tiles[0].key), MAX_DEPTH)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,428 @@
+""" Update the road graph for a changed set of placemarks, without rebuilding
+it
+
+Placemarks are matched to those of the previous build by their names and a
+hash of their points. Placemarks that match are left as they are. Only the
+nodes of removed and added placemarks change, along with the junction edges
+near them, so a small edit to the roads costs time in proportion to the edit
+rather than to the whole graph.
+
+The graph is the same as placemark_graph.placemarks_to_csr would build from
+the new placemarks, apart from node order, and which node is picked when a
+point has two equally near neighbours.
+"""
+
+
+import hashlib
+import math
+import unittest
+from array import array
+from collections import namedtuple
+
+import csr_graph
+import placemark_graph
+import placemark_store
+import spatial_hash
+
+
+DEFAULT_MAX_DIST_SQUARED = .0000000000001
+
+# what an update changed. Edge counts include road and junction edges.
+# num_nodes and num_edges are the sizes of the graph after the update.
+_UpdateReport = namedtuple('UpdateReport', [
+    'placemarks_added', 'placemarks_removed', 'placemarks_unchanged',
+    'nodes_added', 'nodes_removed', 'edges_added', 'edges_removed',
+    'num_nodes', 'num_edges'])
+
+
+class UpdateReport(_UpdateReport):
+    @property
+    def changed_fraction(self):
+        """ Share of the nodes in the old or new graph that were added or
+            removed
+        """
+        total = self.num_nodes + self.nodes_removed
+        if total == 0:
+            return 0.0
+        return (self.nodes_added + self.nodes_removed) / total
+
+    def __str__(self):
+        return ('placemarks: +{} -{} ={}, nodes: +{} -{}, edges: +{} -{}, '
+                '{:.2%} of nodes changed').format(
+                    self.placemarks_added, self.placemarks_removed,
+                    self.placemarks_unchanged, self.nodes_added, self.nodes_removed,
+                    self.edges_added, self.edges_removed, self.changed_fraction)
+
+
+class IncrementalGraph(object):
+    """ A road graph built from placemarks, that can be updated to a new set
+        of placemarks by changing only the parts that differ.
+        Nodes are numbered in the order they're added, and the ids of removed
+        nodes aren't reused. to_csr numbers the remaining nodes from 0.
+        max_dist_squared and all_pairs are the same as for
+        placemark_graph.placemarks_to_csr.
+    """
+    def __init__(self, max_dist_squared=DEFAULT_MAX_DIST_SQUARED, all_pairs=False,
+                 cell_size=None):
+        self.max_dist_squared = max_dist_squared
+        self.all_pairs = all_pairs
+        self.cell_size = cell_size
+        # x is longitude, y is latitude. Created by the first update, so the
+        # cell size can suit its points
+        self.index = None
+        self.alive = bytearray()
+        # nearest other node within max_dist_squared of each node, or -1.
+        # Only kept when all_pairs is not set
+        self.nearest = array('l')
+        # junction edges, by node. Nodes without any aren't in the dict.
+        # Edges between consecutive nodes of a placemark are implied by
+        # placemark_ranges
+        self.junctions = {}
+        self.num_junction_edges = 0
+        self.name_ids = array('i')
+        self.names = []
+        self._name_ids = {}
+        # placemark key -> list of (first node id, end node id), one per
+        # placemark with that key
+        self.placemark_ranges = {}
+        # first node id of each node's placemark, so road edges can be told
+        # from junctions
+        self.placemark_firsts = array('l')
+        self.num_nodes = 0
+        self.num_road_edges = 0
+
+    @property
+    def num_edges(self):
+        return self.num_road_edges + self.num_junction_edges
+
+    def update(self, placemarks):
+        """ Change the graph to that of placemarks (placemark objects or a
+            placemark_store.PlacemarkStore). Returns an UpdateReport.
+        """
+        store = placemark_store.from_placemarks(placemarks)
+        wanted = {}
+        for pm_idx in range(len(store)):
+            wanted.setdefault(placemark_key(store, pm_idx), []).append(pm_idx)
+
+        removed = []
+        unchanged = 0
+        for key, ranges in list(self.placemark_ranges.items()):
+            keep = len(wanted.get(key, ()))
+            unchanged += min(keep, len(ranges))
+            if len(ranges) > keep:
+                removed.extend(ranges[keep:])
+                del ranges[keep:]
+            if not ranges:
+                del self.placemark_ranges[key]
+        added = []
+        for key, pm_idxs in wanted.items():
+            have = len(self.placemark_ranges.get(key, ()))
+            added.extend((key, pm_idx) for pm_idx in pm_idxs[have:])
+        # add in store order, so a fresh build numbers nodes like placemarks_to_csr
+        added.sort(key=lambda item: item[1])
+
+        nodes_removed, edges_removed = self._remove_ranges(removed)
+        new_ids, edges_added = self._add_placemarks(store, added)
+        if self.all_pairs:
+            edges_added += self._join_all_pairs(new_ids)
+        else:
+            junctions_added, junctions_removed = self._join_nearest(new_ids, removed)
+            edges_added += junctions_added
+            edges_removed += junctions_removed
+        return UpdateReport(len(added), len(removed), unchanged,
+                            len(new_ids), nodes_removed, edges_added, edges_removed,
+                            self.num_nodes, self.num_edges)
+
+    def _remove_ranges(self, ranges):
+        """ Remove the nodes of placemarks, and their edges. Returns the
+            number of (nodes, edges) removed.
+        """
+        nodes_removed = edges_removed = 0
+        for first, end in ranges:
+            for i in range(first, end):
+                self.alive[i] = 0
+                self.index.remove(i)
+                for j in self.junctions.pop(i, ()):
+                    self._unlink(j, i)
+                    self.num_junction_edges -= 1
+                    edges_removed += 1
+            road_edges = max(0, end - first - 1)
+            self.num_road_edges -= road_edges
+            edges_removed += road_edges
+            nodes_removed += end - first
+        self.num_nodes -= nodes_removed
+        return nodes_removed, edges_removed
+
+    def _add_placemarks(self, store, added):
+        """ Add the nodes of placemarks, and the edges between their
+            consecutive points. Returns (new node ids, number of edges added).
+        """
+        if not added:
+            return [], 0
+        if self.index is None:
+            cell_size = self.cell_size
+            if cell_size is None:
+                cell_size = spatial_hash.default_cell_size(store.lons, store.lats)
+            self.index = spatial_hash.SpatialHash(cell_size)
+        first_id = len(self.alive)
+        lats, lons = array('d'), array('d')
+        edges_added = 0
+        for key, pm_idx in added:
+            start, end = store.point_range(pm_idx)
+            first = first_id + len(lats)
+            count = end - start
+            lats.extend(store.lats[start:end])
+            lons.extend(store.lons[start:end])
+            name_id = self._intern(store.names[store.declared_name_ids[pm_idx]])
+            self.name_ids.extend([name_id] * count)
+            self.placemark_firsts.extend([first] * count)
+            self.placemark_ranges.setdefault(key, []).append((first, first + count))
+            edges_added += max(0, count - 1)
+        # one bulk insert, since each insert updates the index bounds
+        self.index.insert(lons, lats)
+        self.alive.extend(b'\1' * len(lats))
+        self.nearest.extend([-1] * len(lats))
+        self.num_nodes += len(self.alive) - first_id
+        self.num_road_edges += edges_added
+        return range(first_id, len(self.alive)), edges_added
+
+    def _intern(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def _close(self, x, y):
+        """ (squared distance, id) of each node within max_dist_squared of x, y """
+        max_d = self.max_dist_squared
+        xs, ys = self.index.xs, self.index.ys
+        # search_nn_dist finds strictly closer points, so pad the radius a
+        # little and filter the result
+        radius = math.sqrt(max_d) * (1 + 1e-9) + 1e-300
+        close = []
+        for j in self.index.search_nn_dist((x, y), radius):
+            dx = xs[j] - x
+            dy = ys[j] - y
+            d = dx * dx + dy * dy
+            if d <= max_d:
+                close.append((d, j))
+        return close
+
+    def _link(self, i, j):
+        """ Add a junction edge, returns whether it was new. Consecutive
+            nodes of a placemark already have a road edge, so aren't linked.
+        """
+        if abs(i - j) == 1 and self.placemark_firsts[i] == self.placemark_firsts[j]:
+            return False
+        adjacent = self.junctions.setdefault(i, set())
+        if j in adjacent:
+            return False
+        adjacent.add(j)
+        self.junctions.setdefault(j, set()).add(i)
+        self.num_junction_edges += 1
+        return True
+
+    def _unlink(self, i, j):
+        """ Remove one direction of a junction edge """
+        adjacent = self.junctions[i]
+        adjacent.discard(j)
+        if not adjacent:
+            del self.junctions[i]
+
+    def _join_all_pairs(self, new_ids):
+        """ Join each new node to every node within max_dist_squared. Pairs
+            of old nodes can't have changed. Returns the number of edges added.
+        """
+        xs, ys = self.index.xs, self.index.ys
+        added = 0
+        for i in new_ids:
+            for d, j in self._close(xs[i], ys[i]):
+                if j != i and self._link(i, j):
+                    added += 1
+        return added
+
+    def _join_nearest(self, new_ids, removed):
+        """ Update the nearest neighbour of the new nodes, and of every node
+            that a new or removed node was close to, then the junction edges
+            of those nodes. removed: ranges of removed node ids.
+            Returns the number of junction edges (added, removed).
+        """
+        if self.index is None:
+            return 0, 0
+        xs, ys, alive, nearest = self.index.xs, self.index.ys, self.alive, self.nearest
+        affected = set(new_ids)
+        moved = [range(first, end) for first, end in removed] + [new_ids]
+        for ids in moved:
+            for i in ids:
+                affected.update(j for d, j in self._close(xs[i], ys[i]))
+        changed = []
+        for i in sorted(affected):
+            if not alive[i]:
+                continue
+            close = [(d, j) for d, j in self._close(xs[i], ys[i]) if j != i]
+            best = min(close)[1] if close else -1
+            if best != nearest[i]:
+                changed.append((i, nearest[i], best))
+                nearest[i] = best
+        added = removed = 0
+        for i, old, new in changed:
+            if (old >= 0 and alive[old] and nearest[old] != i
+                    and old in self.junctions.get(i, ())):
+                self._unlink(i, old)
+                self._unlink(old, i)
+                self.num_junction_edges -= 1
+                removed += 1
+            if new >= 0 and self._link(i, new):
+                added += 1
+        return added, removed
+
+    def to_csr(self):
+        """ The graph as a csr_graph.CSRGraph. Remaining nodes are numbered
+            in id order.
+        """
+        ids = [i for i in range(len(self.alive)) if self.alive[i]]
+        new_id = {i: n for n, i in enumerate(ids)}
+        xs, ys = (self.index.xs, self.index.ys) if self.index else ([], [])
+        lats = array('d', (ys[i] for i in ids))
+        lons = array('d', (xs[i] for i in ids))
+        firsts = array('l')
+        seconds = array('l')
+        for ranges in self.placemark_ranges.values():
+            for first, end in ranges:
+                firsts.extend(new_id[i] for i in range(first, end - 1))
+                seconds.extend(new_id[i] for i in range(first + 1, end))
+        for i, adjacent in self.junctions.items():
+            for j in adjacent:
+                if i < j:
+                    firsts.append(new_id[i])
+                    seconds.append(new_id[j])
+        return csr_graph.from_edges(lats, lons, firsts, seconds,
+                                    name_ids=array('i', (self.name_ids[i] for i in ids)),
+                                    names=list(self.names))
+
+
+def build(placemarks, max_dist_squared=DEFAULT_MAX_DIST_SQUARED, all_pairs=False):
+    """ Create an IncrementalGraph from placemarks """
+    graph = IncrementalGraph(max_dist_squared, all_pairs)
+    graph.update(placemarks)
+    return graph
+
+
+def placemark_key(store, pm_idx):
+    """ A placemark's names and a hash of its points, so that placemarks
+        that are the same in two builds have the same key
+    """
+    start, end = store.point_range(pm_idx)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(store.lats[start:end].tobytes())
+    digest.update(store.lons[start:end].tobytes())
+    names = store.names
+    return (names[store.declared_name_ids[pm_idx]], names[store.road_name_ids[pm_idx]],
+            names[store.local_name_ids[pm_idx]], digest.digest())
+
+
+class GraphUpdateTests(unittest.TestCase):
+    def setUp(self):
+        # a grid of roads: horizontal roads crossing vertical ones at shared
+        # points, split into two placemarks each
+        self.placemarks = []
+        for k in range(6):
+            for half in range(2):
+                cols = range(half * 4, half * 4 + 5)
+                self.placemarks.append(TestPlacemark(
+                    'h{}'.format(k), [(c * 0.001, k * 0.002) for c in cols]))
+                self.placemarks.append(TestPlacemark(
+                    'v{}'.format(k), [(k * 0.002 + 0.0005, c * 0.0015) for c in cols]))
+
+    def edge_set(self, graph):
+        """ Edges by their end coordinates, since node order differs """
+        return sorted(tuple(sorted([(graph.lats[i], graph.lons[i]), (graph.lats[j], graph.lons[j])]))
+                      for i, j in graph.undirected_edges())
+
+    def assert_same_graph(self, graph, placemarks, all_pairs):
+        expected = placemark_graph.placemarks_to_csr(placemarks, all_pairs=all_pairs)
+        actual = graph.to_csr()
+        self.assertEqual(sorted(zip(actual.lats, actual.lons)),
+                         sorted(zip(expected.lats, expected.lons)))
+        self.assertEqual(self.edge_set(actual), self.edge_set(expected))
+        self.assertEqual(graph.num_nodes, len(expected))
+
+    def test_build_matches_full_build(self):
+        for all_pairs in [False, True]:
+            graph = build(self.placemarks, all_pairs=all_pairs)
+            self.assert_same_graph(graph, self.placemarks, all_pairs)
+
+    def test_no_change(self):
+        graph = build(self.placemarks)
+        report = graph.update(list(self.placemarks))
+        self.assertEqual(report.placemarks_unchanged, len(self.placemarks))
+        self.assertEqual((report.nodes_added, report.nodes_removed), (0, 0))
+        self.assertEqual((report.edges_added, report.edges_removed), (0, 0))
+        self.assertEqual(report.changed_fraction, 0)
+
+    def test_add_remove_and_change(self):
+        for all_pairs in [False, True]:
+            graph = build(self.placemarks, all_pairs=all_pairs)
+            new = list(self.placemarks)
+            del new[3]
+            # moved a little, so it no longer meets the road it crossed
+            new[0] = TestPlacemark('h0', [(lat + 0.0001, lon) for lat, lon in new[0].points])
+            new.append(TestPlacemark('new', [(0.002, 0.0025), (0.004, 0.0025)]))
+            report = graph.update(new)
+            self.assertEqual(report.placemarks_added, 2)
+            self.assertEqual(report.placemarks_removed, 2)
+            self.assertEqual(report.placemarks_unchanged, len(self.placemarks) - 2)
+            self.assertEqual(report.nodes_added, 7)
+            self.assertEqual(report.nodes_removed, 10)
+            self.assertEqual(report.num_edges, graph.to_csr().num_edges)
+            self.assert_same_graph(graph, new, all_pairs)
+
+    def test_remove_all(self):
+        graph = build(self.placemarks)
+        report = graph.update([])
+        self.assertEqual(report.num_nodes, 0)
+        self.assertEqual(report.num_edges, 0)
+        self.assertEqual(report.changed_fraction, 1)
+        self.assertEqual(len(graph.to_csr()), 0)
+
+    def test_duplicate_points(self):
+        # repeated and very close consecutive points, and a road through a
+        # repeated point of another
+        placemarks = [TestPlacemark('a', [(0, 0), (0, 0), (0, 0.001), (0, 0.001)]),
+                      TestPlacemark('b', [(0.001, 0.001), (0, 0.001), (0, 0.001 + 1e-8)]),
+                      TestPlacemark('c', [(0.002, 0), (0.002, 0), (0.002, 0.001)])]
+        for all_pairs in [False, True]:
+            graph = build(placemarks[:2], all_pairs=all_pairs)
+            for new in [placemarks[1:], placemarks]:
+                report = graph.update(new)
+                self.assertEqual(report.num_edges, graph.to_csr().num_edges)
+                if all_pairs:
+                    # the nearest of coincident nodes can differ otherwise
+                    self.assert_same_graph(graph, new, all_pairs)
+
+    def test_duplicate_placemarks(self):
+        graph = build(self.placemarks[:2] * 2)
+        report = graph.update(self.placemarks[:2] * 3)
+        self.assertEqual((report.placemarks_added, report.placemarks_unchanged), (2, 4))
+
+
+class TestPlacemark(object):
+    def __init__(self, declared_name, points):
+        self.declared_name = declared_name
+        self.road_name = None
+        self.local_name = None
+        # (lat, lon) tuples
+        self.points = points
+
+    @property
+    def lats(self):
+        return [lat for lat, lon in self.points]
+
+    @property
+    def lons(self):
+        return [lon for lat, lon in self.points]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+""" Write json incrementally, one array element at a time
+
+The output is the same as json.dumps of the equivalent lists and dicts, but
+only one element is held in memory at a time.
+"""
+
+
+import io
+import json
+import unittest
+
+
+def write_array(ofile, items, indent=None, level=0):
+    """ Write an iterable as a json array to a text file object.
+        indent is as for json.dumps. level is the nesting depth of the array,
+        for writing arrays inside other values.
+    """
+    encode = json.JSONEncoder(indent=indent).encode
+    if indent is None:
+        separator = ', '
+        first = end = ''
+        newline = None
+    else:
+        if isinstance(indent, int):
+            indent = ' ' * indent
+        newline = '\n' + indent * (level + 1)
+        separator = ',' + newline
+        first = newline
+        end = '\n' + indent * level
+    ofile.write('[')
+    empty = True
+    for item in items:
+        text = encode(item)
+        if newline is not None:
+            # json strings never contain a raw newline, so this only indents
+            text = text.replace('\n', newline)
+        ofile.write(first if empty else separator)
+        ofile.write(text)
+        empty = False
+    if not empty:
+        ofile.write(end)
+    ofile.write(']')
+
+
+def write_object_of_arrays(ofile, pairs, indent=None):
+    """ Write (key, iterable) pairs as a json object whose values are arrays,
+        streaming each array with write_array
+    """
+    if indent is None:
+        separator, first, end = ', ', '', ''
+    else:
+        if isinstance(indent, int):
+            indent = ' ' * indent
+        separator, first, end = ',\n' + indent, '\n' + indent, '\n'
+    ofile.write('{')
+    empty = True
+    for key, items in pairs:
+        ofile.write(first if empty else separator)
+        ofile.write(json.dumps(key) + ': ')
+        write_array(ofile, items, indent, 1)
+        empty = False
+    if not empty:
+        ofile.write(end)
+    ofile.write('}')
+
+
+class JsonStreamTests(unittest.TestCase):
+    VALUES = [[], [1], [{'a': 'x\ny', 'b': [(1.5, 2), []]}, None, 3], [[[]], {}]]
+
+    def test_array_matches_dumps(self):
+        for indent in [None, '\t', 2]:
+            for value in self.VALUES:
+                buf = io.StringIO()
+                write_array(buf, iter(value), indent)
+                self.assertEqual(buf.getvalue(), json.dumps(value, indent=indent))
+
+    def test_object_matches_dumps(self):
+        for indent in [None, '\t']:
+            for value in [{}, {'nodes': [(1.0, 2.0), (3, 4)], 'edges': []}]:
+                buf = io.StringIO()
+                write_object_of_arrays(buf, ((k, iter(v)) for k, v in value.items()), indent)
+                self.assertEqual(buf.getvalue(), json.dumps(value, indent=indent))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,6 +12,9 @@ import heapq
 import itertools
 import operator
 import math
+import random
+import unittest
+from array import array
 from collections import deque
 from functools import wraps
 
@@ -26,6 +29,9 @@ class Node(object):
     A tree is represented by its root node, and every node represents
     its subtree"""
 
+    # no per-node __dict__, since trees can have millions of nodes
+    __slots__ = ('data', 'left', 'right')
+
     def __init__(self, data=None, left=None, right=None):
         self.data = data
         self.left = left
@@ -190,6 +196,7 @@ def require_axis(f):
 class KDNode(Node):
     """ A Node that contains kd-tree specific data and methods """
 
+    __slots__ = ('axis', 'sel_axis', 'dimensions')
 
     def __init__(self, data=None, left=None, right=None, axis=None,
             sel_axis=None, dimensions=None):
@@ -447,6 +454,74 @@ class KDNode(Node):
                                            counter)
 
 
+    @require_axis
+    def search_knn_2d(self, point, k):
+        """ Same as search_knn with the default distance, for 2-d trees
+        Returns the same (node, squared distance) tuples in the same order,
+        but walks the tree from an explicit stack rather than recursing,
+        computes distances inline, and keeps the kth nearest distance so far
+        as a bound. Subtrees on the far side of a split that is farther than
+        the bound are skipped.
+        >>> tree = create([(0, 0), (5, 0), (5, 5)])
+        >>> [(n.data, d) for n, d in tree.search_knn_2d((1, 0), 2)]
+        [((0, 0), 1), ((5, 0), 16)]
+        """
+
+        if self.dimensions != 2:
+            raise ValueError('search_knn_2d needs a 2-d tree')
+        if k < 1:
+            return []
+
+        px, py = point[0], point[1]
+        results = []
+        worst = float('inf')
+        # count visits, so equal distances are ordered as search_knn orders them
+        counter = 0
+        # alternating nodes, and the squared distance from the point to the
+        # split that separates it from the node's subtree
+        stack = [self, 0]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            plane_dist2 = pop()
+            node = pop()
+            # worst is infinite until there are k results
+            if plane_dist2 >= worst or node.data is None:
+                continue
+
+            data = node.data
+            dx = data[0] - px
+            dy = data[1] - py
+            d = dx * dx + dy * dy
+            if len(results) < k:
+                heapq.heappush(results, (-d, counter, node))
+                if len(results) == k:
+                    worst = -results[0][0]
+            elif d < worst:
+                heapq.heapreplace(results, (-d, counter, node))
+                worst = -results[0][0]
+            counter += 1
+
+            # push the far side first, so the near side is searched first
+            plane_dist = dx if node.axis == 0 else dy
+            if plane_dist > 0:
+                if node.right is not None:
+                    push(node.right)
+                    push(plane_dist * plane_dist)
+                if node.left is not None:
+                    push(node.left)
+                    push(0)
+            else:
+                if node.left is not None:
+                    push(node.left)
+                    push(plane_dist * plane_dist)
+                if node.right is not None:
+                    push(node.right)
+                    push(0)
+
+        return [(node, -d) for d, _, node in sorted(results, reverse=True)]
+
+
     @require_axis
     def search_nn(self, point, dist=None):
         """
@@ -467,24 +542,35 @@ class KDNode(Node):
         """
         Search the n nearest nodes of the given point which are within given
         distance
-        point must be a location, not a node. A list containing the n nearest
-        nodes to the point within the distance will be returned.
+        point must be a location, not a node. A list containing the nodes
+        closer than distance to the point will be returned, in no particular
+        order. distance is a plain (not squared) distance. Found nodes are
+        appended to best, if it is given.
+        >>> tree = create([(0, 0), (5, 0), (5, 5)])
+        >>> sorted(n.data for n in tree.search_nn_dist((4, 1), 2))
+        [(5, 0)]
         """
 
         if best is None:
             best = []
 
-        # consider the current node
-        if self.dist(point) < distance:
-            best.append(self)
+        max_d = distance * distance
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.data is None:
+                continue
 
-        # sort the children, nearer one first (is this really necessairy?)
-        children = sorted(self.children, key=lambda c_p1: c_p1[0].dist(point))
+            if node.dist(point) < max_d:
+                best.append(node)
 
-        for child, p in children:
-            # check if child node needs to be recursed
-            if self.axis_dist(point, self.axis) < math.pow(distance, 2):
-                child.search_nn_dist(point, distance, best)
+            # the left subtree holds points at or below the split, and the
+            # right subtree points at or above it
+            plane_dist = point[node.axis] - node.data[node.axis]
+            if node.left is not None and plane_dist < distance:
+                stack.append(node.left)
+            if node.right is not None and plane_dist > -distance:
+                stack.append(node.right)
 
         return best
 
@@ -557,12 +643,327 @@ def create(point_list=None, dimensions=None, axis=0, sel_axis=None):
     point_list.sort(key=lambda point: point[axis])
     median = len(point_list) // 2
 
+    # pass sel_axis down, so the whole tree shares one function rather than
+    # each node holding its own lambda
     loc   = point_list[median]
-    left  = create(point_list[:median], dimensions, sel_axis(axis))
-    right = create(point_list[median + 1:], dimensions, sel_axis(axis))
+    left  = create(point_list[:median], dimensions, sel_axis(axis), sel_axis)
+    right = create(point_list[median + 1:], dimensions, sel_axis(axis), sel_axis)
     return KDNode(loc, left, right, axis=axis, sel_axis=sel_axis, dimensions=dimensions)
 
 
+def create_bulk(point_list=None, xs=None, ys=None):
+    """ Creates a static 2-d kd-tree in flat arrays
+    Either a list of 2-d points or separate xs and ys coordinate sequences
+    must be given. The indexes are sorted once on each axis, and each index
+    range is split at the median of its split axis, partitioning the other
+    axis' order stably, so building takes O(n log n). This works from an
+    explicit stack so there is no recursion. The tree is stored implicitly
+    (see ImplicitKDTree), so no node objects are created.
+    >>> tree = create_bulk([(1, 2), (3, 4), (5, 6), (7, 8)])
+    >>> len(tree)
+    4
+    >>> tree.is_valid()
+    True
+    """
+
+    if point_list is not None:
+        check_dimensionality(point_list, 2)
+        xs = [p[0] for p in point_list]
+        ys = [p[1] for p in point_list]
+    elif xs is None or ys is None:
+        raise ValueError('either point_list or xs and ys must be provided')
+    elif len(xs) != len(ys):
+        raise ValueError('xs and ys must be the same length')
+    else:
+        xs = list(xs)
+        ys = list(ys)
+
+    n = len(xs)
+    # the indexes sorted on each axis. Every index range holds the same
+    # points in both, so the median of a range is read off its split axis
+    # order, and the other order is partitioned around it keeping its sort.
+    orders = [sorted(range(n), key=xs.__getitem__),
+              sorted(range(n), key=ys.__getitem__)]
+    left_side = bytearray(n)
+    stack = [(0, n, 0)]
+    while stack:
+        lo, hi, axis = stack.pop()
+        if hi - lo < 2:
+            continue
+        split_order, other = orders[axis], orders[1 - axis]
+        mid = (lo + hi) // 2
+        median = split_order[mid]
+        for i in split_order[lo:mid]:
+            left_side[i] = 1
+        left, right = [], []
+        for i in other[lo:hi]:
+            if left_side[i]:
+                left.append(i)
+                left_side[i] = 0
+            elif i != median:
+                right.append(i)
+        left.append(median)
+        left.extend(right)
+        other[lo:hi] = left
+        stack.append((lo, mid, 1 - axis))
+        stack.append((mid + 1, hi, 1 - axis))
+    # both orders now agree: each position holds its subtree's median
+    idx = orders[0]
+
+    return ImplicitKDTree(array('d', [xs[i] for i in idx]),
+                          array('d', [ys[i] for i in idx]),
+                          array('l', idx), point_list)
+
+
+class ImplicitKDTree(object):
+    """ A static 2-d kd-tree stored in flat arrays
+    Position p holds the point with original index idx[p] at (xs[p], ys[p]).
+    The subtree covering positions [lo, hi) has its root at
+    mid = (lo + hi) // 2, its left subtree at [lo, mid) and its right subtree
+    at [mid + 1, hi). The root splits on x, and the split axis alternates
+    with depth.
+    Search results refer to points by their index in the original point
+    list. If the tree was created from a point list, the points are
+    available as tree.points.
+    """
+
+    def __init__(self, xs, ys, idx, points=None):
+        self.xs = xs
+        self.ys = ys
+        self.idx = idx
+        self.points = points
+        # (minx, maxx, miny, maxy) of all points, where range searches start
+        self.bounds = (min(xs), max(xs), min(ys), max(ys)) if len(xs) else None
+
+
+    def __len__(self):
+        return len(self.idx)
+
+
+    def search_knn(self, point, k):
+        """ Return the k nearest neighbors of point and their distances
+        The result is a list of (point index, squared distance) tuples,
+        nearest first.
+        >>> tree = create_bulk([(0, 0), (5, 0), (5, 5)])
+        >>> tree.search_knn((1, 0), 2)
+        [(0, 1.0), (1, 16.0)]
+        """
+
+        results = self._search_knn_heap(point[0], point[1], k)
+        idx = self.idx
+        return [(idx[pos], -d) for d, pos in sorted(results, reverse=True)]
+
+
+    def search_knn_batch(self, xs, ys, k):
+        """ Return the k nearest neighbors of every query point (xs[i], ys[i])
+        The result is a (indexes, distances) tuple of flat arrays with k
+        entries per query point, nearest first: the neighbors of query i are
+        at [i * k:(i + 1) * k]. Distances are squared. If the tree has fewer
+        than k points, missing entries have index -1 and an infinite distance.
+        >>> tree = create_bulk([(0, 0), (5, 0), (5, 5)])
+        >>> indexes, dists = tree.search_knn_batch([0, 5], [0, 4], 2)
+        >>> list(indexes), list(dists)
+        ([0, 1, 2, 1], [0.0, 25.0, 1.0, 16.0])
+        """
+
+        if len(xs) != len(ys):
+            raise ValueError('xs and ys must be the same length')
+        out_idx = array('l', [-1]) * (len(xs) * k)
+        out_dist = array('d', [float('inf')]) * (len(xs) * k)
+        idx = self.idx
+        search = self._search_knn_heap
+        for q in range(len(xs)):
+            results = search(xs[q], ys[q], k)
+            results.sort(reverse=True)
+            out = q * k
+            for d, pos in results:
+                out_idx[out] = idx[pos]
+                out_dist[out] = -d
+                out += 1
+        return out_idx, out_dist
+
+
+    def _search_knn_heap(self, px, py, k):
+        """ Returns a heap of up to k (-squared distance, position) tuples """
+
+        xs, ys = self.xs, self.ys
+        results = []
+        worst = float('inf')
+        stack = [(0, len(xs), 0, 0.0)]
+        while stack:
+            lo, hi, axis, plane_dist2 = stack.pop()
+            if lo >= hi or plane_dist2 > worst:
+                continue
+            mid = (lo + hi) // 2
+            dx = xs[mid] - px
+            dy = ys[mid] - py
+            d = dx * dx + dy * dy
+            if len(results) < k:
+                heapq.heappush(results, (-d, mid))
+                if len(results) == k:
+                    worst = -results[0][0]
+            elif d < worst:
+                heapq.heapreplace(results, (-d, mid))
+                worst = -results[0][0]
+            plane_dist = dx if axis == 0 else dy
+            # push the far side first, so the near side is searched first
+            if plane_dist > 0:
+                stack.append((mid + 1, hi, 1 - axis, plane_dist * plane_dist))
+                stack.append((lo, mid, 1 - axis, 0.0))
+            else:
+                stack.append((lo, mid, 1 - axis, plane_dist * plane_dist))
+                stack.append((mid + 1, hi, 1 - axis, 0.0))
+        return results
+
+
+    def search_nn(self, point):
+        """ Search the nearest point to the given point
+        The result is a (point index, squared distance) tuple, or None if
+        the tree is empty.
+        """
+
+        return next(iter(self.search_knn(point, 1)), None)
+
+
+    def search_nn_dist(self, point, distance):
+        """ Return the indexes of all points closer than distance to point
+        distance is a plain (not squared) distance.
+        >>> tree = create_bulk([(0, 0), (5, 0), (5, 5)])
+        >>> sorted(tree.search_nn_dist((4, 1), 2))
+        [1]
+        """
+
+        max_d = distance * distance
+        indexes, dists = self.search_range(point, distance)
+        return [i for i, d in zip(indexes, dists) if d < max_d]
+
+
+    def search_range(self, point, distance):
+        """ Find all points within distance of point, including those at
+        exactly distance
+        Returns (indexes, distances) arrays, in no particular order.
+        distance is a plain distance, the returned distances are squared.
+        Each subtree's bounding box is narrowed at every split on the way
+        down. Subtrees whose box is out of range are skipped, and subtrees
+        whose box is entirely in range are taken without testing each
+        point's distance against the range.
+        >>> tree = create_bulk([(0, 0), (5, 0), (5, 5), (1, 1)])
+        >>> indexes, dists = tree.search_range((4, 1), 3)
+        >>> sorted(zip(indexes, dists))
+        [(1, 2.0), (3, 9.0)]
+        """
+
+        xs, ys, idx = self.xs, self.ys, self.idx
+        px, py = point[0], point[1]
+        max_d = distance * distance
+        out_idx = array('l')
+        out_dist = array('d')
+        if not xs:
+            return out_idx, out_dist
+        minx, maxx, miny, maxy = self.bounds
+        stack = [(0, len(xs), 0, minx, maxx, miny, maxy)]
+        while stack:
+            lo, hi, axis, minx, maxx, miny, maxy = stack.pop()
+            # distance from the point to the nearest and farthest points of
+            # the subtree's box
+            gx = minx - px if px < minx else (px - maxx if px > maxx else 0.0)
+            gy = miny - py if py < miny else (py - maxy if py > maxy else 0.0)
+            if gx * gx + gy * gy > max_d:
+                continue
+            fx = max(px - minx, maxx - px)
+            fy = max(py - miny, maxy - py)
+            if fx * fx + fy * fy <= max_d:
+                for p in range(lo, hi):
+                    dx = xs[p] - px
+                    dy = ys[p] - py
+                    out_idx.append(idx[p])
+                    out_dist.append(dx * dx + dy * dy)
+                continue
+            mid = (lo + hi) // 2
+            dx = xs[mid] - px
+            dy = ys[mid] - py
+            d = dx * dx + dy * dy
+            if d <= max_d:
+                out_idx.append(idx[mid])
+                out_dist.append(d)
+            if axis == 0:
+                split = xs[mid]
+                if lo < mid:
+                    stack.append((lo, mid, 1, minx, split, miny, maxy))
+                if mid + 1 < hi:
+                    stack.append((mid + 1, hi, 1, split, maxx, miny, maxy))
+            else:
+                split = ys[mid]
+                if lo < mid:
+                    stack.append((lo, mid, 0, minx, maxx, miny, split))
+                if mid + 1 < hi:
+                    stack.append((mid + 1, hi, 0, minx, maxx, split, maxy))
+        return out_idx, out_dist
+
+
+    def query_pairs(self, max_dist_squared):
+        """ Find all pairs of points within max_dist_squared of each other
+        Returns (firsts, seconds, distances) arrays, one entry per pair,
+        where firsts[i] < seconds[i] are point indexes and distances are
+        squared.
+        >>> tree = create_bulk([(0, 0), (0, 0), (1, 0), (5, 5)])
+        >>> firsts, seconds, dists = tree.query_pairs(1)
+        >>> sorted(zip(firsts, seconds))
+        [(0, 1), (0, 2), (1, 2)]
+        """
+
+        xs, ys, idx = self.xs, self.ys, self.idx
+        n = len(xs)
+        firsts = array('l')
+        seconds = array('l')
+        dists = array('d')
+        max_dist = math.sqrt(max_dist_squared)
+        for q in range(n):
+            px, py, q_idx = xs[q], ys[q], idx[q]
+            stack = [(0, n, 0)]
+            while stack:
+                lo, hi, axis = stack.pop()
+                if lo >= hi:
+                    continue
+                mid = (lo + hi) // 2
+                dx = xs[mid] - px
+                dy = ys[mid] - py
+                d = dx * dx + dy * dy
+                # each pair is found from both ends, keep one of them
+                if d <= max_dist_squared and q_idx < idx[mid]:
+                    firsts.append(q_idx)
+                    seconds.append(idx[mid])
+                    dists.append(d)
+                plane_dist = dx if axis == 0 else dy
+                if plane_dist >= -max_dist:
+                    stack.append((lo, mid, 1 - axis))
+                if plane_dist <= max_dist:
+                    stack.append((mid + 1, hi, 1 - axis))
+        return firsts, seconds, dists
+
+
+    def is_valid(self):
+        """ Checks that every position splits its subtree correctly """
+
+        xs, ys = self.xs, self.ys
+        stack = [(0, len(xs), 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if hi - lo < 2:
+                continue
+            mid = (lo + hi) // 2
+            coords = xs if axis == 0 else ys
+            split = coords[mid]
+            if any(coords[p] > split for p in range(lo, mid)):
+                return False
+            if any(coords[p] < split for p in range(mid + 1, hi)):
+                return False
+            stack.append((lo, mid, 1 - axis))
+            stack.append((mid + 1, hi, 1 - axis))
+        return True
+
+
+
 def check_dimensionality(point_list, dimensions=None):
     dimensions = dimensions or len(point_list[0])
     for p in point_list:
@@ -625,4 +1026,130 @@ def visualize(tree, max_level=100, node_width=10, left_padding=5):
             break
 
     print()
-    print()
\ No newline at end of file
+    print()
+
+
+
+class CreateBulkTests(unittest.TestCase):
+    def check_invariant(self, tree):
+        """ Every point left of a split is <= it and every point right of it
+            is >= it, on both axes
+        """
+        stack = [(0, len(tree), 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if hi - lo < 2:
+                continue
+            mid = (lo + hi) // 2
+            coords = tree.xs if axis == 0 else tree.ys
+            for p in range(lo, mid):
+                self.assertLessEqual(coords[p], coords[mid])
+            for p in range(mid + 1, hi):
+                self.assertGreaterEqual(coords[p], coords[mid])
+            stack.append((lo, mid, 1 - axis))
+            stack.append((mid + 1, hi, 1 - axis))
+
+    def test_random_points(self):
+        rng = random.Random(3)
+        points = [(rng.uniform(-180, 180), rng.uniform(-90, 90)) for _ in range(5000)]
+        tree = create_bulk(points)
+        self.check_invariant(tree)
+        self.assertEqual(sorted(tree.idx), list(range(len(points))))
+        for p, i in enumerate(tree.idx):
+            self.assertEqual((tree.xs[p], tree.ys[p]), points[i])
+
+    def test_duplicates(self):
+        rng = random.Random(4)
+        xs = [rng.randint(0, 10) for _ in range(3000)]
+        ys = [rng.randint(0, 3) for _ in range(3000)]
+        tree = create_bulk(xs=xs, ys=ys)
+        self.check_invariant(tree)
+        self.assertEqual(sorted(tree.idx), list(range(3000)))
+
+
+class RangeSearchTests(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(1)
+        # clumped points on a coarse grid, so there are duplicates and ties
+        self.points = [(rng.randint(0, 40) * 0.25, rng.randint(0, 40) * 0.25)
+                       for _ in range(500)]
+        self.queries = [(rng.uniform(-1, 11), rng.uniform(-1, 11)) for _ in range(50)]
+        self.queries.extend(self.points[:10])
+
+    def brute_range(self, point, distance, strict=False):
+        found = []
+        for i, (x, y) in enumerate(self.points):
+            dx = x - point[0]
+            dy = y - point[1]
+            d = dx * dx + dy * dy
+            if d < distance * distance or (d == distance * distance and not strict):
+                found.append((i, d))
+        return found
+
+    def test_search_range_matches_brute_force(self):
+        tree = create_bulk(self.points)
+        for point in self.queries:
+            for distance in [0, 0.25, 1, 3, 20]:
+                indexes, dists = tree.search_range(point, distance)
+                self.assertEqual(sorted(zip(indexes, dists)),
+                                 self.brute_range(point, distance))
+
+    def test_implicit_search_nn_dist(self):
+        tree = create_bulk(self.points)
+        for point in self.queries:
+            expected = [i for i, d in self.brute_range(point, 1, strict=True)]
+            self.assertEqual(sorted(tree.search_nn_dist(point, 1)), expected)
+
+    def test_node_search_nn_dist(self):
+        tree = create(list(self.points))
+        for point in self.queries:
+            for distance in [0.25, 1, 3]:
+                found = sorted(n.data for n in tree.search_nn_dist(point, distance))
+                expected = sorted(self.points[i]
+                                  for i, d in self.brute_range(point, distance, strict=True))
+                self.assertEqual(found, expected)
+
+    def test_empty(self):
+        indexes, dists = create_bulk(xs=[], ys=[]).search_range((0, 0), 1)
+        self.assertEqual((len(indexes), len(dists)), (0, 0))
+        self.assertEqual(create(dimensions=2).search_nn_dist((0, 0), 1), [])
+
+
+class KnnSearchTests(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(2)
+        # clumped points, so there are many equal distances
+        self.points = [(rng.randint(0, 20) * 0.5, rng.randint(0, 20) * 0.5)
+                       for _ in range(300)]
+        self.queries = [(rng.uniform(-1, 11), rng.uniform(-1, 11)) for _ in range(30)]
+        self.queries.extend(self.points[:10])
+
+    def assert_same_as_search_knn(self, tree):
+        for point in self.queries:
+            for k in [1, 2, 7, 400]:
+                expected = tree.search_knn(point, k)
+                found = tree.search_knn_2d(point, k)
+                self.assertEqual([id(n) for n, d in found], [id(n) for n, d in expected])
+                # search_knn squares with math.pow, which can differ in the
+                # last place
+                for (_, d), (_, e) in zip(found, expected):
+                    self.assertAlmostEqual(d, e, places=12)
+
+    def test_same_as_search_knn(self):
+        self.assert_same_as_search_knn(create(list(self.points)))
+
+    def test_tree_built_by_adding(self):
+        tree = create(dimensions=2)
+        for point in self.points:
+            tree.add(point)
+        self.assert_same_as_search_knn(tree)
+
+    def test_edge_cases(self):
+        tree = create(list(self.points))
+        self.assertEqual(tree.search_knn_2d((0, 0), 0), [])
+        self.assertEqual(create(dimensions=2).search_knn_2d((0, 0), 3), [])
+        self.assertRaises(ValueError, create([(0, 0, 0)]).search_knn_2d, (0, 0), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+""" On-disk cache of parsed kml files
+
+Parsed placemarks are stored as binary PlacemarkStores, keyed by a hash of
+the kml file's content and the placemark limit. Anything applied after
+parsing (bbox, output format) doesn't affect the key, so converting the
+same kml to several outputs only parses it once. The least recently used
+entries are removed once the cache grows past its size limit.
+"""
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import placemark_store
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+    'vicroads_graph_search')
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_EXTENSION = '.pms'
+
+
+def cached_store(kml_path, limit, parse, cache_dir=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES):
+    """ Returns the PlacemarkStore for kml_path and limit from the cache, or
+        calls parse(kml_path, limit) and caches its result
+    """
+    path = os.path.join(cache_dir, cache_key(kml_path, limit) + CACHE_EXTENSION)
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as ifile:
+                store = placemark_store.read_store(ifile)
+            # mark as recently used
+            os.utime(path, None)
+            return store
+        except (ValueError, EOFError):
+            # old or corrupt cache file, replace it
+            os.remove(path)
+    store = parse(kml_path, limit)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as ofile:
+        placemark_store.write_store(ofile, store)
+    os.replace(tmp_path, path)
+    evict(cache_dir, max_bytes)
+    return store
+
+
+def cache_key(kml_path, limit=None):
+    """ sha256 of the file content, plus the limit """
+    sha = hashlib.sha256()
+    with open(kml_path, 'rb') as ifile:
+        for chunk in iter(lambda: ifile.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return '{}-{}'.format(sha.hexdigest(), limit if limit else 'all')
+
+
+def cache_entries(cache_dir):
+    """ Returns [(mtime, size, path)] of all cache files, oldest first """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(CACHE_EXTENSION):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return sorted(entries)
+
+
+def evict(cache_dir, max_bytes):
+    """ Remove the least recently used cache files until the cache is no
+        bigger than max_bytes
+    """
+    entries = cache_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+
+def clear(cache_dir=DEFAULT_CACHE_DIR):
+    """ Remove all cached files """
+    for _, _, path in cache_entries(cache_dir):
+        os.remove(path)
+
+
+class KmlCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        self.kml_path = os.path.join(self.dir, 'roads.kml')
+        with open(self.kml_path, 'w') as ofile:
+            ofile.write('<kml></kml>')
+        self.parses = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self, kml_path, limit):
+        self.parses += 1
+        store = placemark_store.PlacemarkStore()
+        store.append([1, 2], [3, 4], 'road')
+        return store
+
+    def test_second_load_is_cached(self):
+        first = cached_store(self.kml_path, None, self.parse, self.cache_dir)
+        second = cached_store(self.kml_path, None, self.parse, self.cache_dir)
+        self.assertEqual(self.parses, 1)
+        self.assertEqual(list(second[0].latlons()), list(first[0].latlons()))
+
+    def test_key_depends_on_content_and_limit(self):
+        cached_store(self.kml_path, None, self.parse, self.cache_dir)
+        cached_store(self.kml_path, 10, self.parse, self.cache_dir)
+        with open(self.kml_path, 'w') as ofile:
+            ofile.write('<kml> </kml>')
+        cached_store(self.kml_path, None, self.parse, self.cache_dir)
+        self.assertEqual(self.parses, 3)
+
+    def test_eviction_and_clear(self):
+        cached_store(self.kml_path, 1, self.parse, self.cache_dir)
+        cached_store(self.kml_path, 2, self.parse, self.cache_dir, max_bytes=1)
+        self.assertEqual(len(cache_entries(self.cache_dir)), 0)
+        cached_store(self.kml_path, 1, self.parse, self.cache_dir)
+        clear(self.cache_dir)
+        self.assertEqual(cache_entries(self.cache_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
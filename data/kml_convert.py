@@ -3,38 +3,131 @@
 
 import argparse
 import csv
+import io
 import json
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import unittest
 import xml.etree.ElementTree as etree
-
+from array import array
+
+import contraction_hierarchy
+import graph_file
+import graph_simplify
+import graph_tiles
+import json_stream
+import kml_cache
+import landmarks
 import placemark_graph
+import placemark_store
+
+
+OUTPUT_EXTENSIONS = ['.json', '.csv', '.graph.bin', '.graph.js', '.js', '.tiles']
 
 
 def main():
     args = parse_args()
-    placemarks = kml_2_placemarks(args.kml, args.limit)
+    unknown = [out for out in args.out if not any(out.endswith(ext) for ext in OUTPUT_EXTENSIONS)]
+    if unknown:
+        print('unknown output extension: ' + ', '.join(unknown))
+        return
+    if args.clear_cache:
+        kml_cache.clear(args.cache_dir)
+
+    def parse(kml_path, limit):
+        # parallel parsing reads every chunk, so a limit is read serially
+        if args.jobs > 1 and not limit:
+            return kml_2_placemark_store_parallel(kml_path, args.jobs)
+        return kml_2_placemark_store(kml_path, limit)
+
+    if args.no_cache:
+        placemarks = parse(args.kml, args.limit)
+    else:
+        placemarks = kml_cache.cached_store(args.kml, args.limit, parse,
+                                            args.cache_dir, args.cache_size * 1024 * 1024)
     if args.bbox:
         placemarks = filter_placemarks_bbox(placemarks, args.bbox)
-    if args.out.endswith('.json'):
-        placemarks_to_json(placemarks, args.out, args.pretty)
-    elif args.out.endswith('.csv'):
-        placemarks_2_csv(placemarks, args.out)
-    elif args.out.endswith('.graph.js'):
-        placemarks_to_js_graph(placemarks, args.out, args.pretty)
-    elif args.out.endswith('.js'):
-        placemarks_to_js(placemarks, args.out, args.pretty)
-    else:
-        print('unknown output extension')
+    write_outputs(placemarks, args.out, args.pretty, args.simplify, args.tile_nodes,
+                  args.landmarks, args.contraction_hierarchy)
+
+
+def write_outputs(placemarks, outpaths, pretty=False, simplify=False,
+                  tile_nodes=graph_tiles.DEFAULT_MAX_NODES, num_landmarks=0,
+                  hierarchy=False):
+    """ Write placemarks to each output path, in the format given by its
+        extension. The road graph is built at most once, and shared by all
+        graph outputs. A .tiles output is a directory of graph tiles, see
+        graph_tiles. If num_landmarks is set, ALT landmark distances are
+        written next to each .graph.bin output, see landmarks. Likewise for
+        a contraction hierarchy if hierarchy is set, see
+        contraction_hierarchy.
+    """
+    graph = None
+    alt = None
+    ch = None
+    for out in outpaths:
+        if out.endswith('.json'):
+            placemarks_to_json(placemarks, out, pretty)
+        elif out.endswith('.csv'):
+            placemarks_2_csv(placemarks, out)
+        elif out.endswith('.js') and not out.endswith('.graph.js'):
+            placemarks_to_js(placemarks, out, pretty)
+        else:
+            if graph is None:
+                graph = placemarks_to_csr_graph(placemarks, simplify)
+            if out.endswith('.graph.bin'):
+                graph_file.write_graph(out, graph)
+                if num_landmarks:
+                    if alt is None:
+                        alt = landmarks.select_farthest(graph, num_landmarks)
+                    landmarks.write_landmarks(landmarks.landmarks_path(out), alt, len(graph))
+                if hierarchy:
+                    if ch is None:
+                        ch = contraction_hierarchy.build(graph)
+                    contraction_hierarchy.write_hierarchy(
+                        contraction_hierarchy.hierarchy_path(out), ch)
+            elif out.endswith('.graph.js'):
+                graph_to_js(graph, out, pretty)
+            elif out.endswith('.tiles'):
+                graph_tiles.write_tiles(out, graph, tile_nodes)
 
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser(
-        description='Convert vicroads kml data to csv, js, json')
+        description='Convert vicroads kml data to csv, js, json, graph.bin, tiles')
     parser.add_argument('kml', help='vicroads kml data file')
-    parser.add_argument('out', help='output path. Format determined by output extension')
+    parser.add_argument('out', nargs='+',
+                        help='output paths. Format determined by output extension')
     parser.add_argument('-l', '--limit', type=int, help='limit the numer of output placemarks')
     parser.add_argument('-p', '--pretty', action='store_true', help='pretty print (js(on) only)')
     parser.add_argument('-b', '--bbox', type=float, nargs=4,
                         help='bounding box: [lat lon lat lon]. Points outside this box are removed')
+    parser.add_argument('-s', '--simplify', action='store_true',
+                        help='merge chains of degree 2 nodes (graph.js, graph.bin, tiles only). '
+                             'The merged nodes are kept as edge geometry')
+    parser.add_argument('--tile-nodes', type=int, default=graph_tiles.DEFAULT_MAX_NODES,
+                        help='maximum number of nodes per graph tile (tiles only). '
+                             'Default: %(default)s')
+    parser.add_argument('--landmarks', type=int, default=0,
+                        help='number of ALT landmarks to precompute, written next to the '
+                             'graph (graph.bin only)')
+    parser.add_argument('--contraction-hierarchy', action='store_true',
+                        help='precompute a contraction hierarchy, written next to the '
+                             'graph (graph.bin only)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to parse the kml with (ignored with --limit)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the parsed kml cache")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='empty the parsed kml cache before converting')
+    parser.add_argument('--cache-dir', default=kml_cache.DEFAULT_CACHE_DIR,
+                        help='parsed kml cache directory. Default: %(default)s')
+    parser.add_argument('--cache-size', type=int,
+                        default=kml_cache.DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='maximum parsed kml cache size in MB. Default: %(default)s')
     if args is None:
         return parser.parse_args()
     else:
@@ -44,64 +137,224 @@ def parse_args(args=None):
 def placemarks_2_csv(placemarks, csv_path):
     """ convert vicroads kml data file to csv file """
     with open(csv_path, 'w') as csvfile:
-        fieldnames = ['declared_name', 'lat', 'lon']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
+        writer = csv.writer(csvfile)
+        writer.writerow(['declared_name', 'lat', 'lon'])
         for placemark in placemarks:
-            for point in placemark.points:
-                writer.writerow({"declared_name": placemark.declared_name,
-                                 "lat": point.lat, "lon": point.lon})
+            # one batch of rows per placemark
+            name = placemark.declared_name
+            writer.writerows([(name, lat, lon) for lat, lon in placemark.latlons()])
 
 
 def kml_2_placemarks(kml_path, limit=None):
     """ Parse vicroads kml into a list of Placemarks
+        The kml is parsed incrementally: each Placemark element is converted
+        then dropped from the tree, so memory use doesn't grow with file size.
+        Reading stops once limit placemarks have been yielded.
         Returns: Placemark iterator
     """
-    kmltree = etree.parse(kml_path).getroot()
-
     i = 0
-    for p in kmltree.iter('Placemark'):
+    for p in iter_placemark_elements(kml_path):
         i += 1
         if limit and i > limit:
             break
         yield placemark_e2obj(p)
 
 
+def kml_2_placemark_store(kml_path, limit=None):
+    """ Parse vicroads kml into a PlacemarkStore. Points are written straight
+        into the store's coordinate arrays, no Point objects are created.
+    """
+    store = placemark_store.PlacemarkStore()
+    i = 0
+    for p in iter_placemark_elements(kml_path):
+        i += 1
+        if limit and i > limit:
+            break
+        placemark_e2store(p, store)
+    return store
+
+
+def kml_2_placemark_store_parallel(kml_path, jobs, chunks_per_job=4):
+    """ Parse vicroads kml into a PlacemarkStore using a pool of jobs
+        processes. The file is split into chunks of whole Placemarks, which
+        are parsed separately and joined back in file order, so node indexes
+        are the same as a serial parse. Workers send back their stores in
+        write_store's binary form rather than pickled objects.
+    """
+    chunks = placemark_chunks(kml_path, jobs * chunks_per_job)
+    tasks = [(kml_path, start, end) for start, end in chunks]
+    with multiprocessing.Pool(jobs) as pool:
+        results = pool.map(parse_placemark_chunk, tasks)
+    return placemark_store.concat(
+        placemark_store.read_store(io.BytesIO(result)) for result in results)
+
+
+def placemark_chunks(kml_path, num_chunks):
+    """ Split a kml file into at most num_chunks (start, end) byte ranges,
+        each holding only complete Placemark elements
+    """
+    with open(kml_path, 'rb') as ifile:
+        data = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        starts = []
+        for i in range(num_chunks):
+            start = find_placemark_start(data, len(data) * i // num_chunks)
+            if start < 0:
+                break
+            if not starts or start > starts[-1]:
+                starts.append(start)
+        chunks = []
+        for i, start in enumerate(starts):
+            limit = starts[i + 1] if i + 1 < len(starts) else len(data)
+            end = data.rfind(b'</Placemark>', start, limit)
+            chunks.append((start, end + len(b'</Placemark>')))
+    return chunks
+
+
+def find_placemark_start(data, pos):
+    """ Position of the next '<Placemark' tag at or after pos, or -1 """
+    while True:
+        pos = data.find(b'<Placemark', pos)
+        if pos < 0 or data[pos + 10:pos + 11] in (b'>', b' ', b'\t', b'\r', b'\n'):
+            return pos
+        pos += 1
+
+
+def parse_placemark_chunk(task):
+    """ Parse the Placemarks in a byte range of a kml file. Returns the
+        placemarks as a binary PlacemarkStore.
+    """
+    kml_path, start, end = task
+    with open(kml_path, 'rb') as ifile:
+        head = ifile.read(256)
+        ifile.seek(start)
+        chunk = ifile.read(end - start)
+    # keep the xml declaration, it may give the file's encoding
+    declaration = b''
+    if head.startswith(b'<?xml') and b'?>' in head:
+        declaration = head[:head.find(b'?>') + 2]
+    xml = io.BytesIO(declaration + b'<chunk>' + b''.join(placemark_slices(chunk)) + b'</chunk>')
+    store = placemark_store.PlacemarkStore()
+    for p in iter_placemark_elements(xml):
+        placemark_e2store(p, store)
+    out = io.BytesIO()
+    placemark_store.write_store(out, store)
+    return out.getvalue()
+
+
+def placemark_slices(chunk):
+    """ Yield each complete <Placemark>...</Placemark> in a chunk of kml
+        bytes, leaving out anything between them, such as the start and end
+        tags of the Folders that hold them
+    """
+    pos = 0
+    while True:
+        start = find_placemark_start(chunk, pos)
+        if start < 0:
+            return
+        end = chunk.find(b'</Placemark>', start)
+        if end < 0:
+            return
+        pos = end + len(b'</Placemark>')
+        yield chunk[start:pos]
+
+
+def iter_placemark_elements(kml_path):
+    """ Yield complete Placemark xml elements from a kml file, freeing each
+        one (and detaching it from its parent) once the consumer is done
+        with it
+    """
+    parents = []
+    for event, elem in etree.iterparse(kml_path, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == 'Placemark':
+            yield elem
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+
+
 def placemarks_to_json(placemarks, outpath, pretty=False):
     """ Write placemarks to json file """
     with open(outpath, 'w') as ofile:
-        ofile.write(placemarks_to_json_str(placemarks, pretty))
+        write_placemarks_json(ofile, placemarks, pretty)
 
 
 def placemarks_to_json_str(placemarks, pretty=False):
     """ Return list of placemarks as a json string """
-    placemark_dicts = [p.to_jsondict() for p in placemarks]
+    buf = io.StringIO()
+    write_placemarks_json(buf, placemarks, pretty)
+    return buf.getvalue()
+
+
+def write_placemarks_json(ofile, placemarks, pretty=False):
+    """ Write placemarks as a json list to a text file object, one placemark
+        at a time
+    """
     indent = '\t' if pretty else None
-    return json.dumps(placemark_dicts, indent=indent)
+    json_stream.write_array(ofile, (p.to_jsondict() for p in placemarks), indent)
 
 
 def placemarks_to_js(placemarks, outpath, pretty=False, var_name='roads_data'):
     """ Write list of placemarks to a js variable in a file """
     with open(outpath, 'w') as ofile:
         ofile.write('let {} = '.format(var_name))
-        ofile.write(placemarks_to_json_str(placemarks, pretty))
+        write_placemarks_json(ofile, placemarks, pretty)
 
-def placemarks_to_js_graph(placemarks, outpath, pretty=False, var_name='roads_graph'):
+def placemarks_to_js_graph(placemarks, outpath, pretty=False, var_name='roads_graph',
+                           simplify=False):
     """ Write a js data variable of nodes and edges:
-        {'nodes': [(lat, lon), ...], 'edges': [(0, 1), (1, 0), ...]}
-    """
-    nodes = placemark_graph.placemarks_to_graph(placemarks)
-    graph = {'nodes': [], 'edges': []}
-    node_idx = 0
-    for node in nodes:
-        graph['nodes'].append(node.xy)
-        for a in node.adjacent:
-            graph['edges'].append((node_idx, a))
-        node_idx += 1
+        {'nodes': [(lon, lat), ...], 'edges': [(0, 1), (1, 2), ...]}
+        Each edge is written once, the js adds both directions.
+        If simplify is set, chains of degree 2 nodes are merged into single
+        edges, and 'paths': [[(lon, lat), ...], ...] holds the merged nodes
+        of each edge.
+    """
+    graph_to_js(placemarks_to_csr_graph(placemarks, simplify), outpath, pretty, var_name)
+
+
+def graph_to_js(csr, outpath, pretty=False, var_name='roads_graph'):
+    """ Write a csr_graph.CSRGraph as a js variable, see placemarks_to_js_graph.
+        If the graph has edge geometry, 'paths' holds the [lon, lat] shape
+        points of each edge, from its first node to its second.
+    """
     with open(outpath, 'w') as ofile:
         ofile.write('let {} = '.format(var_name))
         indent = '\t' if pretty else None
-        ofile.write(json.dumps(graph, indent=indent))
+        arrays = [('nodes', zip(csr.lons, csr.lats)),
+                  ('edges', csr.undirected_edges())]
+        if csr.geometry is not None:
+            arrays.append(('paths', edge_paths(csr)))
+        json_stream.write_object_of_arrays(ofile, arrays, indent)
+
+
+def edge_paths(csr):
+    """ Yield the (lon, lat) shape points of each edge of a graph with
+        geometry, in the order of csr.undirected_edges()
+    """
+    offsets, targets, geometry = csr.offsets, csr.targets, csr.geometry
+    for i in range(len(csr)):
+        for e in range(offsets[i], offsets[i + 1]):
+            if targets[e] > i:
+                yield [(lon, lat) for lat, lon in geometry.points(e)]
+
+
+def placemarks_to_graph_bin(placemarks, outpath, simplify=False):
+    """ Write the road graph to a binary graph file. See graph_file for the
+        format.
+    """
+    graph_file.write_graph(outpath, placemarks_to_csr_graph(placemarks, simplify))
+
+
+def placemarks_to_csr_graph(placemarks, simplify=False):
+    """ Build the road graph, optionally merging chains of degree 2 nodes """
+    graph = placemark_graph.placemarks_to_csr(placemarks)
+    if simplify:
+        graph = graph_simplify.contract_degree_2(graph).graph
+    return graph
 
 
 def placemark_e2obj(placemark):
@@ -117,25 +370,108 @@ def placemark_e2obj(placemark):
     for coords in placemark.iter('coordinates'):
         if len(pm.points) > 0:
             raise Exception('more than one coordinate set in placemark with declared name: ' + pm.declared_name)
-        pm.points = list(coords_text_to_points(coords.text))
+        pm.points = points_from_arrays(*coords_text_to_arrays(coords.text))
     return pm
 
 
+def placemark_e2store(placemark, store):
+    """ Append a placemark xml element to a PlacemarkStore """
+    names = placemark_e2names(placemark)
+    coords = list(placemark.iter('coordinates'))
+    if len(coords) > 1:
+        raise Exception('more than one coordinate set in placemark with declared name: ' + names['DECLARED'])
+    lats, lons = coords_text_to_arrays(coords[0].text) if coords else ([], [])
+    store.append(lats, lons, names['DECLARED'], names['ROADNAME'], names['LOCALNAME'])
+
+
+def placemark_e2names(placemark):
+    """ Returns the DECLARED, ROADNAME and LOCALNAME values of a placemark
+        xml element as a dict
+    """
+    names = {'DECLARED': None, 'ROADNAME': None, 'LOCALNAME': None}
+    for sd in placemark.iter('SimpleData'):
+        if sd.attrib['name'] in names:
+            names[sd.attrib['name']] = sd.text
+    return names
+
+
+def coords_text_to_arrays(text):
+    """ Convert a list of coordinates (kml linestring) to (lats, lons) float
+        arrays. Coordinates are lon,lat or lon,lat,altitude. Altitudes are
+        dropped.
+        The whole block is decoded with a single split and float conversion,
+        then the lon and lat columns are sliced out. Each coordinate has one
+        comma fewer than it has values, so the number of coordinates is the
+        number of values less the number of commas.
+    """
+    if not text:
+        return array('d'), array('d')
+    values = array('d', map(float, text.replace(',', ' ').split()))
+    num_coords = len(values) - text.count(',')
+    if num_coords <= 0:
+        return array('d'), array('d')
+    dims, rest = divmod(len(values), num_coords)
+    if rest or dims not in (2, 3):
+        # a mix of 2d and 3d coordinates
+        lats = array('d')
+        lons = array('d')
+        for lonlat in text.split():
+            lonlat = lonlat.split(',')
+            lons.append(float(lonlat[0]))
+            lats.append(float(lonlat[1]))
+        return lats, lons
+    return values[1::dims], values[0::dims]
+
+
 def coords_text_to_points(text):
     """ Convert a list of coordinates (kml linestring) to a Point iterator """
     for lonlat in text.split():
-        lon, lat = lonlat.split(',')
+        lon, lat = lonlat.split(',')[:2]
         yield Point(lat=lat, lon=lon)
 
 
+def points_from_arrays(lats, lons):
+    """ List of Points from lat and lon float arrays. The values are floats
+        already, so Point's conversion is skipped.
+    """
+    new = Point.__new__
+    points = []
+    append = points.append
+    for lat, lon in zip(lats, lons):
+        point = new(Point)
+        point.lat = lat
+        point.lon = lon
+        append(point)
+    return points
+
+
 def filter_placemarks_bbox(placemarks, bbox):
     """ Remove points outside the bbox. If a placemark has no points, it is removed.
         bbox: [lat, lon, lat, lon]
+        Returns a new PlacemarkStore if given one, otherwise a Placemark iterator
+    """
+    minlat, maxlat, minlon, maxlon = bbox_bounds(bbox)
+    if isinstance(placemarks, placemark_store.PlacemarkStore):
+        return placemark_store.filter_store_bbox(placemarks, minlat, maxlat, minlon, maxlon)
+    return filter_placemark_objs_bbox(placemarks, minlat, maxlat, minlon, maxlon)
+
+
+def filter_placemarks_bboxes(placemarks, bboxes):
+    """ Extract several regions from the same placemarks, see
+        filter_placemarks_bbox. Returns a new PlacemarkStore per bbox.
     """
-    maxlat = max(bbox[0], bbox[2])
-    minlat = min(bbox[0], bbox[2])
-    maxlon = max(bbox[1], bbox[3])
-    minlon = min(bbox[1], bbox[3])
+    store = placemark_store.from_placemarks(placemarks)
+    return placemark_store.filter_store_bboxes(store, [bbox_bounds(b) for b in bboxes])
+
+
+def bbox_bounds(bbox):
+    """ Convert a [lat, lon, lat, lon] bbox to (minlat, maxlat, minlon, maxlon) """
+    return (min(bbox[0], bbox[2]), max(bbox[0], bbox[2]),
+            min(bbox[1], bbox[3]), max(bbox[1], bbox[3]))
+
+
+def filter_placemark_objs_bbox(placemarks, minlat, maxlat, minlon, maxlon):
+    """ Yield Placemark objects with their points outside the bounds removed """
     for p in placemarks:
         p.points = list(filter_points_bbox(p.points, minlat, maxlat, minlon, maxlon))
         if len(p.points) > 0:
@@ -159,10 +495,22 @@ class Placemark(object):
         self.alt_name = None
         self.alt_2_name = None
 
+    @property
+    def lats(self):
+        return [p.lat for p in self.points]
+
+    @property
+    def lons(self):
+        return [p.lon for p in self.points]
+
+    def latlons(self):
+        """ Iterator of (lat, lon) tuples """
+        return ((p.lat, p.lon) for p in self.points)
+
     def to_jsondict(self):
         return {
             "declared_name": self.declared_name,
-            "points": [(p.lat, p.lon) for p in self.points]
+            "points": list(self.latlons())
         }
 
     def __str__(self):
@@ -177,5 +525,228 @@ class Point:
         self.lon = float(lon)
 
 
+def make_test_kml(folders):
+    """ kml text for tests. folders: per Folder, a list of
+        (declared name, [(lon, lat), ...]) placemarks
+    """
+    parts = ['<?xml version="1.0" encoding="utf-8" ?>\n<kml><Document><name>roads</name>\n']
+    for f, placemarks in enumerate(folders):
+        parts.append('<Folder><name>folder {}</name>\n'.format(f))
+        for name, points in placemarks:
+            coords = ' '.join('{},{}'.format(lon, lat) for lon, lat in points)
+            parts.append(
+                '<Placemark><ExtendedData><SchemaData schemaUrl="#x">'
+                '<SimpleData name="DECLARED">{}</SimpleData>'
+                '<SimpleData name="ROADNAME">road {}</SimpleData>'
+                '</SchemaData></ExtendedData>'
+                '<LineString><coordinates>{}</coordinates></LineString></Placemark>\n'
+                .format(name, name, coords))
+        parts.append('</Folder>\n')
+    parts.append('</Document></kml>\n')
+    return ''.join(parts)
+
+
+class KmlTestCase(unittest.TestCase):
+    """ Writes kml test files into a temporary directory """
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write_kml(self, folders, name='roads.kml'):
+        path = os.path.join(self.dir.name, name)
+        with open(path, 'w') as ofile:
+            ofile.write(make_test_kml(folders))
+        return path
+
+    def assert_stores_equal(self, a, b):
+        self.assertEqual(list(a.offsets), list(b.offsets))
+        self.assertEqual(list(a.lats), list(b.lats))
+        self.assertEqual(list(a.lons), list(b.lons))
+        self.assertEqual([(p.declared_name, p.road_name, p.local_name) for p in a],
+                         [(p.declared_name, p.road_name, p.local_name) for p in b])
+
+
+class CountingReader(object):
+    """ Binary file wrapper that counts the bytes read from it """
+    def __init__(self, ifile):
+        self.ifile = ifile
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.ifile.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class IterPlacemarksTests(KmlTestCase):
+    def test_document_order_in_nested_containers(self):
+        placemark = '<Placemark><name>{}</name></Placemark>'
+        kml = ('<kml><Document>' + placemark.format(0) +
+               '<Folder><name>a</name>' + placemark.format(1) +
+               '<Folder>' + placemark.format(2) + placemark.format(3) + '</Folder>' +
+               placemark.format(4) + '</Folder>' +
+               '<Document><Folder>' + placemark.format(5) + '</Folder></Document>' +
+               placemark.format(6) + '</Document></kml>')
+        names = [p.find('name').text
+                 for p in iter_placemark_elements(io.BytesIO(kml.encode('utf-8')))]
+        self.assertEqual(names, [str(i) for i in range(7)])
+
+    def test_elements_are_cleared(self):
+        path = self.write_kml([[('a', [(1, 2), (3, 4)]), ('b', [(5, 6)])],
+                               [('c', [(7, 8)])]])
+        seen = []
+        for p in iter_placemark_elements(path):
+            # the previous placemark is freed by the time the next is yielded
+            self.assertTrue(all(len(prev) == 0 for prev in seen))
+            self.assertEqual(len(list(p.iter('coordinates'))), 1)
+            seen.append(p)
+        self.assertEqual(len(seen), 3)
+        self.assertTrue(all(len(p) == 0 and not p.attrib for p in seen))
+
+    def test_stops_reading_at_limit(self):
+        folders = [[('road {}'.format(i), [(144.9, -37.8), (144.91, -37.81)])
+                    for i in range(2000)]]
+        path = self.write_kml(folders)
+        with open(path, 'rb') as ifile:
+            reader = CountingReader(ifile)
+            placemarks = list(kml_2_placemarks(reader, limit=5))
+            self.assertEqual([p.declared_name for p in placemarks],
+                             ['road {}'.format(i) for i in range(5)])
+            self.assertLess(reader.bytes_read, os.path.getsize(path) // 4)
+        self.assertEqual(len(kml_2_placemark_store(path, limit=5)), 5)
+
+
+class CoordsDecodeTests(unittest.TestCase):
+    def decode(self, text):
+        lats, lons = coords_text_to_arrays(text)
+        return list(zip(lons, lats))
+
+    def test_2d(self):
+        self.assertEqual(self.decode('144.9,-37.8 145,-37.75'), [(144.9, -37.8), (145, -37.75)])
+
+    def test_3d(self):
+        self.assertEqual(self.decode('144.9,-37.8,0 145,-37.75,12.5'),
+                         [(144.9, -37.8), (145, -37.75)])
+
+    def test_mixed_2d_and_3d(self):
+        for text in ['144.9,-37.8,0 145,-37.75 145.1,-37.7,3',
+                     '1,2 3,4,5 6,7 8,9,10', '1,2,3 4,5']:
+            expected = [tuple(float(v) for v in c.split(',')[:2]) for c in text.split()]
+            self.assertEqual(self.decode(text), expected)
+
+    def test_whitespace(self):
+        text = '\n\t\t144.9,-37.8,0\n\t\t145,-37.75,0  \r\n 145.1,-37.7,0\n\t'
+        self.assertEqual(self.decode(text), [(144.9, -37.8), (145, -37.75), (145.1, -37.7)])
+        self.assertEqual(self.decode(' 1,2\n'), [(1, 2)])
+
+    def test_empty(self):
+        for text in [None, '', '  \n\t ']:
+            lats, lons = coords_text_to_arrays(text)
+            self.assertEqual((len(lats), len(lons)), (0, 0))
+
+    def test_same_as_points(self):
+        text = '144.9,-37.8,0 145,-37.75,0 145.1,-37.7,0'
+        lats, lons = coords_text_to_arrays(text)
+        points = points_from_arrays(lats, lons)
+        self.assertEqual([(p.lat, p.lon) for p in points],
+                         [(p.lat, p.lon) for p in coords_text_to_points(text)])
+
+
+class ParallelParseTests(KmlTestCase):
+    def test_parallel_matches_serial_across_folders(self):
+        # uneven folders, so chunks start and end in the middle of them
+        folders = [[('road {}.{}'.format(f, i),
+                     [(144.9 + 0.001 * i, -37.8 + 0.001 * f), (144.9 + 0.001 * i, -37.7)])
+                    for i in range(size)]
+                   for f, size in enumerate([7, 13, 1, 5, 14])]
+        path = self.write_kml(folders)
+        serial = kml_2_placemark_store(path)
+        self.assertEqual(len(serial), 40)
+        for jobs, chunks_per_job in [(2, 4), (4, 4), (3, 1)]:
+            parallel = kml_2_placemark_store_parallel(path, jobs, chunks_per_job)
+            self.assert_stores_equal(parallel, serial)
+
+    def test_placemark_slices_skip_containers(self):
+        chunk = (b'<Placemark><name>a</name></Placemark>\n</Folder>\n'
+                 b'<Folder><name>f</name><Placemark>b</Placemark></Folder></Document>')
+        self.assertEqual(list(placemark_slices(chunk)),
+                         [b'<Placemark><name>a</name></Placemark>', b'<Placemark>b</Placemark>'])
+
+
+class WriteOutputsTests(KmlTestCase):
+    OUTPUTS = ['roads.csv', 'roads.json', 'roads.js', 'roads.graph.js', 'roads.graph.bin',
+               'roads.tiles']
+
+    def read_output(self, path):
+        """ File contents, or for a directory, a dict of its files' contents """
+        if os.path.isdir(path):
+            return {name: self.read_output(os.path.join(path, name)) for name in os.listdir(path)}
+        with open(path, 'rb') as ifile:
+            return ifile.read()
+
+    def test_same_as_single_outputs(self):
+        path = self.write_kml([[('a', [(144.9, -37.8), (144.91, -37.8), (144.92, -37.8)]),
+                                ('b', [(144.91, -37.81), (144.91, -37.8)])]])
+        store = kml_2_placemark_store(path)
+        os.mkdir(os.path.join(self.dir.name, 'single'))
+        singles = []
+        for name in self.OUTPUTS:
+            out = os.path.join(self.dir.name, 'single', name)
+            write_outputs(store, [out], tile_nodes=2)
+            singles.append(self.read_output(out))
+
+        from unittest import mock
+        outs = [os.path.join(self.dir.name, name) for name in self.OUTPUTS]
+        module = sys.modules[__name__]
+        with mock.patch.object(module, 'placemarks_to_csr_graph',
+                                        wraps=module.placemarks_to_csr_graph) as build:
+            write_outputs(store, outs, tile_nodes=2)
+        self.assertEqual(build.call_count, 1)
+        for name, out, single in zip(self.OUTPUTS, outs, singles):
+            self.assertEqual(self.read_output(out), single, name)
+
+    def test_graph_not_built_without_graph_outputs(self):
+        path = self.write_kml([[('a', [(144.9, -37.8), (144.91, -37.8)])]])
+        outs = [os.path.join(self.dir.name, name) for name in ['roads.csv', 'roads.json']]
+        from unittest import mock
+        module = sys.modules[__name__]
+        with mock.patch.object(module, 'placemarks_to_csr_graph') as build:
+            write_outputs(kml_2_placemark_store(path), outs)
+        self.assertEqual(build.call_count, 0)
+        self.assertTrue(all(os.path.exists(out) for out in outs))
+
+
+class SimplifiedOutputTests(KmlTestCase):
+    def test_outputs_keep_edge_geometry(self):
+        # a road with shape points, crossed by another in the middle
+        road = [(144.90 + 0.001 * i, -37.8) for i in range(7)]
+        cross = [(144.903, -37.801), (144.903, -37.8), (144.903, -37.799)]
+        path = self.write_kml([[('a', road), ('b', cross)]])
+        bin_path = os.path.join(self.dir.name, 'roads.graph.bin')
+        js_path = os.path.join(self.dir.name, 'roads.graph.js')
+        write_outputs(kml_2_placemark_store(path), [bin_path, js_path], simplify=True)
+
+        graph = graph_file.load_graph(bin_path)
+        # the road and crossing ends, and a node of each road at the junction
+        self.assertEqual(len(graph), 6)
+        shape = set()
+        for e in range(len(graph.targets)):
+            shape.update((lon, lat) for lat, lon in graph.geometry.points(e))
+        self.assertEqual(shape | set(zip(graph.lons, graph.lats)), set(road) | set(cross))
+
+        with open(js_path) as ifile:
+            js_graph = json.loads(ifile.read()[len('let roads_graph = '):])
+        self.assertEqual(len(js_graph['paths']), len(js_graph['edges']))
+        paths = {}
+        for (a, b), points in zip(js_graph['edges'], js_graph['paths']):
+            ends = (tuple(js_graph['nodes'][a]), tuple(js_graph['nodes'][b]))
+            paths[ends] = [tuple(p) for p in points]
+            paths[ends[::-1]] = paths[ends][::-1]
+        self.assertEqual(paths[road[0], road[3]], road[1:3])
+        self.assertEqual(paths[road[6], road[3]], road[5:3:-1])
+
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
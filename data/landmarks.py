@@ -0,0 +1,262 @@
+""" ALT (A*, landmarks, triangle inequality) preprocessing for the road graph
+
+A few landmark nodes are chosen, and the shortest path distance from each
+landmark to every node is stored. Since the graph is undirected, for any
+landmark L, dist(v, t) >= |dist(L, t) - dist(L, v)|, which gives A* a much
+tighter lower bound than the straight line distance.
+
+Distances are stored as float32, in a file next to the graph file:
+
+    header (32 bytes):
+        magic           8 bytes     b'VRLMARKS'
+        version         uint32
+        num_landmarks   uint32
+        num_nodes       uint64
+        (zero padding)
+    landmarks   int32[num_landmarks]                node index of each landmark
+    (zero padding to 8 bytes)
+    dists       float32[num_landmarks * num_nodes]  dists[k * num_nodes + v] is
+                                                    the distance from landmark
+                                                    k to node v
+"""
+
+
+import os
+import struct
+import tempfile
+import unittest
+from array import array
+from collections import deque
+
+import csr_graph
+import graph_file
+import graph_search
+from geo import haversine
+
+
+MAGIC = b'VRLMARKS'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQ')
+HEADER_SIZE = 32
+DEFAULT_NUM_LANDMARKS = 8
+# distances are rounded to float32, with a relative error of at most 2^-24.
+# Bounds are reduced by this much of the distances they're made from, so
+# they never overestimate
+FLOAT32_SLACK = 1.2e-7
+
+
+class Landmarks(object):
+    """ landmarks: node index of each landmark
+        tables: per landmark, the distance from it to every node. Unreachable
+            nodes are infinitely far.
+    """
+    def __init__(self, landmarks, tables):
+        if len(landmarks) != len(tables):
+            raise ValueError('need one distance table per landmark')
+        self.landmarks = landmarks
+        self.tables = tables
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    def lower_bound(self, node, target, graph=None):
+        """ Lower bound on the distance from node to target """
+        return self.heuristic(target, graph)(node)
+
+    def heuristic(self, target, graph=None):
+        """ A* heuristic function for searches to target, see
+            graph_search.astar. Given the graph, bounds are never below the
+            great-circle distance, so ALT is never weaker than plain A*, even
+            where no landmark reaches the target.
+        """
+        inf = float('inf')
+        # landmarks that can't reach the target: nodes they do reach can't
+        # reach the target either
+        unreached = [table for table in self.tables if table[target] == inf]
+        reached = [(table, table[target]) for table in self.tables if table[target] != inf]
+        lats = lons = None
+        if graph is not None:
+            lats, lons = graph.lats, graph.lons
+            tlat, tlon = lats[target], lons[target]
+
+        def heuristic(node):
+            for table in unreached:
+                if table[node] != inf:
+                    return inf
+            best = 0.0
+            if lats is not None:
+                # scaled down as in graph_search.astar
+                best = haversine(lats[node], lons[node], tlat, tlon) * 0.999999
+            for table, to_target in reached:
+                d = table[node]
+                if d == inf:
+                    return inf
+                bound = abs(to_target - d) - (to_target + d) * FLOAT32_SLACK
+                if bound > best:
+                    best = bound
+            return best
+        return heuristic
+
+
+def select_farthest(graph, num_landmarks=DEFAULT_NUM_LANDMARKS, start=None):
+    """ Choose landmarks by farthest point selection: the first landmark is
+        the node farthest from start, and each next one is the node farthest
+        from all landmarks so far. Only start's connected component is
+        considered, which by default is the largest one.
+        Returns Landmarks, with their float32 distance tables.
+    """
+    graph = graph_search.prepare(graph)
+    if start is None:
+        start = largest_component(graph)[0] if len(graph) else 0
+    inf = float('inf')
+    dists, _ = graph_search.dijkstra_all(graph, start)
+    node = _farthest(dists)
+    nearest = array('d', [inf]) * len(graph)
+    landmarks = array('i')
+    tables = []
+    while len(landmarks) < num_landmarks and node >= 0:
+        dists, _ = graph_search.dijkstra_all(graph, node)
+        landmarks.append(node)
+        tables.append(array('f', dists))
+        for i, d in enumerate(dists):
+            if d < nearest[i]:
+                nearest[i] = d
+        node = _farthest(nearest)
+        if node >= 0 and nearest[node] == 0:
+            # every node in the component is already a landmark
+            node = -1
+    return Landmarks(landmarks, tables)
+
+
+def largest_component(graph):
+    """ Node indexes of the largest connected component """
+    component = array('l', [-1]) * len(graph)
+    best = []
+    for start in range(len(graph)):
+        if component[start] >= 0:
+            continue
+        component[start] = start
+        nodes = [start]
+        frontier = deque(nodes)
+        while frontier:
+            for neighbour in graph.neighbours(frontier.popleft()):
+                if component[neighbour] < 0:
+                    component[neighbour] = start
+                    nodes.append(neighbour)
+                    frontier.append(neighbour)
+        if len(nodes) > len(best):
+            best = nodes
+    return best
+
+
+def _farthest(dists):
+    """ Index of the largest finite distance, or -1 if there are none """
+    inf = float('inf')
+    best, best_dist = -1, -1.0
+    for i, d in enumerate(dists):
+        if d != inf and d > best_dist:
+            best, best_dist = i, d
+    return best
+
+
+def landmarks_path(graph_path):
+    """ Landmarks file path for a graph file, eg. roads.graph.bin ->
+        roads.landmarks.bin
+    """
+    if graph_path.endswith('.graph.bin'):
+        graph_path = graph_path[:-len('.graph.bin')]
+    return graph_path + '.landmarks.bin'
+
+
+def write_landmarks(path, landmarks, num_nodes):
+    """ Write Landmarks to a binary file """
+    header = HEADER.pack(MAGIC, VERSION, len(landmarks), num_nodes)
+    dists = array('f')
+    for table in landmarks.tables:
+        dists.extend(table)
+    with open(path, 'wb') as ofile:
+        ofile.write(header.ljust(HEADER_SIZE, b'\0'))
+        graph_file.write_blocks(ofile, [array('i', landmarks.landmarks), dists])
+
+
+def load_landmarks(path):
+    """ Memory-map a landmarks file. The distance tables are read-only views
+        of the file.
+    """
+    view = graph_file.map_file(path)
+    magic, version, num_landmarks, num_nodes = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError('{} is not a landmarks file'.format(path))
+    if version != VERSION:
+        raise ValueError('unsupported landmarks file version: {}'.format(version))
+    graph_file.check_mappable('landmarks files')
+    reader = graph_file.BlockReader(view, HEADER_SIZE)
+    landmarks = reader.block('i', num_landmarks)
+    dists = reader.block('f', num_landmarks * num_nodes)
+    tables = [dists[k * num_nodes:(k + 1) * num_nodes] for k in range(num_landmarks)]
+    return Landmarks(landmarks, tables)
+
+
+class LandmarksTests(unittest.TestCase):
+    def setUp(self):
+        # a 6 x 6 grid with a few edges missing, plus an unconnected pair
+        self.graph = csr_graph.make_test_grid(6, missing=[(13, 14), (21, 22), (10, 16), (26, 32)])
+
+    def test_farthest_selection(self):
+        landmarks = select_farthest(self.graph, 3)
+        # the corner opposite node 0 is first
+        self.assertEqual(landmarks.landmarks[0], 35)
+        self.assertEqual(len(set(landmarks.landmarks)), 3)
+        self.assertTrue(all(node < 36 for node in landmarks.landmarks))
+
+    def test_bounds_are_admissible(self):
+        landmarks = select_farthest(self.graph, 4)
+        for target in [0, 14, 35]:
+            dists, _ = graph_search.dijkstra_all(self.graph, target)
+            for node in range(len(self.graph)):
+                self.assertLessEqual(landmarks.lower_bound(node, target), dists[node])
+
+    def test_astar_with_landmarks(self):
+        landmarks = select_farthest(self.graph, 4)
+        for source, target in [(0, 35), (5, 30), (13, 22)]:
+            plain = graph_search.astar(self.graph, source, target)
+            alt = graph_search.astar(self.graph, source, target,
+                                     landmarks.heuristic(target, self.graph))
+            self.assertAlmostEqual(alt.distance, plain.distance, delta=0.1)
+            self.assertLessEqual(alt.settled, plain.settled)
+        result = graph_search.astar(self.graph, 0, 36, landmarks.heuristic(36))
+        self.assertEqual(result.path, [])
+
+    def test_starts_in_largest_component(self):
+        # node 0 is on its own, the rest are a path
+        graph = csr_graph.from_edges([0] * 5, [0, 1, 2, 2.001, 2.002], [1, 2, 3], [2, 3, 4])
+        self.assertEqual(sorted(largest_component(graph)), [1, 2, 3, 4])
+        landmarks = select_farthest(graph, 2)
+        self.assertEqual(sorted(landmarks.landmarks), [1, 4])
+
+    def test_never_weaker_than_great_circle(self):
+        # one landmark, in the unconnected pair
+        landmarks = select_farthest(self.graph, 1, start=36)
+        for source, target in [(0, 35), (5, 30), (13, 22)]:
+            self.assertEqual(landmarks.lower_bound(source, target), 0)
+            plain = graph_search.astar(self.graph, source, target)
+            alt = graph_search.astar(self.graph, source, target,
+                                     landmarks.heuristic(target, self.graph))
+            self.assertEqual(alt.settled, plain.settled)
+
+    def test_write_load(self):
+        landmarks = select_farthest(self.graph, 2)
+        fd, path = tempfile.mkstemp(suffix='.landmarks.bin')
+        os.close(fd)
+        try:
+            write_landmarks(path, landmarks, len(self.graph))
+            loaded = load_landmarks(path)
+            self.assertEqual(list(loaded.landmarks), list(landmarks.landmarks))
+            self.assertEqual([list(t) for t in loaded.tables], [list(t) for t in landmarks.tables])
+        finally:
+            os.remove(path)
+        self.assertEqual(landmarks_path('a/roads.graph.bin'), 'a/roads.landmarks.bin')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,13 @@
 
 
 import unittest
+from array import array
+from itertools import chain, repeat
 
+import csr_graph
 import kd_tree
+import placemark_store
+import spatial_hash
 
 
 def placemarks_to_graph(placemarks):
@@ -18,18 +23,77 @@ def placemarks_to_graph(placemarks):
     return nodes
 
 
-def add_edges_between_close_nodes(nodes, max_dist_squared=.0000000000001):
-    tree = kd_tree.create(nodes)
-    for node in nodes:
-        nearest_kdnode, dist_squared = tree.search_knn(node.xy, 2)[1]
-        if dist_squared <= max_dist_squared:
-            nearest_node = nearest_kdnode.data
-            node.adjacent.add(nearest_node.idx)
-            nearest_node.adjacent.add(node.idx)
+def placemarks_to_csr(placemarks, max_dist_squared=.0000000000001, all_pairs=False,
+                      create_index=kd_tree.create_bulk):
+    """ Same graph as placemarks_to_graph, built straight from the placemark
+        points into a csr_graph.CSRGraph without creating any Nodes
+    """
+    store = placemark_store.from_placemarks(placemarks)
+    firsts = array('l')
+    seconds = array('l')
+    # edges between points on same placemark (same road)
+    for pm_idx in range(len(store)):
+        start, end = store.point_range(pm_idx)
+        firsts.extend(range(start, end - 1))
+        seconds.extend(range(start + 1, end))
+    close_firsts, close_seconds = close_point_pairs(
+        store.lons, store.lats, max_dist_squared, all_pairs, create_index)
+    firsts.extend(close_firsts)
+    seconds.extend(close_seconds)
+    # name each node after its placemark's declared name
+    offsets = store.offsets
+    name_ids = array('i', chain.from_iterable(
+        repeat(name_id, end - start)
+        for name_id, start, end in zip(store.declared_name_ids, offsets, offsets[1:])))
+    return csr_graph.from_edges(store.lats, store.lons, firsts, seconds,
+                                name_ids=name_ids, names=store.names)
+
+
+def add_edges_between_close_nodes(nodes, max_dist_squared=.0000000000001, all_pairs=False,
+                                  create_index=kd_tree.create_bulk):
+    """ Connect each node to its nearest other node, if that node is within
+        max_dist_squared. All nodes are queried in one batch.
+        If all_pairs is set, every pair of nodes within max_dist_squared is
+        connected instead, so junctions where three or more roads meet get
+        all of their edges.
+        create_index(xs=, ys=) builds the spatial index, eg.
+        kd_tree.create_bulk or spatial_hash.create
+    """
+    xs = [n.x for n in nodes]
+    ys = [n.y for n in nodes]
+    firsts, seconds = close_point_pairs(xs, ys, max_dist_squared, all_pairs, create_index)
+    for i, j in zip(firsts, seconds):
+        nodes[i].adjacent.add(nodes[j].idx)
+        nodes[j].adjacent.add(nodes[i].idx)
+
+
+def close_point_pairs(xs, ys, max_dist_squared, all_pairs=False,
+                      create_index=kd_tree.create_bulk):
+    """ Returns (firsts, seconds) arrays of the positions of point pairs to
+        join: each point and its nearest other point if it is within
+        max_dist_squared, or every pair within max_dist_squared if all_pairs
+        is set
+    """
+    tree = create_index(xs=xs, ys=ys)
+    if all_pairs:
+        firsts, seconds, _ = tree.query_pairs(max_dist_squared)
+        return firsts, seconds
+    # nearest 2, since a point's nearest neighbour is usually itself
+    nearest, dists_squared = tree.search_knn_batch(xs, ys, 2)
+    firsts = array('l')
+    seconds = array('l')
+    for i in range(len(xs)):
+        j = 2 * i if nearest[2 * i] != i else 2 * i + 1
+        if nearest[j] >= 0 and dists_squared[j] <= max_dist_squared:
+            firsts.append(i)
+            seconds.append(nearest[j])
+    return firsts, seconds
 
 
 def placemarks_to_nodes(placemarks):
     """ Extract placemark points to Nodes """
+    if isinstance(placemarks, placemark_store.PlacemarkStore):
+        return placemark_store_to_nodes(placemarks)
     nodes = []
     nodes_idx = 0
     for p in placemarks:
@@ -45,23 +109,48 @@ def placemarks_to_nodes(placemarks):
     return nodes
 
 
+def placemark_store_to_nodes(store):
+    """ Extract PlacemarkStore points to Nodes. Node indexes are the same as
+        the store's point indexes.
+    """
+    nodes = [Node(idx, lon, lat) for idx, (lon, lat)
+             in enumerate(zip(store.lons, store.lats))]
+    for pm_idx in range(len(store)):
+        start, end = store.point_range(pm_idx)
+        # add edges between points on same placemark (same road)
+        for idx in range(start + 1, end):
+            nodes[idx - 1].adjacent.add(idx)
+            nodes[idx].adjacent.add(idx - 1)
+    return nodes
+
+
 def road_point_to_node(point, idx):
     return Node(idx, point.lon, point.lat)
 
 
 class Node:
+    # no per-node __dict__, since there is a Node per road point
+    __slots__ = ('idx', 'x', 'y', 'adjacent')
+
     def __init__(self, idx, x, y):
         self.idx = idx
         self.x = x
         self.y = y
-        self.xy = (x, y)
         # adjacent Node idxs
         self.adjacent = set([])
 
+    @property
+    def xy(self):
+        return (self.x, self.y)
+
     def __len__(self):
         return 2
 
     def __getitem__(self, i):
+        if i == 0:
+            return self.x
+        if i == 1:
+            return self.y
         return self.xy[i]
 
     def __str__(self):
@@ -88,6 +177,47 @@ class KmlToGraphTests(unittest.TestCase):
         self.assertEqual(n2.adjacent, set([1, 3]))
         self.assertEqual(n3.adjacent, set([2]))
 
+    def test_add_close_node_edges_all_pairs(self):
+        # three roads meeting at the same point
+        nodes = [Node(0, 0, 0), Node(1, 0, 0), Node(2, 0, 0), Node(3, 5, 5)]
+        add_edges_between_close_nodes(nodes, 1, all_pairs=True)
+        self.assertEqual(nodes[0].adjacent, set([1, 2]))
+        self.assertEqual(nodes[1].adjacent, set([0, 2]))
+        self.assertEqual(nodes[2].adjacent, set([0, 1]))
+        self.assertEqual(nodes[3].adjacent, set([]))
+
+    def test_add_close_node_edges_spatial_hash(self):
+        n1 = Node(1, 0, 0)
+        n2 = Node(2, 5, 0)
+        n3 = Node(3, 5, 5)
+        nodes = [n1, n2, n3]
+        add_edges_between_close_nodes(nodes, 25, create_index=spatial_hash.create)
+        self.assertEqual(n1.adjacent, set([2]))
+        self.assertEqual(n2.adjacent, set([1, 3]))
+        self.assertEqual(n3.adjacent, set([2]))
+
+    def test_node_coordinates(self):
+        node = Node(0, 1.5, 2.5)
+        self.assertEqual(node.xy, (1.5, 2.5))
+        self.assertEqual((node[0], node[1], node[-1]), (1.5, 2.5, 2.5))
+        self.assertEqual(list(node), [1.5, 2.5])
+        self.assertFalse(hasattr(node, '__dict__'))
+
+    def test_placemarks_to_csr(self):
+        pm1 = TestPlacemark([TestPoint(0, 0)])
+        pm2 = TestPlacemark([TestPoint(0, 0), TestPoint(1, 1), TestPoint(2, 2)])
+        graph = placemarks_to_csr([pm1, pm2])
+        self.assertEqual(len(graph), 4)
+        self.assertEqual(list(graph.undirected_edges()), [(0, 1), (1, 2), (2, 3)])
+
+    def test_placemarks_to_csr_names(self):
+        store = placemark_store.PlacemarkStore()
+        store.append([0], [0], 'road a')
+        store.append([1, 1, 2], [0, 1, 1], 'road b')
+        graph = placemarks_to_csr(store)
+        self.assertEqual([graph.node_name(i) for i in range(len(graph))],
+                         ['road a', 'road b', 'road b', 'road b'])
+
     def test_placemarks_to_nodes(self):
         pm1 = TestPlacemark([TestPoint(0, 0)])
         pm2 = TestPlacemark([TestPoint(1, 0), TestPoint(1, 1)])
@@ -100,10 +230,29 @@ class KmlToGraphTests(unittest.TestCase):
         self.assertEqual(n1.adjacent, set([2]))
         self.assertEqual(n2.adjacent, set([1]))
 
+    def test_placemark_store_to_nodes(self):
+        store = placemark_store.PlacemarkStore()
+        store.append([0], [0])
+        store.append([0, 1], [1, 1])
+        nodes = placemarks_to_nodes(store)
+        self.assertEqual([n.xy for n in nodes], [(0, 0), (1, 0), (1, 1)])
+        self.assertEqual(nodes[0].adjacent, set([]))
+        self.assertEqual(nodes[1].adjacent, set([2]))
+        self.assertEqual(nodes[2].adjacent, set([1]))
+
 
 class TestPlacemark:
     def __init__(self, points):
         self.points = points
+        self.declared_name = None
+
+    @property
+    def lats(self):
+        return [p.lat for p in self.points]
+
+    @property
+    def lons(self):
+        return [p.lon for p in self.points]
 
 
 class TestPoint:
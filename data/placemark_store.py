@@ -0,0 +1,343 @@
+""" Compact columnar storage for vicroads placemarks """
+
+
+import io
+import json
+import struct
+import unittest
+from array import array
+from itertools import compress
+
+import graph_file
+
+
+STORE_MAGIC = b'VRPMARKS'
+STORE_VERSION = 2
+# magic, version, number of placemarks, number of points, names size. 40
+# bytes, so the blocks after it stay 8 byte aligned
+STORE_HEADER = struct.Struct('<8sI4xQQQ')
+
+
+class PlacemarkStore(object):
+    """ Stores all placemark points in two contiguous float64 arrays, instead
+        of a Point object per point. The points of placemark i are at
+        offsets[i]:offsets[i + 1]. Names are interned into one table and
+        referred to by index, since most road names are repeated many times.
+    """
+    def __init__(self):
+        self.lats = array('d')
+        self.lons = array('d')
+        self.offsets = array('l', [0])
+        # interned names. Index 0 is reserved for 'no name'
+        self.names = [None]
+        self._name_ids = {None: 0}
+        self.declared_name_ids = array('l')
+        self.road_name_ids = array('l')
+        self.local_name_ids = array('l')
+        self._bounds = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('placemark index out of range')
+        return StoredPlacemark(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield StoredPlacemark(self, i)
+
+    @property
+    def num_points(self):
+        return len(self.lats)
+
+    def intern(self, name):
+        """ Return the name table index of name, adding it if necessary """
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.names.append(name)
+            self._name_ids[name] = name_id
+        return name_id
+
+    def append(self, lats, lons, declared_name=None, road_name=None, local_name=None):
+        """ Add a placemark with the given point coordinates """
+        if len(lats) != len(lons):
+            raise ValueError('lats and lons must be the same length')
+        self.lats.extend(lats)
+        self.lons.extend(lons)
+        self.offsets.append(len(self.lats))
+        self.declared_name_ids.append(self.intern(declared_name))
+        self.road_name_ids.append(self.intern(road_name))
+        self.local_name_ids.append(self.intern(local_name))
+        self._bounds = None
+
+    def append_placemark(self, placemark):
+        """ Add a Placemark object (or another store's StoredPlacemark) """
+        lats, lons = placemark.lats, placemark.lons
+        self.append(lats, lons, placemark.declared_name,
+                    getattr(placemark, 'road_name', None),
+                    getattr(placemark, 'local_name', None))
+
+    def point_range(self, i):
+        """ Returns (start, end) indexes of placemark i's points """
+        return self.offsets[i], self.offsets[i + 1]
+
+    def bounds(self):
+        """ Per-placemark bounding box index: (minlats, maxlats, minlons,
+            maxlons) arrays. A placemark with no points has an empty (inf,
+            -inf) box. Computed on first use and kept until the store changes.
+        """
+        if self._bounds is None:
+            minlats, maxlats = array('d'), array('d')
+            minlons, maxlons = array('d'), array('d')
+            lats, lons, offsets = self.lats, self.lons, self.offsets
+            inf = float('inf')
+            for i in range(len(self)):
+                start, end = offsets[i], offsets[i + 1]
+                if start == end:
+                    minlats.append(inf)
+                    maxlats.append(-inf)
+                    minlons.append(inf)
+                    maxlons.append(-inf)
+                    continue
+                plats = lats[start:end]
+                plons = lons[start:end]
+                minlats.append(min(plats))
+                maxlats.append(max(plats))
+                minlons.append(min(plons))
+                maxlons.append(max(plons))
+            self._bounds = (minlats, maxlats, minlons, maxlons)
+        return self._bounds
+
+
+class StoredPlacemark(object):
+    """ A view of a single placemark in a PlacemarkStore. Has the same read
+        interface as kml_convert.Placemark, without copying any points.
+    """
+    def __init__(self, store, idx):
+        self.store = store
+        self.idx = idx
+
+    @property
+    def declared_name(self):
+        return self.store.names[self.store.declared_name_ids[self.idx]]
+
+    @property
+    def road_name(self):
+        return self.store.names[self.store.road_name_ids[self.idx]]
+
+    @property
+    def local_name(self):
+        return self.store.names[self.store.local_name_ids[self.idx]]
+
+    @property
+    def lats(self):
+        start, end = self.store.point_range(self.idx)
+        return self.store.lats[start:end]
+
+    @property
+    def lons(self):
+        start, end = self.store.point_range(self.idx)
+        return self.store.lons[start:end]
+
+    def latlons(self):
+        """ Iterator of (lat, lon) tuples """
+        return zip(self.lats, self.lons)
+
+    def __len__(self):
+        start, end = self.store.point_range(self.idx)
+        return end - start
+
+    def to_jsondict(self):
+        return {
+            "declared_name": self.declared_name,
+            "points": list(self.latlons())
+        }
+
+    def __str__(self):
+        return "placemark: '{}', '{}', '{}', pts: {}".format(
+            self.declared_name, self.road_name, self.local_name, len(self))
+
+
+def from_placemarks(placemarks):
+    """ Create a store from an iterable of placemarks """
+    if isinstance(placemarks, PlacemarkStore):
+        return placemarks
+    store = PlacemarkStore()
+    for p in placemarks:
+        store.append_placemark(p)
+    return store
+
+
+def concat(stores):
+    """ Join stores into one new store, in order """
+    out = PlacemarkStore()
+    for store in stores:
+        base = out.num_points
+        out.lats.extend(store.lats)
+        out.lons.extend(store.lons)
+        out.offsets.extend(base + offset for offset in store.offsets[1:])
+        name_map = [out.intern(name) for name in store.names]
+        for src, dst in [(store.declared_name_ids, out.declared_name_ids),
+                         (store.road_name_ids, out.road_name_ids),
+                         (store.local_name_ids, out.local_name_ids)]:
+            dst.extend(name_map[name_id] for name_id in src)
+    return out
+
+
+def filter_store_bbox(store, minlat, maxlat, minlon, maxlon):
+    """ Return a new store containing only the points within the given bounds
+        (min inclusive, max exclusive). Placemarks left with no points are
+        dropped.
+        The store's bounding box index is used to copy placemarks wholly
+        inside the bounds, and skip those wholly outside, without checking
+        their points. The rest are filtered with a mask over their points.
+    """
+    out = PlacemarkStore()
+    lats, lons, offsets = store.lats, store.lons, store.offsets
+    names = store.names
+    minlats, maxlats, minlons, maxlons = store.bounds()
+    for i in range(len(store)):
+        if (maxlats[i] < minlat or minlats[i] >= maxlat
+                or maxlons[i] < minlon or minlons[i] >= maxlon):
+            continue
+        start, end = offsets[i], offsets[i + 1]
+        plats = lats[start:end]
+        plons = lons[start:end]
+        if not (minlats[i] >= minlat and maxlats[i] < maxlat
+                and minlons[i] >= minlon and maxlons[i] < maxlon):
+            mask = [minlat <= lat < maxlat and minlon <= lon < maxlon
+                    for lat, lon in zip(plats, plons)]
+            plats = array('d', compress(plats, mask))
+            plons = array('d', compress(plons, mask))
+            if not plats:
+                continue
+        out.append(plats, plons, names[store.declared_name_ids[i]],
+                   names[store.road_name_ids[i]], names[store.local_name_ids[i]])
+    return out
+
+
+def filter_store_bboxes(store, bboxes):
+    """ Extract several regions from one store. bboxes are (minlat, maxlat,
+        minlon, maxlon) tuples. Returns a new store per bbox, see
+        filter_store_bbox. The bounding box index is only built once.
+    """
+    return [filter_store_bbox(store, *bbox) for bbox in bboxes]
+
+
+def write_store(ofile, store):
+    """ Write a store to a binary file object. All arrays are written
+        little-endian with fixed size types, see graph_file.write_blocks.
+    """
+    names = json.dumps(store.names).encode('utf-8')
+    ofile.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(store),
+                                  store.num_points, len(names)))
+    graph_file.write_blocks(ofile, [array(typecode, values) for typecode, values in [
+        ('d', store.lats), ('d', store.lons), ('q', store.offsets),
+        ('i', store.declared_name_ids), ('i', store.road_name_ids),
+        ('i', store.local_name_ids)]] + [names])
+
+
+def read_store(ifile):
+    """ Read a store written by write_store from a binary file object """
+    header = ifile.read(STORE_HEADER.size)
+    if len(header) != STORE_HEADER.size:
+        raise ValueError('truncated placemark store')
+    magic, version, num_placemarks, num_points, names_size = STORE_HEADER.unpack(header)
+    if magic != STORE_MAGIC or version != STORE_VERSION:
+        raise ValueError('not a version {} placemark store'.format(STORE_VERSION))
+    sizes = [8 * num_points] * 2 + [8 * (num_placemarks + 1)] + [4 * num_placemarks] * 3
+    sizes.append(names_size)
+    reader = graph_file.BlockReader(
+        ifile.read(sum(size + graph_file.padding(size) for size in sizes)))
+
+    store = PlacemarkStore()
+    store.lats = reader.array('d', num_points)
+    store.lons = reader.array('d', num_points)
+    store.offsets = array('l', reader.array('q', num_placemarks + 1))
+    store.declared_name_ids = array('l', reader.array('i', num_placemarks))
+    store.road_name_ids = array('l', reader.array('i', num_placemarks))
+    store.local_name_ids = array('l', reader.array('i', num_placemarks))
+    store.names = json.loads(reader.bytes(names_size).decode('utf-8'))
+    store._name_ids = {name: i for i, name in enumerate(store.names)}
+    return store
+
+
+class PlacemarkStoreTests(unittest.TestCase):
+    def test_append_and_view(self):
+        store = PlacemarkStore()
+        store.append([1, 2], [3, 4], 'road a')
+        store.append([5], [6], 'road b', local_name='b st')
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.num_points, 3)
+        self.assertEqual(store[1].declared_name, 'road b')
+        self.assertEqual(store[1].local_name, 'b st')
+        self.assertEqual(list(store[0].latlons()), [(1, 3), (2, 4)])
+
+    def test_names_are_interned(self):
+        store = PlacemarkStore()
+        store.append([1], [1], 'road a', 'road a')
+        store.append([2], [2], 'road a')
+        self.assertEqual(store.names, [None, 'road a'])
+
+    def test_filter_bbox(self):
+        store = PlacemarkStore()
+        store.append([0, 1, 2], [0, 1, 2], 'a')
+        store.append([5], [5], 'b')
+        filtered = filter_store_bbox(store, 0.5, 3, 0.5, 3)
+        self.assertEqual(len(filtered), 1)
+        self.assertEqual(list(filtered[0].latlons()), [(1, 1), (2, 2)])
+
+    def test_filter_bboxes_matches_point_check(self):
+        store = PlacemarkStore()
+        for i in range(20):
+            store.append([i * 0.5 + j * 0.1 for j in range(6)], [i * 0.3 - j for j in range(6)], str(i))
+        store.append([], [], 'empty')
+        bboxes = [(0, 100, -100, 100), (2, 5, -3, 3), (1.05, 1.6, -5, 2), (50, 60, 0, 1)]
+        for bbox, filtered in zip(bboxes, filter_store_bboxes(store, bboxes)):
+            minlat, maxlat, minlon, maxlon = bbox
+            expected = [[(lat, lon) for lat, lon in p.latlons()
+                         if minlat <= lat < maxlat and minlon <= lon < maxlon]
+                        for p in store]
+            self.assertEqual([list(p.latlons()) for p in filtered], [e for e in expected if e])
+
+    def test_bounds_reset_on_append(self):
+        store = PlacemarkStore()
+        store.append([1, 3], [2, 0], 'a')
+        self.assertEqual([list(b) for b in store.bounds()], [[1], [3], [0], [2]])
+        store.append([5], [6], 'b')
+        self.assertEqual(list(store.bounds()[1]), [3, 5])
+
+    def test_concat(self):
+        a = PlacemarkStore()
+        a.append([1], [2], 'road a')
+        b = PlacemarkStore()
+        b.append([3, 4], [5, 6], 'road b')
+        b.append([7], [8], 'road a')
+        joined = concat([a, b])
+        self.assertEqual(list(joined.offsets), [0, 1, 3, 4])
+        self.assertEqual([p.declared_name for p in joined], ['road a', 'road b', 'road a'])
+        self.assertEqual(list(joined[1].latlons()), [(3, 5), (4, 6)])
+
+    def test_write_read(self):
+        store = PlacemarkStore()
+        store.append([1.5, 2], [3, 4], 'road a', 'a rd')
+        store.append([5], [6], 'road b')
+        buf = io.BytesIO()
+        write_store(buf, store)
+        buf.seek(0)
+        read = read_store(buf)
+        self.assertEqual(buf.tell(), len(buf.getvalue()))
+        self.assertEqual([p.to_jsondict() for p in read], [p.to_jsondict() for p in store])
+        self.assertEqual(read[0].road_name, 'a rd')
+        self.assertEqual(read.intern('road b'), store.intern('road b'))
+        buf.seek(0)
+        self.assertRaises(ValueError, read_store, io.BytesIO(buf.read(60)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,264 @@
+""" Snap points (eg. GPS fixes) to the nearest node or road segment of the
+road graph
+
+The spatial indexes are built once per Snapper, the first time each is
+needed, and reused for every batch after that. Coordinates are projected
+to a plane where a degree of latitude and of longitude are the same length
+near the middle of the graph, which is accurate enough to find the nearest
+node or segment. Reported distances are great-circle metres.
+"""
+
+
+import math
+import unittest
+from array import array
+
+import csr_graph
+import graph_search
+import kd_tree
+import spatial_hash
+from geo import haversine
+
+
+class Snapper(object):
+    """ Snaps batches of (lat, lon) points to a graph. Node results are node
+        indexes. A segment is an edge of the graph, as its (first, second)
+        node indexes with first < second.
+    """
+    def __init__(self, graph, cell_size=None):
+        self.graph = graph_search.prepare(graph)
+        if len(self.graph) == 0:
+            raise ValueError('can not snap to an empty graph')
+        lats = self.graph.lats
+        mid_lat = (min(lats) + max(lats)) / 2
+        self.x_scale = math.cos(math.radians(mid_lat))
+        self.cell_size = cell_size
+        self._node_index = None
+        self._segment_index = None
+
+    def project(self, lats, lons):
+        """ Returns (xs, ys) arrays of points in the snapping plane """
+        scale = self.x_scale
+        return array('d', (lon * scale for lon in lons)), array('d', lats)
+
+    @property
+    def node_index(self):
+        if self._node_index is None:
+            xs, ys = self.project(self.graph.lats, self.graph.lons)
+            self._node_index = kd_tree.create_bulk(xs=xs, ys=ys)
+        return self._node_index
+
+    @property
+    def segment_index(self):
+        if self._segment_index is None:
+            xs, ys = self.project(self.graph.lats, self.graph.lons)
+            cell_size = self.cell_size or spatial_hash.default_cell_size(xs, ys)
+            self._segment_index = SegmentIndex(xs, ys, self.graph.undirected_edges(), cell_size)
+        return self._segment_index
+
+    def snap_nodes(self, lats, lons):
+        """ Nearest node to each point. Returns (nodes, distances) arrays. """
+        if len(lats) != len(lons):
+            raise ValueError('lats and lons must be the same length')
+        xs, ys = self.project(lats, lons)
+        nodes, _ = self.node_index.search_knn_batch(xs, ys, 1)
+        graph_lats, graph_lons = self.graph.lats, self.graph.lons
+        distances = array('d', (haversine(lat, lon, graph_lats[n], graph_lons[n])
+                                for lat, lon, n in zip(lats, lons, nodes)))
+        return nodes, distances
+
+    def snap_segments(self, lats, lons):
+        """ Nearest segment to each point.
+            Returns (firsts, seconds, fractions, distances) arrays: the
+            segment's nodes, how far along it from first to second the
+            nearest point is (0 to 1), and the distance to that point. Where
+            the graph has no edges, nodes are -1 and distances infinite.
+        """
+        if len(lats) != len(lons):
+            raise ValueError('lats and lons must be the same length')
+        xs, ys = self.project(lats, lons)
+        segments, fractions = self.segment_index.search_nearest_batch(xs, ys)
+        index = self.segment_index
+        graph_lats, graph_lons = self.graph.lats, self.graph.lons
+        firsts = array('l', [-1]) * len(lats)
+        seconds = array('l', [-1]) * len(lats)
+        distances = array('d', [float('inf')]) * len(lats)
+        for q, s in enumerate(segments):
+            if s < 0:
+                continue
+            a, b = index.firsts[s], index.seconds[s]
+            t = fractions[q]
+            lat = graph_lats[a] + t * (graph_lats[b] - graph_lats[a])
+            lon = graph_lons[a] + t * (graph_lons[b] - graph_lons[a])
+            firsts[q] = a
+            seconds[q] = b
+            distances[q] = haversine(lats[q], lons[q], lat, lon)
+        return firsts, seconds, fractions, distances
+
+
+class SegmentIndex(object):
+    """ Line segments bucketed into square cells of side cell_size. Each
+        segment is stored in every cell it passes through.
+        Segment s joins points firsts[s] and seconds[s] of xs, ys.
+    """
+    def __init__(self, xs, ys, segments, cell_size):
+        if cell_size <= 0:
+            raise ValueError('cell_size must be positive')
+        self.xs = xs
+        self.ys = ys
+        self.cell_size = cell_size
+        self.firsts = array('l')
+        self.seconds = array('l')
+        self.cells = {}
+        for a, b in segments:
+            s = len(self.firsts)
+            self.firsts.append(a)
+            self.seconds.append(b)
+            for key in segment_cells(xs[a], ys[a], xs[b], ys[b], cell_size):
+                bucket = self.cells.get(key)
+                if bucket is None:
+                    self.cells[key] = [s]
+                else:
+                    bucket.append(s)
+        if self.cells:
+            cols = [c for c, r in self.cells]
+            rows = [r for c, r in self.cells]
+            self._min_cell = (min(cols), min(rows))
+            self._max_cell = (max(cols), max(rows))
+
+    def __len__(self):
+        return len(self.firsts)
+
+    def search_nearest_batch(self, xs, ys):
+        """ Nearest segment to each query point (xs[i], ys[i]).
+            Returns (segments, fractions) arrays. fractions are how far
+            along the segment the nearest point is. Segment is -1 if the
+            index is empty.
+        """
+        segments = array('l', [-1]) * len(xs)
+        fractions = array('d', [0.0]) * len(xs)
+        for q in range(len(xs)):
+            s, t, _ = self.search_nearest(xs[q], ys[q])
+            segments[q] = s
+            fractions[q] = t
+        return segments, fractions
+
+    def search_nearest(self, px, py):
+        """ Returns (segment, fraction, squared distance) of the segment
+            nearest to (px, py). Searches rings of cells outwards until no
+            unsearched cell can hold a closer segment.
+        """
+        best, best_t, best_d = -1, 0.0, float('inf')
+        if not self.cells:
+            return best, best_t, best_d
+        xs, ys, cells = self.xs, self.ys, self.cells
+        firsts, seconds = self.firsts, self.seconds
+        size = self.cell_size
+        qc, qr = int(math.floor(px / size)), int(math.floor(py / size))
+        edge_gap = min(px - qc * size, (qc + 1) * size - px,
+                       py - qr * size, (qr + 1) * size - py)
+        max_ring = max(abs(qc - self._min_cell[0]), abs(qc - self._max_cell[0]),
+                       abs(qr - self._min_cell[1]), abs(qr - self._max_cell[1]))
+        ring = 0
+        while ring <= max_ring:
+            if ring > 0 and best >= 0:
+                ring_gap = edge_gap + (ring - 1) * size
+                if ring_gap * ring_gap > best_d:
+                    break
+            for key in spatial_hash.ring_cells(qc, qr, ring):
+                bucket = cells.get(key)
+                if bucket is None:
+                    continue
+                for s in bucket:
+                    ax, ay = xs[firsts[s]], ys[firsts[s]]
+                    dx, dy = xs[seconds[s]] - ax, ys[seconds[s]] - ay
+                    length2 = dx * dx + dy * dy
+                    t = 0.0
+                    if length2 > 0:
+                        t = ((px - ax) * dx + (py - ay) * dy) / length2
+                        t = 0.0 if t < 0 else 1.0 if t > 1 else t
+                    ex = ax + t * dx - px
+                    ey = ay + t * dy - py
+                    d = ex * ex + ey * ey
+                    if d < best_d or (d == best_d and s < best):
+                        best, best_t, best_d = s, t, d
+            ring += 1
+        return best, best_t, best_d
+
+
+def segment_cells(x0, y0, x1, y1, size):
+    """ Yield the (column, row) keys of the cells a line segment passes
+        through
+    """
+    if x0 > x1:
+        x0, y0, x1, y1 = x1, y1, x0, y0
+    floor = math.floor
+    c0, c1 = int(floor(x0 / size)), int(floor(x1 / size))
+    slope = (y1 - y0) / (x1 - x0) if x1 != x0 else 0.0
+    for c in range(c0, c1 + 1):
+        # the part of the segment within this column
+        xa = max(x0, c * size)
+        xb = min(x1, (c + 1) * size)
+        if x1 == x0:
+            ya, yb = y0, y1
+        else:
+            ya = y0 + (xa - x0) * slope
+            yb = y0 + (xb - x0) * slope
+        if ya > yb:
+            ya, yb = yb, ya
+        for r in range(int(floor(ya / size)), int(floor(yb / size)) + 1):
+            yield (c, r)
+
+
+class SnappingTests(unittest.TestCase):
+    def setUp(self):
+        # a few roads near melbourne, including a long diagonal one
+        lats = [-37.80, -37.80, -37.81, -37.81, -37.75, -37.85, -37.82]
+        lons = [144.90, 144.95, 144.95, 145.00, 144.80, 145.10, 144.91]
+        edges = [(0, 1), (1, 2), (2, 3), (4, 5)]
+        self.graph = csr_graph.from_edges(lats, lons, [a for a, b in edges], [b for a, b in edges])
+        self.snapper = Snapper(self.graph, cell_size=0.004)
+        self.lats = [-37.8, -37.805, -37.79, -37.83, -37.9, -37.76, -37.8201]
+        self.lons = [144.92, 144.951, 144.99, 144.90, 145.2, 144.85, 144.9101]
+
+    def test_snap_nodes(self):
+        nodes, distances = self.snapper.snap_nodes(self.lats, self.lons)
+        for q, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            dists = [haversine(lat, lon, self.graph.lats[i], self.graph.lons[i])
+                     for i in range(len(self.graph))]
+            # the projection can pick a node a little further away, when two
+            # are almost the same distance
+            self.assertAlmostEqual(distances[q], min(dists), delta=0.01)
+            self.assertAlmostEqual(distances[q], dists[nodes[q]])
+
+    def test_snap_segments_matches_brute_force(self):
+        firsts, seconds, fractions, distances = self.snapper.snap_segments(self.lats, self.lons)
+        xs, ys = self.snapper.project(self.graph.lats, self.graph.lons)
+        segments = list(self.graph.undirected_edges())
+        brute = SegmentIndex(xs, ys, segments, cell_size=1000)
+        qxs, qys = self.snapper.project(self.lats, self.lons)
+        for q in range(len(self.lats)):
+            s, t, _ = brute.search_nearest(qxs[q], qys[q])
+            self.assertEqual((firsts[q], seconds[q]), segments[s])
+            self.assertAlmostEqual(fractions[q], t)
+        # on the first segment, two fifths of the way along (144.92 on 144.90 to 144.95)
+        self.assertEqual((firsts[0], seconds[0]), (0, 1))
+        self.assertAlmostEqual(fractions[0], 0.4)
+        self.assertAlmostEqual(distances[0], 0, delta=1e-6)
+        # the fix beside node 6, which has no edges, snaps to a segment
+        self.assertNotEqual(firsts[6], 6)
+
+    def test_segment_cells(self):
+        cells = set(segment_cells(0.5, 0.5, 3.5, 1.5, 1))
+        self.assertEqual(cells, {(0, 0), (1, 0), (1, 1), (2, 1), (3, 1)})
+        self.assertEqual(list(segment_cells(2.5, 3.5, 2.5, 1.5, 1)), [(2, 1), (2, 2), (2, 3)])
+
+    def test_no_edges(self):
+        graph = csr_graph.from_edges([0, 1], [0, 1], [], [])
+        firsts, _, _, distances = Snapper(graph).snap_segments([0.5], [0.5])
+        self.assertEqual(list(firsts), [-1])
+        self.assertEqual(list(distances), [float('inf')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,310 @@
+""" Uniform grid spatial index for 2-d points
+
+A lighter alternative to kd_tree for dense, static sets of road points that
+are only ever queried with a small radius. Has the same query interface as
+kd_tree.ImplicitKDTree, so either can be used by placemark_graph.
+"""
+
+
+import heapq
+import math
+import unittest
+from array import array
+
+
+def create(point_list=None, xs=None, ys=None, cell_size=None):
+    """ Creates a SpatialHash from a list of 2-d points, or from separate xs
+        and ys coordinate sequences. If cell_size isn't given, it is chosen so
+        that there is about one point per cell over the points' bounding box.
+    """
+    if point_list is not None:
+        xs = [p[0] for p in point_list]
+        ys = [p[1] for p in point_list]
+    elif xs is None or ys is None:
+        raise ValueError('either point_list or xs and ys must be provided')
+    if cell_size is None:
+        cell_size = default_cell_size(xs, ys)
+    index = SpatialHash(cell_size)
+    index.insert(xs, ys)
+    index.points = point_list
+    return index
+
+
+def default_cell_size(xs, ys):
+    """ A cell size giving roughly one point per cell """
+    if len(xs) < 2:
+        return 1.0
+    width = max(xs) - min(xs)
+    height = max(ys) - min(ys)
+    area = max(width, height) ** 2 if width == 0 or height == 0 else width * height
+    if area == 0:
+        return 1.0
+    return math.sqrt(area / len(xs))
+
+
+class SpatialHash(object):
+    """ Points bucketed into square cells of side cell_size. Only occupied
+        cells are stored, in a dict keyed by (column, row).
+        Search results refer to points by their insertion index.
+    """
+    def __init__(self, cell_size):
+        if cell_size <= 0:
+            raise ValueError('cell_size must be positive')
+        self.cell_size = cell_size
+        self.xs = array('d')
+        self.ys = array('d')
+        self.cells = {}
+        self.points = None
+        # bounds of the occupied cells, used to stop ring searches
+        self._min_cell = None
+        self._max_cell = None
+        self._num_removed = 0
+
+    def __len__(self):
+        return len(self.xs) - self._num_removed
+
+    def cell_of(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def insert(self, xs, ys):
+        """ Bulk insert points. Returns the index of the first new point. """
+        if len(xs) != len(ys):
+            raise ValueError('xs and ys must be the same length')
+        first = len(self.xs)
+        self.xs.extend(xs)
+        self.ys.extend(ys)
+        cells = self.cells
+        size = self.cell_size
+        floor = math.floor
+        for i in range(first, len(self.xs)):
+            key = (int(floor(self.xs[i] / size)), int(floor(self.ys[i] / size)))
+            bucket = cells.get(key)
+            if bucket is None:
+                cells[key] = [i]
+            else:
+                bucket.append(i)
+        self._update_bounds()
+        return first
+
+    def remove(self, i):
+        """ Remove the point with insertion index i. Its coordinates are kept,
+            so other points keep their indexes, but searches no longer find it.
+        """
+        key = self.cell_of(self.xs[i], self.ys[i])
+        bucket = self.cells.get(key)
+        if bucket is None or i not in bucket:
+            raise ValueError('point {} is not in the index'.format(i))
+        bucket.remove(i)
+        if not bucket:
+            # the bounds may now be larger than needed, which only makes ring
+            # searches go a little further
+            del self.cells[key]
+        self._num_removed += 1
+
+    def _update_bounds(self):
+        if not self.cells:
+            self._min_cell = self._max_cell = None
+            return
+        cols = [c for c, r in self.cells]
+        rows = [r for c, r in self.cells]
+        self._min_cell = (min(cols), min(rows))
+        self._max_cell = (max(cols), max(rows))
+
+    def search_knn(self, point, k):
+        """ Return the k nearest neighbors of point and their distances
+            The result is a list of (point index, squared distance) tuples,
+            nearest first.
+        """
+        results = self._search_knn_heap(point[0], point[1], k)
+        return [(i, d) for d, i in sorted((-d, i) for d, i in results)]
+
+    def search_nn(self, point):
+        """ Returns a (point index, squared distance) tuple, or None if the
+            index is empty
+        """
+        return next(iter(self.search_knn(point, 1)), None)
+
+    def search_knn_batch(self, xs, ys, k):
+        """ Same as kd_tree.ImplicitKDTree.search_knn_batch """
+        if len(xs) != len(ys):
+            raise ValueError('xs and ys must be the same length')
+        out_idx = array('l', [-1]) * (len(xs) * k)
+        out_dist = array('d', [float('inf')]) * (len(xs) * k)
+        search = self._search_knn_heap
+        for q in range(len(xs)):
+            results = sorted((-d, i) for d, i in search(xs[q], ys[q], k))
+            out = q * k
+            for d, i in results:
+                out_idx[out] = i
+                out_dist[out] = d
+                out += 1
+        return out_idx, out_dist
+
+    def _search_knn_heap(self, px, py, k):
+        """ Search rings of cells outwards from the query point's cell until
+            no unsearched cell can hold a point closer than the current kth.
+            Returns a heap of up to k (-squared distance, index) tuples.
+        """
+        results = []
+        if not self.cells or k < 1:
+            return results
+        xs, ys, cells = self.xs, self.ys, self.cells
+        size = self.cell_size
+        qc, qr = self.cell_of(px, py)
+        # distances from the query point to the edges of its own cell
+        edge_gap = min(px - qc * size, (qc + 1) * size - px,
+                       py - qr * size, (qr + 1) * size - py)
+        # rings beyond this radius contain no occupied cells
+        max_ring = max(abs(qc - self._min_cell[0]), abs(qc - self._max_cell[0]),
+                       abs(qr - self._min_cell[1]), abs(qr - self._max_cell[1]))
+        worst = float('inf')
+        ring = 0
+        while ring <= max_ring:
+            if ring > 0 and len(results) == k:
+                ring_gap = edge_gap + (ring - 1) * size
+                if ring_gap * ring_gap > worst:
+                    break
+            for key in ring_cells(qc, qr, ring):
+                bucket = cells.get(key)
+                if bucket is None:
+                    continue
+                for i in bucket:
+                    dx = xs[i] - px
+                    dy = ys[i] - py
+                    d = dx * dx + dy * dy
+                    if len(results) < k:
+                        heapq.heappush(results, (-d, i))
+                        if len(results) == k:
+                            worst = -results[0][0]
+                    elif d < worst:
+                        heapq.heapreplace(results, (-d, i))
+                        worst = -results[0][0]
+            ring += 1
+        return results
+
+    def search_nn_dist(self, point, distance):
+        """ Return the indexes of all points closer than distance to point.
+            distance is a plain (not squared) distance.
+        """
+        px, py = point[0], point[1]
+        xs, ys, cells = self.xs, self.ys, self.cells
+        max_d = distance * distance
+        c0, r0 = self.cell_of(px - distance, py - distance)
+        c1, r1 = self.cell_of(px + distance, py + distance)
+        found = []
+        for c in range(c0, c1 + 1):
+            for r in range(r0, r1 + 1):
+                for i in cells.get((c, r), ()):
+                    dx = xs[i] - px
+                    dy = ys[i] - py
+                    if dx * dx + dy * dy < max_d:
+                        found.append(i)
+        return found
+
+    def query_pairs(self, max_dist_squared):
+        """ Find all pairs of points within max_dist_squared of each other.
+            Same result format as kd_tree.ImplicitKDTree.query_pairs.
+            Each cell is compared with itself and with the neighbouring cells
+            in one half plane, so each pair of cells is only visited once.
+        """
+        xs, ys, cells = self.xs, self.ys, self.cells
+        reach = int(math.ceil(math.sqrt(max_dist_squared) / self.cell_size))
+        offsets = [(dc, dr) for dc in range(0, reach + 1)
+                   for dr in range(-reach, reach + 1)
+                   if dc > 0 or dr > 0]
+        firsts = array('l')
+        seconds = array('l')
+        dists = array('d')
+
+        def add_pair(i, j, d):
+            if i < j:
+                firsts.append(i)
+                seconds.append(j)
+            else:
+                firsts.append(j)
+                seconds.append(i)
+            dists.append(d)
+
+        for (c, r), bucket in cells.items():
+            for a in range(len(bucket)):
+                i = bucket[a]
+                xi, yi = xs[i], ys[i]
+                for b in range(a + 1, len(bucket)):
+                    j = bucket[b]
+                    dx = xs[j] - xi
+                    dy = ys[j] - yi
+                    d = dx * dx + dy * dy
+                    if d <= max_dist_squared:
+                        add_pair(i, j, d)
+            for dc, dr in offsets:
+                other = cells.get((c + dc, r + dr))
+                if other is None:
+                    continue
+                for i in bucket:
+                    xi, yi = xs[i], ys[i]
+                    for j in other:
+                        dx = xs[j] - xi
+                        dy = ys[j] - yi
+                        d = dx * dx + dy * dy
+                        if d <= max_dist_squared:
+                            add_pair(i, j, d)
+        return firsts, seconds, dists
+
+
+def ring_cells(c, r, ring):
+    """ Yield the keys of the cells at chebyshev distance ring from (c, r) """
+    if ring == 0:
+        yield (c, r)
+        return
+    for dc in range(-ring, ring + 1):
+        yield (c + dc, r - ring)
+        yield (c + dc, r + ring)
+    for dr in range(-ring + 1, ring):
+        yield (c - ring, r + dr)
+        yield (c + ring, r + dr)
+
+
+class SpatialHashTests(unittest.TestCase):
+    def setUp(self):
+        self.points = [(0, 0), (5, 0), (5, 5), (5, 5.5), (20, 20)]
+        self.index = create(self.points, cell_size=2)
+
+    def brute_knn(self, point, k):
+        dists = [((p[0] - point[0]) ** 2 + (p[1] - point[1]) ** 2, i)
+                 for i, p in enumerate(self.points)]
+        return [(i, d) for d, i in sorted(dists)[:k]]
+
+    def test_knn_matches_brute_force(self):
+        for point in [(0, 0), (4, 4), (19, 1), (100, -100)]:
+            for k in [1, 2, 5, 7]:
+                self.assertEqual(self.index.search_knn(point, k),
+                                 self.brute_knn(point, k))
+
+    def test_search_nn_dist(self):
+        self.assertEqual(sorted(self.index.search_nn_dist((5, 5.2), 1)), [2, 3])
+
+    def test_query_pairs(self):
+        firsts, seconds, dists = self.index.query_pairs(1)
+        self.assertEqual(list(zip(firsts, seconds)), [(2, 3)])
+        self.assertEqual(list(dists), [0.25])
+
+    def test_bulk_insert(self):
+        first = self.index.insert([30, 31], [30, 30])
+        self.assertEqual(first, 5)
+        self.assertEqual(self.index.search_nn((31, 31)), (6, 1.0))
+
+    def test_remove(self):
+        self.index.remove(3)
+        self.index.remove(4)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.search_nn_dist((5, 5.2), 1), [2])
+        self.assertEqual(self.index.search_nn((20, 20)), (2, 450))
+        self.assertEqual(self.index.query_pairs(1)[0], array('l'))
+        self.assertRaises(ValueError, self.index.remove, 3)
+        # new points still get new indexes
+        self.assertEqual(self.index.insert([5], [5.5]), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -79,6 +79,10 @@ class BreadthFirstSearch {
       return undefined;
     } else {
       let nextNode = this.frontier[this.frontierIndex];
+      //On a TiledGraph, wait until the node's tile has loaded
+      if (this.graph.isLoaded && !this.graph.isLoaded(nextNode)) {
+        return null;
+      }
       //Remove nextNode from frontier
       this.frontierIndex++;
       //Add to explored
@@ -97,16 +101,19 @@ class BreadthFirstSearch {
 class BidirectionalProblem {
   constructor(graph) {
     this.graph = graph;
-    this.initial = 0;
+    //Nodes of a TiledGraph that aren't loaded yet are undefined
+    let loaded = this.graph.nodes.filter(node => node !== undefined);
+    this.initial = loaded[0].id;
     //Force the initial node to be around the middle of the canvas.
     for (let i = 0; i < this.graph.nodes.length; i++) {
-      if (distance([this.graph.width / 2, this.graph.height / 2], [this.graph.nodes[i].x, this.graph.nodes[i].y]) < 50) {
+      let node = this.graph.nodes[i];
+      if (node && distance([this.graph.width / 2, this.graph.height / 2], [node.x, node.y]) < 50) {
         this.initial = i;
         break;
       }
     }
     //Final node is chosen randomly
-    this.final = Math.floor(Math.random() * this.graph.nodes.length);
+    this.final = loaded[Math.floor(Math.random() * loaded.length)].id;
     this.sourceBFS = new BreadthFirstSearch(this.graph, this.initial);
     this.destBFS = new BreadthFirstSearch(this.graph, this.final);
   }
@@ -118,14 +125,14 @@ class BidirectionalProblem {
       //Iterate Source side BFS
     let nextNode = this.sourceBFS.step();
     obj.source = nextNode;
-    if (!this.destBFS.state[nextNode]) {
+    if (nextNode !== null && !this.destBFS.state[nextNode]) {
       obj.done = true;
     }
 
     //Iterate Destination side BFS
     nextNode = this.destBFS.step();
     obj.dest = nextNode;
-    if (!this.sourceBFS.state[nextNode]) {
+    if (nextNode !== null && !this.sourceBFS.state[nextNode]) {
       obj.done = true;
     }
     return obj;
@@ -32,21 +32,7 @@ class BidirectionalDiagram {
       .interpolate(d3.interpolateRgb)
       .range([d3.hsl('hsla(102, 100%, 50%, 1)'), d3.hsl('hsla(0, 100%, 50%, 1)')]);
 
-    //Draw all nodes
-    for (let i = 0; i < this.nodes.length; i++) {
-      this.colorNode(i, this.initialColor);
-    }
-    //Draw all edges
-    for (let i = 0; i < this.edges.length; i++) {
-      let d = this.edges[i];
-      this.context.beginPath();
-      this.context.lineWidth = 1;
-      this.context.strokeStyle = this.edgeColor;
-      this.context.moveTo(this.nodes[d[0]].x, this.nodes[d[0]].y);
-      this.context.lineTo(this.nodes[d[1]].x, this.nodes[d[1]].y);
-      this.context.stroke();
-      this.context.closePath();
-    }
+    this.drawGraph(this.nodes.filter(node => node !== undefined), this.edges);
 
     //Initial Node
     this.context.fillStyle = this.sourceColor;
@@ -69,6 +55,25 @@ class BidirectionalDiagram {
     this.bfs();
   }
 
+  //Draw nodes and edges. Called again by tiled graphs as tiles load
+  drawGraph(nodes, edges) {
+    //Draw all nodes
+    for (let i = 0; i < nodes.length; i++) {
+      this.colorNode(nodes[i].id, this.initialColor);
+    }
+    //Draw all edges
+    for (let i = 0; i < edges.length; i++) {
+      let d = edges[i];
+      this.context.beginPath();
+      this.context.lineWidth = 1;
+      this.context.strokeStyle = this.edgeColor;
+      this.context.moveTo(this.nodes[d[0]].x, this.nodes[d[0]].y);
+      this.context.lineTo(this.nodes[d[1]].x, this.nodes[d[1]].y);
+      this.context.stroke();
+      this.context.closePath();
+    }
+  }
+
   colorNode(node, color) {
     //If the given node is not an initial node or final node
     if (node != this.initial && node != this.final) {
@@ -114,6 +119,10 @@ class BFSDiagram extends BidirectionalDiagram {
     this.bfsAgent = new BreadthFirstSearch(this.problem.graph, this.initial);
     this.intervalFunction = setInterval(() => {
       let node = this.bfsAgent.step();
+      if (node === null) {
+        //waiting for a tile to load
+        return;
+      }
       this.colorNode(node, this.sourceBFSColor);
       if (node == this.final) {
         clearInterval(this.intervalFunction)
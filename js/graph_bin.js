@@ -0,0 +1,114 @@
+/** Loader for the binary graph files written by data/graph_file.py
+ *  (python3 kml_convert.py <kml> roads.graph.bin). See graph_file.py for
+ *  the layout. Every block is 8 byte aligned, so it is viewed in place as a
+ *  typed array without copying.
+ */
+
+const GRAPH_BIN_MAGIC = 'VRGRAPH\0';
+const GRAPH_BIN_VERSION = 1;
+const GRAPH_BIN_HEADER_SIZE = 64;
+
+/**
+ * Parse a binary graph file
+ * @param {ArrayBuffer} buffer
+ * @returns {{lats: Float64Array, lons: Float64Array, offsets: Int32Array,
+ *            targets: Int32Array, weights: ?Float32Array,
+ *            nameIds: ?Int32Array, names: ?string[],
+ *            pathOffsets: ?Int32Array, pathLats: ?Float64Array,
+ *            pathLons: ?Float64Array}}
+ *   The path arrays hold each edge entry's shape points, if the graph has
+ *   them: entry e's are at [pathOffsets[e], pathOffsets[e + 1]).
+ */
+function parseBinaryGraph(buffer) {
+  let header = new DataView(buffer, 0, GRAPH_BIN_HEADER_SIZE);
+  let magic = String.fromCharCode(...new Uint8Array(buffer, 0, 8));
+  if (magic !== GRAPH_BIN_MAGIC) {
+    throw new Error('not a graph file');
+  }
+  let version = header.getUint32(8, true);
+  if (version !== GRAPH_BIN_VERSION) {
+    throw new Error('unsupported graph file version: ' + version);
+  }
+  let flags = header.getUint32(12, true);
+  // 64 bit counts. Fine as numbers below 2^53
+  let numNodes = Number(header.getBigUint64(16, true));
+  let numEntries = Number(header.getBigUint64(24, true));
+  let namesSize = Number(header.getBigUint64(32, true));
+  let numPoints = Number(header.getBigUint64(40, true));
+
+  let position = GRAPH_BIN_HEADER_SIZE;
+  function block(ArrayType, count) {
+    let arr = new ArrayType(buffer, position, count);
+    let size = count * ArrayType.BYTES_PER_ELEMENT;
+    position += size + (8 - size % 8) % 8;
+    return arr;
+  }
+  let graph = {
+    lats: block(Float64Array, numNodes),
+    lons: block(Float64Array, numNodes),
+    offsets: block(Int32Array, numNodes + 1),
+    targets: block(Int32Array, numEntries),
+    weights: null,
+    nameIds: null,
+    names: null,
+    pathOffsets: null,
+    pathLats: null,
+    pathLons: null
+  };
+  if (flags & 1) {
+    graph.weights = block(Float32Array, numEntries);
+  }
+  if (flags & 2) {
+    graph.nameIds = block(Int32Array, numNodes);
+    let names = new Uint8Array(buffer, position, namesSize);
+    graph.names = JSON.parse(new TextDecoder('utf-8').decode(names));
+    position += namesSize + (8 - namesSize % 8) % 8;
+  }
+  if (flags & 4) {
+    graph.pathOffsets = block(Int32Array, numEntries + 1);
+    graph.pathLats = block(Float64Array, numPoints);
+    graph.pathLons = block(Float64Array, numPoints);
+  }
+  return graph;
+}
+
+/**
+ * Fetch and parse a binary graph file
+ * @param {string} url
+ * @returns {Promise} resolves to the parsed graph, see parseBinaryGraph
+ */
+function loadBinaryGraph(url) {
+  return fetch(url)
+    .then(response => {
+      if (!response.ok) {
+        throw new Error('failed to load ' + url + ': ' + response.status);
+      }
+      return response.arrayBuffer();
+    })
+    .then(parseBinaryGraph);
+}
+
+/** Convert a parsed binary graph to the {nodes, edges, paths} form written
+ *  by placemarks_to_js_graph, for use with pyGraphToNodesAndEdges
+ */
+function binaryGraphToPyGraph(graph) {
+  let nodes = [];
+  let edges = [];
+  let paths = graph.pathOffsets ? [] : undefined;
+  for (let i = 0; i < graph.lats.length; i++) {
+    nodes.push([graph.lons[i], graph.lats[i]]);
+    for (let e = graph.offsets[i]; e < graph.offsets[i + 1]; e++) {
+      if (graph.targets[e] > i) {
+        edges.push([i, graph.targets[e]]);
+        if (paths) {
+          let path = [];
+          for (let p = graph.pathOffsets[e]; p < graph.pathOffsets[e + 1]; p++) {
+            path.push([graph.pathLons[p], graph.pathLats[p]]);
+          }
+          paths.push(path);
+        }
+      }
+    }
+  }
+  return {nodes: nodes, edges: edges, paths: paths};
+}
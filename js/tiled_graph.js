@@ -0,0 +1,149 @@
+/** Road graph split into tiles by data/graph_tiles.py
+ *  (python3 kml_convert.py <kml> roads.tiles), loaded on demand. See
+ *  graph_tiles.py for the file layout.
+ *
+ *  Node ids are global. Each tile holds a consecutive range of ids, so the
+ *  tile of any node is known from the manifest before it is loaded.
+ *  nodes[id] is undefined until the node's tile has loaded.
+ */
+
+const TILE_MANIFEST_VERSION = 1;
+
+class TiledGraph {
+  /**
+   * @param {object} manifest parsed manifest.json
+   * @param {string} baseUrl url of the tiles directory
+   * @param {function} project optional (lon, lat) => [x, y] for new nodes
+   */
+  constructor(manifest, baseUrl, project) {
+    if (manifest.version !== TILE_MANIFEST_VERSION) {
+      throw new Error('unsupported tile manifest version: ' + manifest.version);
+    }
+    this.manifest = manifest;
+    this.baseUrl = baseUrl.replace(/\/?$/, '/');
+    this.project = project || ((lon, lat) => [lon, lat]);
+    this.tiles = manifest.tiles;
+    this.nodes = new Array(manifest.num_nodes);
+    this.edges = [];
+    // [lon, lat] shape points of each of edges, if the tiles have them
+    this.paths = [];
+    // tile index -> promise, for tiles loaded or loading
+    this.loading = new Map();
+    // called with (nodes, edges) added by each tile as it loads
+    this.onTileLoaded = null;
+  }
+
+  /**
+   * Fetch a manifest and create a graph from it. No tiles are loaded.
+   * @param {string} url url of the tiles directory
+   * @returns {Promise} resolves to a TiledGraph
+   */
+  static load(url, project) {
+    let baseUrl = url.replace(/\/?$/, '/');
+    return fetchJson(baseUrl + 'manifest.json')
+      .then(manifest => new TiledGraph(manifest, baseUrl, project));
+  }
+
+  /** Index of the tile holding node id */
+  tileOf(id) {
+    let lo = 0, hi = this.tiles.length - 1;
+    while (lo < hi) {
+      let mid = (lo + hi + 1) >> 1;
+      if (this.tiles[mid].first <= id) {
+        lo = mid;
+      } else {
+        hi = mid - 1;
+      }
+    }
+    return lo;
+  }
+
+  isLoaded(id) {
+    return this.nodes[id] !== undefined;
+  }
+
+  /** Load tile t, if it isn't loaded or loading already. Returns a promise */
+  loadTile(t) {
+    if (!this.loading.has(t)) {
+      let tile = this.tiles[t];
+      this.loading.set(t, fetchJson(this.baseUrl + tile.file)
+        .then(data => this.addTile(tile, data)));
+    }
+    return this.loading.get(t);
+  }
+
+  addTile(tile, data) {
+    let first = tile.first;
+    let end = first + tile.count;
+    let newNodes = [];
+    for (let i = 0; i < data.nodes.length; i++) {
+      let node = new Node(first + i, ...this.project(...data.nodes[i]));
+      this.nodes[first + i] = node;
+      newNodes.push(node);
+    }
+    let newEdges = [];
+    let newPaths = [];
+    for (let i = 0; i < data.edges.length; i++) {
+      let [a, b] = data.edges[i];
+      this.nodes[a].adjacent.push(b);
+      if (b >= first && b < end) {
+        this.nodes[b].adjacent.push(a);
+      } else if (!this.isLoaded(b)) {
+        // edge between tiles. It's added once, by whichever of its tiles
+        // loads second
+        continue;
+      }
+      newEdges.push([a, b]);
+      if (data.paths) {
+        newPaths.push(data.paths[i]);
+      }
+    }
+    this.edges.push(...newEdges);
+    this.paths.push(...newPaths);
+    if (this.onTileLoaded) {
+      this.onTileLoaded(newNodes, newEdges);
+    }
+  }
+
+  /** Load the tiles holding the given node ids. Returns a promise */
+  loadNodes(ids) {
+    let tiles = new Set(ids.map(id => this.tileOf(id)));
+    return Promise.all([...tiles].map(t => this.loadTile(t)));
+  }
+
+  /** Load all tiles overlapping a [minlon, minlat, maxlon, maxlat] box */
+  loadBbox(bbox) {
+    let [minlon, minlat, maxlon, maxlat] = bbox;
+    let loads = [];
+    for (let t = 0; t < this.tiles.length; t++) {
+      let b = this.tiles[t].bbox;
+      if (b[0] <= maxlon && b[2] >= minlon && b[1] <= maxlat && b[3] >= minlat) {
+        loads.push(this.loadTile(t));
+      }
+    }
+    return Promise.all(loads);
+  }
+
+  /** Neighbours of a loaded node. Starts loading the tiles of any
+   *  neighbours that aren't loaded yet, so they are ready by the time a
+   *  search expands them.
+   */
+  getAdjacent(id) {
+    let adjacent = this.nodes[id].adjacent;
+    for (let i = 0; i < adjacent.length; i++) {
+      if (!this.isLoaded(adjacent[i])) {
+        this.loadTile(this.tileOf(adjacent[i]));
+      }
+    }
+    return adjacent;
+  }
+}
+
+function fetchJson(url) {
+  return fetch(url).then(response => {
+    if (!response.ok) {
+      throw new Error('failed to load ' + url + ': ' + response.status);
+    }
+    return response.json();
+  });
+}
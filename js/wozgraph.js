@@ -1,6 +1,13 @@
-/** Assumes road data is loaded into a variable named roads_data
+/** Assumes road data is loaded into a variable named roads_data, or a
+ *  graph into roads_graph. If neither is loaded, the tiled graph at
+ *  ROADS_TILES_URL is used, loading tiles as the search reaches them.
  */
 
+const ROADS_TILES_URL = './data/roads.tiles';
+// [minlon, minlat, maxlon, maxlat] to load before searching. null loads the
+// middle of the graph
+const ROADS_TILES_VIEWPORT = null;
+
 /**
  * Create nodes and edges from vicroads json data
  * @param {object[]} roads_data
@@ -31,6 +38,8 @@ function vicroadsNodesAndEdges(roads_data) {
 
 /** Convert the variable output by my python placemarks_to_js_graph
  *  function to a graph expected by the plotting stuff. Yeah. Great docs.
+ *  paths, the shape points of each edge of a simplified graph, is passed
+ *  through if present.
  */
 function pyGraphToNodesAndEdges(roads_graph) {
   let nodes = [];
@@ -42,7 +51,38 @@ function pyGraphToNodesAndEdges(roads_graph) {
     nodes[n1].adjacent.push(n2);
     nodes[n2].adjacent.push(n1);
   }
-  return {nodes: nodes, edges: roads_graph.edges};
+  return {nodes: nodes, edges: roads_graph.edges, paths: roads_graph.paths};
+}
+
+/** Load the tiles of a tiled graph (see tiled_graph.js) that overlap the
+ *  viewport. The rest of the graph's tiles are fetched as the search
+ *  frontier reaches them.
+ *  @param {string} url url of the tiles directory
+ *  @param {?number[]} viewport [minlon, minlat, maxlon, maxlat], or null for
+ *      the middle quarter of the graph
+ *  @returns {Promise} resolves to the TiledGraph, scaled to height, width
+ */
+function tiledGraphToNodesAndEdges(url, viewport, height, width) {
+  return TiledGraph.load(url).then(graph => {
+    let [minlon, minlat, maxlon, maxlat] = graph.manifest.bbox;
+    if (!viewport) {
+      let dlon = (maxlon - minlon) / 4, dlat = (maxlat - minlat) / 4;
+      viewport = [minlon + dlon, minlat + dlat, maxlon - dlon, maxlat - dlat];
+    }
+    graph.project = bboxProjection(viewport, height, width);
+    graph.height = height;
+    graph.width = width;
+    return graph.loadBbox(viewport).then(() => graph);
+  });
+}
+
+/** Same scaling as scaleNodesToFit, for nodes that haven't been loaded
+ *  yet. Returns a (lon, lat) => [x, y] function.
+ */
+function bboxProjection(bbox, height, width) {
+  let [minx, miny, maxx, maxy] = bbox;
+  let scale = Math.min(width / (maxx - minx), height / (maxy - miny));
+  return (x, y) => [(x - minx) * scale, height - (y - miny) * scale];
 }
 
 /** Scale nodes' x,y values to fit in box of size h,w. Maintain aspect ratio */
@@ -92,6 +132,17 @@ class WozGraph {
 $(document).ready(function() {
   let height = 500;
   let width = 1100;
+  if (typeof roads_graph === 'undefined' && typeof roads_data === 'undefined') {
+    tiledGraphToNodesAndEdges(ROADS_TILES_URL, ROADS_TILES_VIEWPORT, height, width)
+      .then(graph => {
+        console.log('edges loaded: ' + graph.edges.length);
+        let problem = new BidirectionalProblem(graph);
+        let vicDiagram = new BFSDiagram(d3.select('#vicroads_div').select('#vicCanvas'), height, width);
+        graph.onTileLoaded = (nodes, edges) => vicDiagram.drawGraph(nodes, edges);
+        vicDiagram.init(problem, d3.select('#vicroads_div').select('#vicStepCount'));
+      });
+    return;
+  }
   // let ne = vicroadsNodesAndEdges(roads_data);
   let ne = pyGraphToNodesAndEdges(roads_graph);
   console.log('nodes: ' + ne.nodes.length);